@@ -0,0 +1,46 @@
+import random
+
+from django.conf import settings
+from django.db import connections
+
+
+# Модели каталога, чтение которых можно отдавать репликам: навигация, сводный каталог и все товары
+CATALOG_MODELS = {'parentcategory', 'category', 'catalogproduct', 'searchtoken'}
+
+
+def _get_catalog_models():
+    from shop.models import get_product_models
+
+    return CATALOG_MODELS | {model._meta.model_name for model in get_product_models()}
+
+
+class ReplicaRouter:
+    """ Чтение каталога (категории, товары) - со случайной реплики из settings.DATABASE_REPLICAS,
+        всё остальное (корзины, заказы, покупатели, сессии) и любые записи - с основной базы.
+        Внутри транзакции основной базы каталог тоже читается с неё: списание остатков и оформление заказа
+        должны видеть свои же изменения, а не отставшую реплику
+    """
+
+    def __init__(self):
+        self.replicas = list(getattr(settings, 'DATABASE_REPLICAS', []))
+        self._catalog_models = None
+
+    def is_catalog_model(self, model):
+        if self._catalog_models is None:
+            self._catalog_models = _get_catalog_models()
+        return model._meta.app_label == 'shop' and model._meta.model_name in self._catalog_models
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or not self.is_catalog_model(model) or connections['default'].in_atomic_block:
+            return 'default'
+        return random.choice(self.replicas)
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики - копии основной базы, связи между объектами с разных подключений допустимы
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
@@ -12,20 +12,45 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 import os
 from pathlib import Path
 
+import django
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve(strict=True).parent.parent
 
 
+# Настройки окружения: все параметры, которые отличаются на рабочем сервере, задаются переменными окружения
+# с префиксом DJANGO_. Без них проект работает как раньше - в режиме разработки на SQLite
+
+def env(name, default=None):
+    return os.environ.get('DJANGO_' + name, default)
+
+
+def env_bool(name, default=False):
+    value = env(name)
+    return default if value is None else value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def env_int(name, default):
+    value = env(name)
+    return default if value is None or value == '' else int(value)
+
+
+def env_list(name, default=()):
+    value = env(name)
+    return list(default) if value is None else [item.strip() for item in value.split(',') if item.strip()]
+
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/3.1/howto/deployment/checklist/
 
 # SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = '_fhjhd4i8z#d737o=70fzzum_34jk@61de30((i7ncgo+rbb5e'
+SECRET_KEY = env('SECRET_KEY', '_fhjhd4i8z#d737o=70fzzum_34jk@61de30((i7ncgo+rbb5e')
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# В режиме отладки Django хранит в памяти каждый выполненный SQL-запрос - на рабочем сервере DJANGO_DEBUG=0
+DEBUG = env_bool('DEBUG', True)
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = env_list('ALLOWED_HOSTS')
 
 
 # Application definition
@@ -47,6 +72,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Статистика запросов (SHOP_INSTRUMENTATION) - первой, чтобы учитывать запросы остальных middleware
+    'shop.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -71,6 +98,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'shop.context_processors.cart',
+                'shop.context_processors.categories',
             ],
         },
     },
@@ -93,13 +122,141 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Профиль базы данных: DJANGO_DB_PROFILE=sqlite (по умолчанию) или postgres
+
+DB_PROFILE = env('DB_PROFILE', 'sqlite')
+
+# Сколько секунд держать подключение к базе между запросами (0 - закрывать после каждого запроса).
+# Постоянные подключения экономят установку соединения на каждый запрос
+CONN_MAX_AGE = env_int('CONN_MAX_AGE', 0 if DEBUG else 60)
+
+if DB_PROFILE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'fishing_shop.sqlite',
+            'NAME': env('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': CONN_MAX_AGE,
+            'OPTIONS': {
+                # WAL: чтение не блокируется записью, запись - одна транзакция за раз без блокировки читателей
+                'pragmas': {
+                    'journal_mode': env('SQLITE_JOURNAL_MODE', 'WAL'),
+                    'synchronous': env('SQLITE_SYNCHRONOUS', 'NORMAL'),
+                    # Сколько миллисекунд ждать блокировку записи, прежде чем ответить "database is locked"
+                    'busy_timeout': env_int('SQLITE_BUSY_TIMEOUT', 20000),
+                    'mmap_size': env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+                    'cache_size': env_int('SQLITE_CACHE_SIZE', -64000),
+                    'temp_store': 'MEMORY',
+                },
+                # Транзакции с записью (write_atomic магазина) сразу берут блокировку записи и ждут её, а не падают
+                # при конкурентной записи. Остальные транзакции (только чтение) блокировку записи не берут
+                'transaction_mode': env('SQLITE_TRANSACTION_MODE', 'DEFERRED'),
+                'write_transaction_mode': env('SQLITE_WRITE_TRANSACTION_MODE', 'IMMEDIATE'),
+            },
+        }
+    }
+elif DB_PROFILE == 'postgres':
+    def postgres_database(host):
+        return {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': env('DB_NAME', 'fishing_shop'),
+            'USER': env('DB_USER', 'fishing_shop'),
+            'PASSWORD': env('DB_PASSWORD', ''),
+            'HOST': host,
+            'PORT': env('DB_PORT', '5432'),
+            'CONN_MAX_AGE': env_int('CONN_MAX_AGE', 600),
+            # Через PgBouncer в режиме пула транзакций серверные курсоры недоступны
+            'DISABLE_SERVER_SIDE_CURSORS': env_bool('DB_PGBOUNCER', False),
+            'OPTIONS': {
+                'connect_timeout': env_int('DB_CONNECT_TIMEOUT', 5),
+            },
+        }
+
+    DATABASES = {'default': postgres_database(env('DB_HOST', 'localhost'))}
+    # Реплики только для чтения: DJANGO_DB_REPLICAS=host1,host2. Чтение каталога уходит на них (ReplicaRouter)
+    for number, host in enumerate(env_list('DB_REPLICAS')):
+        DATABASES['replica_{}'.format(number)] = dict(postgres_database(host), TEST={'MIRROR': 'default'})
+else:
+    raise ValueError('Неизвестный DJANGO_DB_PROFILE: {}'.format(DB_PROFILE))
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['fishing_shop.routers.ReplicaRouter'] if DATABASE_REPLICAS else []
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+# Кэши магазина: catalog - данные каталога и версии ключей, fragments - готовые фрагменты HTML,
+# sessions - сессии (cached_db). DJANGO_CACHE_BACKEND: file (каталог DJANGO_CACHE_DIR), db (таблицы
+# shop_cache_<имя>, после `manage.py createcachetable`), memcached (DJANGO_CACHE_LOCATION, через запятую)
+# или locmem. По умолчанию - общий для воркеров файловый кэш, locmem - только в режиме отладки без
+# DJANGO_CACHE_DIR. locmem виден только своему процессу: при нескольких воркерах у каждого свои версии ключей
+# и блокировки перестройки, поэтому вне отладки магазин предупреждает о нём при запуске, а при нескольких
+# воркерах (SHOP_WORKERS) не запускается
+CACHE_DIR = env('CACHE_DIR')
+CACHE_BACKEND = env('CACHE_BACKEND', 'locmem' if DEBUG and not CACHE_DIR else 'file')
+
+# memcached через pymemcache (Django 3.2+) или pylibmc: клиент python-memcached (MemcachedCache) устарел
+MEMCACHED_BACKEND = 'django.core.cache.backends.memcached.{}'.format(
+    'PyMemcacheCache' if django.VERSION >= (3, 2) else 'PyLibMCCache'
+)
+
+# Сколько процессов-воркеров обслуживают сайт: DJANGO_WORKERS или WEB_CONCURRENCY (его читают gunicorn и uvicorn)
+SHOP_WORKERS = env_int('WORKERS', int(os.environ.get('WEB_CONCURRENCY') or 1))
+
+def shop_cache(name):
+    """ Настройки именованного кэша магазина для выбранного CACHE_BACKEND
+    """
+    options = {'MAX_ENTRIES': env_int('CACHE_MAX_ENTRIES', 10000)}
+    if CACHE_BACKEND == 'db':
+        return {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'shop_cache_{}'.format(name),
+            'TIMEOUT': None,
+            'OPTIONS': options,
+        }
+    if CACHE_BACKEND == 'memcached':
+        return {
+            'BACKEND': MEMCACHED_BACKEND,
+            'LOCATION': env_list('CACHE_LOCATION', ['127.0.0.1:11211']),
+            'KEY_PREFIX': name,
+            'TIMEOUT': None,
+        }
+    if CACHE_BACKEND == 'locmem':
+        return {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': name,
+            'TIMEOUT': None,
+            'OPTIONS': options,
+        }
+    return {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(CACHE_DIR or os.path.join(BASE_DIR, 'cache'), name),
+        'TIMEOUT': None,
+        'OPTIONS': options,
     }
+
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalog': shop_cache('catalog'),
+    'fragments': shop_cache('fragments'),
+    'sessions': shop_cache('sessions'),
 }
 
+SHOP_CATALOG_CACHE = 'catalog'
+SHOP_FRAGMENTS_CACHE = 'fragments'
+
+# Сессии читаются из кэша, а пишутся и в кэш, и в БД - корзина переживает очистку кэша
+# (cached_db, промахи кэша сессий учитываются в статистике запросов)
+SESSION_ENGINE = 'shop.sessions'
+SESSION_CACHE_ALIAS = 'sessions'
+
+# Асинхронные представления страниц каталога (главная, каталог, подкатегория, товар) - при запуске под ASGI
+# (uvicorn fishing_shop.asgi:application). Под WSGI оставляем синхронные
+SHOP_ASYNC_VIEWS = env_bool('ASYNC_VIEWS', False)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
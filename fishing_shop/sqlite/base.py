@@ -0,0 +1,58 @@
+"""
+Бэкенд SQLite с настройками под конкурентную нагрузку (ENGINE = 'fishing_shop.sqlite').
+Дополнительные ключи OPTIONS (в sqlite3.connect не передаются):
+    pragmas - PRAGMA, выполняемые на каждом новом подключении (journal_mode=WAL, synchronous=NORMAL, ...)
+    transaction_mode - режим BEGIN обычных транзакций atomic: DEFERRED (как в Django), IMMEDIATE или EXCLUSIVE
+    write_transaction_mode - режим BEGIN транзакций, начатых внутри write_transaction() (по умолчанию IMMEDIATE).
+        IMMEDIATE берёт блокировку записи в начале транзакции: параллельные транзакции ждут её busy_timeout,
+        а не падают с "database is locked" при попытке повысить блокировку чтения до записи. Транзакциям только
+        на чтение (админка, чтение каталога в atomic) блокировка записи не нужна - они остаются DEFERRED
+"""
+from contextlib import contextmanager
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+def _get_transaction_mode(conn_params, name, default):
+    mode = (conn_params.pop(name, None) or default).upper()
+    if mode not in TRANSACTION_MODES:
+        raise ImproperlyConfigured('{}: одно из {}'.format(name, ', '.join(TRANSACTION_MODES)))
+    return mode
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_intent = False
+
+    def get_connection_params(self):
+        conn_params = super().get_connection_params()
+        self.pragmas = conn_params.pop('pragmas', {})
+        self.transaction_mode = _get_transaction_mode(conn_params, 'transaction_mode', 'DEFERRED')
+        self.write_transaction_mode = _get_transaction_mode(conn_params, 'write_transaction_mode', 'IMMEDIATE')
+        return conn_params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute('PRAGMA {} = {}'.format(name, value))
+        return conn
+
+    @contextmanager
+    def write_transaction(self):
+        """ Транзакция, начатая внутри блока, будет писать: BEGIN в режиме write_transaction_mode
+        """
+        previous, self.write_intent = self.write_intent, True
+        try:
+            yield
+        finally:
+            self.write_intent = previous
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.write_transaction_mode if self.write_intent else self.transaction_mode
+        self.cursor().execute('BEGIN {}'.format(mode))
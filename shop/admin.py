@@ -1,5 +1,10 @@
-from django.contrib import admin
-from .models import Category, ParentCategory, Customer, Cart, CartProduct, Wobblers, Spoons, Order
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.template.response import TemplateResponse
+from .bulk import bulk_edit_products
+from .forms import ProductBulkEditForm
+from .models import Category, ParentCategory, Customer, Cart, CartProduct, Wobblers, Spoons, Order, CatalogProduct, StockReservation, OrderTask
+from .models import get_product_models
 
 
 
@@ -17,8 +22,54 @@ class ParentCategoryAdmin(admin.ModelAdmin):
 
 
 
+class ProductAdmin(admin.ModelAdmin):
+    """ Базовая админка товаров: массовое изменение цен и остатков одним UPDATE по таблице,
+        при редактировании записываются только изменённые колонки
+    """
+    list_display = ['name', 'price', 'stock', 'available']
+    list_filter = ['available', 'created', 'updated']
+    list_editable = ['price', 'stock', 'available']
+    prepopulated_fields = {'slug': ('name',)}
+    actions = ['bulk_edit']
+
+    def save_model(self, request, obj, form, change):
+        # В том числе строки list_editable: вместо записи всех колонок - только изменённые и дата обновления
+        fields = {field.name for field in obj._meta.concrete_fields}
+        changed = [name for name in form.changed_data if name in fields]
+        if change and changed:
+            obj.save(update_fields=changed + ['updated'])
+        else:
+            super().save_model(request, obj, form, change)
+
+    def bulk_edit(self, request, queryset):
+        """ Промежуточная страница с формой массового изменения выбранных товаров
+        """
+        if 'apply' in request.POST:
+            form = ProductBulkEditForm(request.POST)
+            if form.is_valid():
+                count = bulk_edit_products(queryset, **form.get_changes())
+                self.message_user(request, 'Изменено товаров: {}'.format(count), messages.SUCCESS)
+                return None
+        else:
+            form = ProductBulkEditForm()
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Массовое изменение товаров',
+            opts=self.model._meta,
+            form=form,
+            count=queryset.count(),
+            selected=request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+            action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+            select_across=request.POST.get('select_across', '0'),
+        )
+        return TemplateResponse(request, 'admin/shop/bulk_edit.html', context)
+
+    bulk_edit.short_description = 'Изменить цены и остатки выбранных товаров'
+
+
+
 @admin.register(Wobblers)
-class WobblersAdmin(admin.ModelAdmin):
+class WobblersAdmin(ProductAdmin):
     list_display = ['name', 'price', 'stock', 'available']
     list_filter = ['type_of_fishing', 'created', 'updated']
     list_editable = ['price', 'stock', 'available']
@@ -27,7 +78,7 @@ class WobblersAdmin(admin.ModelAdmin):
 
 
 @admin.register(Spoons)
-class SpoonsAdmin(admin.ModelAdmin):
+class SpoonsAdmin(ProductAdmin):
     list_display = ['name',  'price', 'stock', 'available']
     list_filter = ['type_of_fishing', 'created', 'updated']
     list_editable = ['price', 'stock', 'available']
@@ -35,7 +86,32 @@ class SpoonsAdmin(admin.ModelAdmin):
 
 
 
+@admin.register(CatalogProduct)
+class CatalogProductAdmin(admin.ModelAdmin):
+    list_display = ['name', 'model_name', 'product_key', 'price', 'stock', 'available']
+    list_filter = ['model_name', 'available']
+    search_fields = ['name', 'product_key']
+    readonly_fields = [field.name for field in CatalogProduct._meta.fields]
+
+
+
 admin.site.register(CartProduct)
+admin.site.register(StockReservation)
 admin.site.register(Cart)
 admin.site.register(Customer)
-admin.site.register(Order)
\ No newline at end of file
+admin.site.register(Order)
+
+
+
+@admin.register(OrderTask)
+class OrderTaskAdmin(admin.ModelAdmin):
+    list_display = ['key', 'status', 'attempts', 'run_after', 'updated']
+    list_filter = ['status', 'name']
+    readonly_fields = ['order', 'name', 'key', 'attempts', 'last_error', 'updated']
+
+
+
+# Остальные товары - базовая админка
+for product_model in get_product_models():
+    if not admin.site.is_registered(product_model):
+        admin.site.register(product_model, ProductAdmin)
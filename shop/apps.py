@@ -3,4 +3,16 @@ from django.apps import AppConfig
 
 class ShopConfig(AppConfig):
     name = 'shop'
-    verbose_name='Магазин'
\ No newline at end of file
+    verbose_name='Магазин'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+
+        from .cache import check_shared_caches
+        from .registry import registry
+        from .search import create_search_table
+        from .signals import connect_signals
+        check_shared_caches()
+        registry.build()
+        connect_signals()
+        post_migrate.connect(create_search_table, sender=self)
@@ -0,0 +1,153 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.shortcuts import get_object_or_404, render
+
+from .cache import get_categories, get_main_page_products_html, get_parent_categories, get_product
+from .cart import get_cart_service
+from .facets import FacetFilter
+from .instrumentation import query_budget
+from .mixins import KeysetPaginationMixin
+from .models import Category
+from .pagination import KeysetPaginator
+from .registry import CATEGORY_SLUG2PRODUCT_MODEL, registry
+
+
+# Асинхронные варианты страниц каталога для работы под ASGI (включаются настройкой SHOP_ASYNC_VIEWS).
+# В Django 3.1 нет асинхронного ORM и кэша, поэтому запросы к БД, кэшу и отрисовка шаблонов выполняются
+# в пуле потоков, а независимые обращения (корзина, категории, товар) - одновременно через asyncio.gather.
+# Воркер при этом не держит поток на каждое соединение, пока ждёт БД
+
+
+def _call(func, *args, **kwargs):
+    # Подключения потоков пула живут по тем же правилам CONN_MAX_AGE, что и подключения запросов
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """ Синхронный код (ORM, кэш, шаблоны) в пуле потоков. Вызовы не привязаны к одному потоку,
+        поэтому несколько таких вызовов одного запроса выполняются параллельно
+    """
+    return await sync_to_async(_call, thread_sensitive=False)(func, *args, **kwargs)
+
+
+def load_cart(request):
+    """ Корзина запроса (с переносом гостевой корзины после входа), как в CartMixin
+    """
+    service = get_cart_service(request)
+    service.merge_guest_cart()
+    return service, service.get_cart()
+
+
+def render_page(request, service, template_name, context):
+    """ Отрисовка страницы и запись гостевой корзины в ответ
+    """
+    context['user'] = request.user
+    return service.save(render(request, template_name, context))
+
+
+@query_budget(2, cold=8)
+async def main_view(request):
+    """ Главная страница
+    """
+    (service, cart), category, parent_category, products_html = await asyncio.gather(
+        run_in_thread(load_cart, request),
+        run_in_thread(get_categories),
+        run_in_thread(get_parent_categories),
+        run_in_thread(get_main_page_products_html, 'wobblers', 'spoons'),
+    )
+    return await run_in_thread(render_page, request, service, 'shop/index.html', {
+        'parent_category': parent_category,
+        'category': category,
+        'products_html': products_html,
+        'title': 'Sniper Fish интернет магазин',
+        'cart': cart,
+    })
+
+
+@query_budget(2, cold=7)
+async def category_view(request):
+    """ Общий раздел категорий (Каталог)
+    """
+    (service, cart), category, parent_category = await asyncio.gather(
+        run_in_thread(load_cart, request),
+        run_in_thread(get_categories),
+        run_in_thread(get_parent_categories),
+    )
+    return await run_in_thread(render_page, request, service, 'shop/categories.html', {
+        'parent_category': parent_category,
+        'category': category,
+        'title': 'Каталог товаров',
+        'cart': cart,
+    })
+
+
+def get_category_page(facet_filter, params):
+    """ Страница товаров подкатегории с учётом фасетов, как в KeysetPaginationMixin
+    """
+    paginator = KeysetPaginator(
+        facet_filter.filter(facet_filter.model.objects.all()),
+        KeysetPaginationMixin.page_size,
+        KeysetPaginationMixin.page_ordering,
+    )
+    return paginator.get_page(after=params.get('after'), before=params.get('before'), params=params)
+
+
+@query_budget(4, cold=13)
+async def category_detail_view(request, slug):
+    """ Раздел подкатегории: фасеты и страница товаров считаются одновременно
+    """
+    (service, cart), obj, category = await asyncio.gather(
+        run_in_thread(load_cart, request),
+        run_in_thread(get_object_or_404, Category, slug=slug),
+        run_in_thread(get_categories),
+    )
+    model = CATEGORY_SLUG2PRODUCT_MODEL[obj.slug]
+    facet_filter = FacetFilter(model, request.GET)
+    facets, page = await asyncio.gather(
+        run_in_thread(facet_filter.get_facets, model.objects.all()),
+        run_in_thread(get_category_page, facet_filter, request.GET),
+    )
+    return await run_in_thread(render_page, request, service, 'shop/category_detail.html', {
+        'object': obj,
+        'categories': obj,
+        'category': category,
+        'facets': facets,
+        'facet_filter': facet_filter,
+        'page': page,
+        'product': page.object_list,
+        'cart': cart,
+    })
+
+
+def load_product(ct_model, slug):
+    """ Товар с подкатегорией из кэша каталога, как в ProductDetailView
+    """
+    model = registry.get_model_or_404(ct_model)
+    queryset = model._base_manager.all()
+    if any(field.name == 'category' for field in model._meta.concrete_fields):
+        queryset = queryset.select_related('category')
+    return model, get_product(model, slug, lambda: get_object_or_404(queryset, slug=slug))
+
+
+@query_budget(2, cold=7)
+async def product_detail_view(request, ct_model, slug):
+    """ Страница товара
+    """
+    (service, cart), (model, product), category = await asyncio.gather(
+        run_in_thread(load_cart, request),
+        run_in_thread(load_product, ct_model, slug),
+        run_in_thread(get_categories),
+    )
+    return await run_in_thread(render_page, request, service, 'shop/product_detail.html', {
+        'object': product,
+        'product': product,
+        'ct_model': model._meta.model_name,
+        'category': category,
+        'cart': cart,
+    })
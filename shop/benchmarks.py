@@ -0,0 +1,459 @@
+import json
+import platform
+import random
+import statistics
+import subprocess
+import threading
+import time
+from decimal import Decimal
+from http.client import HTTPConnection
+from socketserver import ThreadingMixIn
+from urllib.parse import urlencode
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection, connections
+from django.http import HttpRequest
+from django.middleware.csrf import get_token
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from .cache import bump_version, CATALOG_CACHE, CATEGORIES, PRODUCTS
+from .instrumentation import percentile
+from .models import Cart, CartProduct, CatalogProduct, Category, Customer, ParentCategory, Spoons, Wobblers
+from .search import index_products
+from .utils import add_cart_product, get_product_content_key, update_cart_totals, write_atomic
+
+
+# Синтетические данные помечаются префиксом в адресах и именах пользователей, чтобы их можно было удалить
+PREFIX = 'bench-'
+USER_PREFIX = 'bench-user-'
+
+# Коды синтетических товаров начинаются отсюда, чтобы не пересекаться с кодами настоящих товаров
+PRODUCT_KEY_BASE = 900000000
+
+SEED_BATCH_SIZE = 500
+
+# Подкатегории, к которым привязаны синтетические воблеры и блесны (их адреса знает CATEGORY_SLUG2PRODUCT_MODEL)
+WOBBLERS_CATEGORY = ('voblery', 'Воблеры')
+SPOONS_CATEGORY = ('blesny', 'Блесны')
+
+ORDER_FORM = {
+    'first_name': 'Бенчмарк', 'last_name': 'Магазина', 'phone': '0', 'address': '-', 'buying_type': 'self',
+    'order_date': '2030-01-01', 'comment': '',
+}
+
+
+# Синтетический каталог
+
+def clear_bench_data():
+    """
+    Удаляем синтетические данные: покупателей (с корзинами и заказами), товары, подкатегории и категории
+    :return: Колличество удалённых объектов
+    """
+    deleted = User.objects.filter(username__startswith=USER_PREFIX).delete()[0]
+    for model in (Wobblers, Spoons):
+        deleted += model._base_manager.filter(slug__startswith=PREFIX).delete()[0]
+    deleted += Category.objects.filter(slug__startswith=PREFIX).delete()[0]
+    deleted += ParentCategory.objects.filter(slug__startswith=PREFIX).delete()[0]
+    bump_version(CATEGORIES)
+    bump_version(PRODUCTS)
+    return deleted
+
+
+def _create_products(model, count, category, rnd, fields):
+    model_name = model._meta.model_name
+    products = [
+        model(
+            category=category,
+            product_key=PRODUCT_KEY_BASE + number,
+            name='{} {} {}'.format(model._meta.verbose_name, rnd.choice(('Pro', 'Lite', 'Max', 'Deep')), number),
+            slug='{}{}-{}'.format(PREFIX, model_name, number),
+            description='Синтетический товар для нагрузочного тестирования',
+            price=Decimal(rnd.randint(100, 5000)),
+            stock=10 ** 6,
+            **{name: value() for name, value in fields.items()}
+        )
+        for number in range(count)
+    ]
+    model._base_manager.bulk_create(products, batch_size=SEED_BATCH_SIZE)
+    # bulk_create не вызывает сигналов: каталог и поисковый индекс заполняем пачками
+    created = list(model._base_manager.filter(slug__startswith=PREFIX))
+    for start in range(0, len(created), SEED_BATCH_SIZE):
+        batch = created[start:start + SEED_BATCH_SIZE]
+        CatalogProduct.objects.sync_many(model, batch, batch_size=SEED_BATCH_SIZE)
+        index_products(model, batch)
+    return created
+
+
+def seed_catalog(parents=3, categories=12, wobblers=2000, spoons=2000, customers=50, max_cart_lines=8, seed=42):
+    """
+    Заполняем базу синтетическим каталогом: категории и подкатегории для навигации, воблеры и блесны
+    (в подкатегориях voblery и blesny), покупатели с корзинами от 0 до max_cart_lines строк.
+    Прежние синтетические данные удаляются, так что одинаковый seed даёт одинаковые данные
+    :return: Словарь с колличеством созданных объектов
+    """
+    rnd = random.Random(seed)
+    clear_bench_data()
+    with write_atomic():
+        parent_objects = [
+            ParentCategory.objects.create(name='Категория {}'.format(number), slug='{}parent-{}'.format(PREFIX, number))
+            for number in range(max(parents, 1))
+        ]
+        Category.objects.bulk_create([
+            Category(
+                category=parent_objects[number % len(parent_objects)], name='Подкатегория {}'.format(number),
+                slug='{}category-{}'.format(PREFIX, number)
+            )
+            for number in range(categories)
+        ])
+        wobblers_category = Category.objects.get_or_create(
+            slug=WOBBLERS_CATEGORY[0], defaults={'name': WOBBLERS_CATEGORY[1], 'category': parent_objects[0]}
+        )[0]
+        spoons_category = Category.objects.get_or_create(
+            slug=SPOONS_CATEGORY[0], defaults={'name': SPOONS_CATEGORY[1], 'category': parent_objects[0]}
+        )[0]
+
+        countries = ('Япония', 'Китай', 'Россия', 'Финляндия')
+        fishing = ('спиннинг', 'троллинг', 'нахлыст')
+        products = _create_products(Wobblers, wobblers, wobblers_category, rnd, {
+            'weight': lambda: rnd.randint(2, 40), 'long': lambda: rnd.randint(40, 160),
+            'type_of_fishing': lambda: rnd.choice(fishing), 'deepening': lambda: rnd.randint(1, 60) / 10,
+            'manufacturer_country': lambda: rnd.choice(countries),
+            'type_of_buoyancy': lambda: rnd.choice(('floating', 'sinking', 'suspending')),
+            'type': lambda: rnd.choice(('minnow', 'crank', 'shad', 'popper')),
+        })
+        products += _create_products(Spoons, spoons, spoons_category, rnd, {
+            'weight': lambda: rnd.randint(2, 40), 'long': lambda: rnd.randint(20, 120),
+            'type_of_fishing': lambda: rnd.choice(fishing), 'manufacturer_country': lambda: rnd.choice(countries),
+            'type': lambda: rnd.choice(('вертушка', 'колебалка', 'пилькер')),
+        })
+
+        User.objects.bulk_create([User(username='{}{}'.format(USER_PREFIX, number)) for number in range(customers)])
+        users = list(User.objects.filter(username__startswith=USER_PREFIX).order_by('pk'))
+        Customer.objects.bulk_create([Customer(user=user) for user in users])
+        lines = 0
+        for customer in Customer.objects.filter(user__in=users).order_by('pk'):
+            cart = Cart.objects.create(owner=customer)
+            cart_products = []
+            for product in rnd.sample(products, min(len(products), rnd.randint(0, max_cart_lines))):
+                content_type_id, object_id = get_product_content_key(product)
+                qty = rnd.randint(1, 3)
+                cart_products.append(CartProduct(
+                    user=customer, cart=cart, content_type_id=content_type_id, object_id=object_id, qty=qty,
+                    final_price=product.price * qty
+                ))
+            CartProduct.objects.bulk_create(cart_products)
+            update_cart_totals(cart)
+            lines += len(cart_products)
+    bump_version(CATEGORIES)
+    bump_version(PRODUCTS)
+    return {
+        'parent_categories': len(parent_objects), 'categories': categories, 'wobblers': wobblers, 'spoons': spoons,
+        'customers': len(users), 'cart_lines': lines,
+    }
+
+
+# Сценарии
+
+class BenchUser:
+    """ Синтетический покупатель, от имени которого выполняются запросы сценариев
+    """
+
+    def __init__(self, user, products, rnd):
+        self.user = user
+        self.customer = Customer.objects.get(user=user)
+        self.products = products
+        self.rnd = rnd
+
+    def pick(self):
+        return self.rnd.choice(self.products)
+
+    def get_cart(self):
+        return Cart.objects.get_or_create(owner=self.customer, in_order=False)[0]
+
+    def ensure_in_cart(self, product):
+        """ Товар есть в корзине (нужно перед изменением колличества и оформлением заказа)
+        """
+        cart = self.get_cart()
+        content_type_id, object_id = get_product_content_key(product)
+        if not cart.related_products.filter(content_type_id=content_type_id, object_id=object_id).exists():
+            add_cart_product(cart, product)
+
+
+def _product_path(prefix, product):
+    return '/{}/{}/{}/'.format(prefix, product.model_name, product.slug)
+
+
+def _home(bench_user):
+    return 'get', '/', None
+
+
+def _category_detail(bench_user):
+    return 'get', '/categories/{}/'.format(bench_user.rnd.choice((WOBBLERS_CATEGORY[0], SPOONS_CATEGORY[0]))), None
+
+
+def _product_detail(bench_user):
+    return 'get', _product_path('categories', bench_user.pick()), None
+
+
+def _cart(bench_user):
+    return 'get', '/cart/', None
+
+
+def _add_to_cart(bench_user):
+    return 'get', _product_path('add-to-cart', bench_user.pick()), None
+
+
+def _change_qty(bench_user):
+    product = bench_user.pick()
+    bench_user.ensure_in_cart(product)
+    return 'post', _product_path('change-qty', product), {'qty': bench_user.rnd.randint(1, 3)}
+
+
+def _make_order(bench_user):
+    bench_user.ensure_in_cart(bench_user.pick())
+    return 'post', '/make-order/', ORDER_FORM
+
+
+# Сценарий -> функция, готовящая данные (вне замера) и возвращающая (метод, адрес, данные формы)
+SCENARIOS = {
+    'home': _home,
+    'category_detail': _category_detail,
+    'product_detail': _product_detail,
+    'cart': _cart,
+    'add_to_cart': _add_to_cart,
+    'change_qty': _change_qty,
+    'make_order': _make_order,
+}
+
+OK_STATUSES = (200, 302)
+
+
+def get_bench_users(count, seed=42):
+    """ Синтетические покупатели и товары для сценариев (нужен bench_seed)
+    """
+    users = list(User.objects.filter(username__startswith=USER_PREFIX).order_by('pk')[:count])
+    products = list(CatalogProduct.objects.filter(slug__startswith=PREFIX, available=True).order_by('pk'))
+    if len(users) < count or not products:
+        raise ValueError('Нет синтетических данных: нужно {} покупателей, выполните bench_seed'.format(count))
+    return [BenchUser(user, products, random.Random(seed + number)) for number, user in enumerate(users)]
+
+
+def summarize(latencies, errors, elapsed, queries=None):
+    """
+    Сводка замера
+    :param latencies: Длительности успешных запросов в секундах
+    :param errors: Колличество неуспешных запросов
+    :param elapsed: Общее время замера в секундах (для пропускной способности)
+    :param queries: Колличество запросов к БД на каждый запрос (только для тестового клиента)
+    """
+    values = [latency * 1000 for latency in latencies]
+    result = {
+        'requests': len(values),
+        'errors': errors,
+        'throughput_rps': round(len(values) / elapsed, 2) if elapsed else 0,
+        'mean_ms': round(statistics.mean(values), 2) if values else 0,
+        'p50_ms': round(percentile(values, 0.5), 2),
+        'p95_ms': round(percentile(values, 0.95), 2),
+        'p99_ms': round(percentile(values, 0.99), 2),
+        'max_ms': round(max(values), 2) if values else 0,
+    }
+    if queries:
+        result['queries_median'] = statistics.median(queries)
+    return result
+
+
+def run_client(scenario, bench_user, iterations, warmup=5):
+    """ Последовательный замер сценария через тестовый клиент Django (с подсчётом запросов к БД)
+    """
+    client = Client()
+    client.force_login(bench_user.user)
+    prepare = SCENARIOS[scenario]
+    latencies, queries, errors, elapsed = [], [], 0, 0.0
+    for number in range(warmup + iterations):
+        method, path, data = prepare(bench_user)
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            response = getattr(client, method)(path, data or {}, HTTP_REFERER='/')
+            duration = time.perf_counter() - started
+        if number < warmup:
+            continue
+        elapsed += duration
+        if response.status_code in OK_STATUSES:
+            latencies.append(duration)
+            queries.append(len(context.captured_queries))
+        else:
+            errors += 1
+    return summarize(latencies, errors, elapsed, queries)
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class LoadServer:
+    """ Локальный многопоточный WSGI-сервер с приложением проекта на свободном порту
+    """
+
+    def __init__(self):
+        self.server = make_server(
+            '127.0.0.1', 0, WSGIHandler(), server_class=_ThreadingWSGIServer, handler_class=_QuietHandler
+        )
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _get_session_headers(bench_user):
+    """ Cookie сессии авторизованного покупателя и CSRF-токен для запросов по HTTP
+    """
+    client = Client()
+    client.force_login(bench_user.user)
+    request = HttpRequest()
+    token = get_token(request)
+    cookie = '{}={}; {}={}'.format(
+        settings.SESSION_COOKIE_NAME, client.cookies[settings.SESSION_COOKIE_NAME].value,
+        settings.CSRF_COOKIE_NAME, request.META['CSRF_COOKIE'],
+    )
+    return {'Cookie': cookie, 'X-CSRFToken': token, 'Referer': '/'}
+
+
+def run_load(scenario, bench_users, requests_per_user, warmup=2):
+    """
+    Конкурентный замер: каждый покупатель - отдельный поток, запросы идут по HTTP в локальный WSGI-сервер
+    :param bench_users: Покупатели (сколько покупателей, столько параллельных потоков)
+    """
+    prepare = SCENARIOS[scenario]
+    lock = threading.Lock()
+    latencies, errors = [], [0]
+    headers = [_get_session_headers(bench_user) for bench_user in bench_users]
+    barrier = threading.Barrier(len(bench_users) + 1)
+
+    def worker(server, bench_user, user_headers):
+        http = HTTPConnection('127.0.0.1', server.port, timeout=60)
+        try:
+            for number in range(warmup + requests_per_user):
+                if number == warmup:
+                    # Замер начинается, когда все потоки прогрелись
+                    barrier.wait()
+                method, path, data = prepare(bench_user)
+                request_headers = dict(user_headers)
+                body = None
+                if method == 'post':
+                    body = urlencode(data or {})
+                    request_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+                started = time.perf_counter()
+                try:
+                    http.request(method.upper(), path, body=body, headers=request_headers)
+                    response = http.getresponse()
+                    response.read()
+                    ok = response.status in OK_STATUSES
+                except OSError:
+                    http.close()
+                    ok = False
+                duration = time.perf_counter() - started
+                if number < warmup:
+                    continue
+                with lock:
+                    if ok:
+                        latencies.append(duration)
+                    else:
+                        errors[0] += 1
+        except threading.BrokenBarrierError:
+            pass
+        except Exception:
+            barrier.abort()
+            raise
+        finally:
+            http.close()
+            connections.close_all()
+
+    with LoadServer() as server:
+        threads = [
+            threading.Thread(target=worker, args=(server, bench_user, user_headers))
+            for bench_user, user_headers in zip(bench_users, headers)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    return summarize(latencies, errors[0], elapsed)
+
+
+# Результаты
+
+def get_environment():
+    """ Описание окружения замера для файла результатов
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ''
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'cache': settings.CACHES.get(CATALOG_CACHE, {}).get('BACKEND', ''),
+        'debug': settings.DEBUG,
+        'products': CatalogProduct.objects.count(),
+        'customers': Customer.objects.count(),
+    }
+
+
+def save_results(path, results):
+    with open(path, 'w', encoding='utf-8') as stream:
+        json.dump(results, stream, ensure_ascii=False, indent=2)
+
+
+def load_results(path):
+    with open(path, encoding='utf-8') as stream:
+        return json.load(stream)
+
+
+COMPARED_METRICS = ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+def compare_results(results, baseline):
+    """
+    Сравнение с базовым замером
+    :return: Список (режим, сценарий, метрика, было, стало, изменение в %); для времени рост - ухудшение,
+             для пропускной способности - улучшение
+    """
+    rows = []
+    for mode, scenarios in results['results'].items():
+        for scenario, current in scenarios.items():
+            previous = baseline.get('results', {}).get(mode, {}).get(scenario)
+            if not previous:
+                continue
+            for metric in COMPARED_METRICS:
+                before, after = previous.get(metric), current.get(metric)
+                if not before or after is None:
+                    continue
+                rows.append((mode, scenario, metric, before, after, round((after - before) / before * 100, 1)))
+    return rows
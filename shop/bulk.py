@@ -0,0 +1,84 @@
+from decimal import Decimal
+
+from django.db import models
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .cache import bump_version, PRODUCTS
+from .models import CatalogProduct
+from .utils import write_atomic
+
+
+PRICE_PERCENT = 'percent'
+PRICE_AMOUNT = 'amount'
+
+STOCK_DELTA = 'delta'
+STOCK_SET = 'set'
+
+
+class Round(models.Func):
+    """ ROUND(x, знаков) - в Django 3.1 Round не принимает колличество знаков
+    """
+    function = 'ROUND'
+
+    def __init__(self, expression, places, **extra):
+        super().__init__(expression, models.Value(places), **extra)
+
+
+def get_price_expression(model, change, value):
+    """
+    Новая цена через выражение над колонкой: процент (+10 / -15) или сумма (+100 / -50), не ниже нуля,
+    с округлением до копеек
+    """
+    field = model._meta.get_field('price')
+    if change == PRICE_PERCENT:
+        # Множитель считаем заранее: на SQLite деление целых цен (51 * 50 / 100) было бы целочисленным
+        price = models.F('price') * ((Decimal(100) + Decimal(value)) / Decimal(100))
+    else:
+        price = models.F('price') + Decimal(value)
+    # Ноль - целым числом: Decimal передаётся в SQLite строкой, а строка при сравнении больше любого числа
+    return Round(Greatest(price, models.Value(0)), field.decimal_places, output_field=field)
+
+
+def get_stock_expression(change, value):
+    """ Новый остаток: прибавить/убавить (не ниже нуля) или задать значение
+    """
+    if change == STOCK_SET:
+        return models.Value(int(value))
+    return Greatest(models.F('stock') + int(value), 0)
+
+
+def bulk_edit_products(queryset, price_change=None, price_value=None, stock_change=None, stock_value=None,
+                       available=None):
+    """
+    Массовое изменение цен, остатков и доступности товаров одной модели: выборка id товаров, один UPDATE
+    по таблице товаров только изменяемых колонок (и даты обновления), затем один UPDATE сводного каталога
+    с подзапросом и сброс кэша товаров. Сигналы post_save не вызываются
+    :param queryset: Отфильтрованные товары (например, выбранные в админке)
+    :param price_change: PRICE_PERCENT или PRICE_AMOUNT (None - цену не менять)
+    :param stock_change: STOCK_DELTA или STOCK_SET (None - остаток не менять)
+    :param available: True/False (None - не менять)
+    :return: Колличество изменённых товаров
+    """
+    model = queryset.model
+    changes = {}
+    if price_change and price_value:
+        changes['price'] = get_price_expression(model, price_change, price_value)
+    if stock_change and (stock_value or stock_change == STOCK_SET):
+        changes['stock'] = get_stock_expression(stock_change, stock_value or 0)
+    if available is not None:
+        changes['available'] = available
+    if not changes:
+        return 0
+
+    # id выбранных товаров собираем до UPDATE и меняем ровно эти строки: после изменения фильтр queryset
+    # может их уже не выбирать, а по дате обновления нашлись бы и товары, сохранённые в ту же микросекунду
+    now = timezone.now()
+    with write_atomic():
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+        if not pks:
+            return 0
+        count = model._base_manager.filter(pk__in=pks).update(updated=now, **changes)
+        CatalogProduct.objects.refresh_from_products(model, pks, [*changes, 'updated'])
+    bump_version(PRODUCTS)
+    return count
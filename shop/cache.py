@@ -0,0 +1,337 @@
+import logging
+import os
+import tempfile
+import time
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.template.loader import render_to_string
+
+from .instrumentation import record_cache
+
+logger = logging.getLogger(__name__)
+
+# Алиасы кэшей магазина из settings.CACHES: данные каталога (навигация, товары, фасеты, версии ключей)
+# и готовые фрагменты HTML
+CATALOG_CACHE = getattr(settings, 'SHOP_CATALOG_CACHE', 'catalog')
+FRAGMENTS_CACHE = getattr(settings, 'SHOP_FRAGMENTS_CACHE', 'fragments')
+
+# Мягкий срок жизни значений, секунд (None - пока не сменится версия). После него значение ещё отдаётся,
+# но один воркер уже перестраивает его. Страховка для изменений, прошедших мимо сигналов (массовые UPDATE)
+SOFT_TIMEOUT = getattr(settings, 'SHOP_CACHE_SOFT_TIMEOUT', 600)
+
+# Сколько устаревшее значение ещё можно отдавать, пока его перестраивают (жёсткий срок = мягкий + STALE_GRACE)
+STALE_GRACE = getattr(settings, 'SHOP_CACHE_STALE_GRACE', 3600)
+
+# Блокировка перестройки ключа: только один воркер строит значение, остальные отдают старое или ждут
+LOCK_TIMEOUT = getattr(settings, 'SHOP_CACHE_LOCK_TIMEOUT', 30)
+# Сколько секунд ждать значение, которое строит другой воркер, при пустом кэше (потом строим сами)
+LOCK_WAIT = getattr(settings, 'SHOP_CACHE_LOCK_WAIT', 5)
+LOCK_POLL_INTERVAL = 0.05
+
+# Сколько процессов-воркеров обслуживают сайт: с кэшем в памяти процесса при нескольких воркерах не запускаемся
+WORKERS = getattr(settings, 'SHOP_WORKERS', 1)
+
+KEY_PREFIX = 'shop'
+
+# Значение в кэше вместе с моментом (time.time()), после которого оно считается устаревшим
+CachedValue = namedtuple('CachedValue', 'value stale_at')
+
+
+def get_cache(alias=CATALOG_CACHE):
+    return caches[alias]
+
+
+def check_shared_caches():
+    """
+    Кэши магазина должны быть общими для воркеров: в locmem у каждого процесса свои версии ключей, блокировки
+    перестройки и сессии, и изменение каталога в одном воркере не сбрасывает кэш остальных. Вне режима отладки
+    locmem даёт предупреждение, а при нескольких воркерах - ошибку запуска
+    """
+    if settings.DEBUG:
+        return
+    session_cache = getattr(settings, 'SESSION_CACHE_ALIAS', 'default')
+    local = [
+        alias for alias in (CATALOG_CACHE, FRAGMENTS_CACHE, session_cache)
+        if alias in settings.CACHES and isinstance(caches[alias], LocMemCache)
+    ]
+    if not local:
+        return
+    message = 'Кэши {} хранятся в памяти процесса (locmem) и не видны другим воркерам'.format(', '.join(local))
+    if WORKERS > 1:
+        raise ImproperlyConfigured(
+            '{} ({} воркеров): задайте общий кэш через DJANGO_CACHE_BACKEND'.format(message, WORKERS)
+        )
+    logger.warning('%s: при нескольких воркерах нужен общий кэш (DJANGO_CACHE_BACKEND)', message)
+
+
+def _version_key(namespace):
+    return '{}:version:{}'.format(KEY_PREFIX, namespace)
+
+
+def _new_version():
+    return uuid.uuid4().hex[:12]
+
+
+def _add_version(cache, key, version):
+    """
+    Первая версия пространства. В файловом кэше add - это проверка и запись: первые читатели пустого кэша
+    записали бы каждый свою версию и собрали значение под разными ключами. Там файл версии создаётся
+    атомарно: пишем во временный файл и ставим его на место через os.link, который не перезаписывает файл
+    :return: True, если записана наша версия
+    """
+    if not isinstance(cache, FileBasedCache):
+        return cache.add(key, version, None)
+    cache._createdir()
+    cache._cull()
+    fd, tmp_path = tempfile.mkstemp(dir=cache._dir)
+    try:
+        with open(fd, 'wb') as f:
+            cache._write_content(f, None, version)
+        os.link(tmp_path, cache._key_to_file(key))
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+
+
+def get_versions(namespaces):
+    """ Текущие версии пространств ключей (меняются при изменении данных) - одним обращением к кэшу
+    """
+    cache = get_cache()
+    keys = [_version_key(namespace) for namespace in namespaces]
+    found = cache.get_many(keys)
+    versions = []
+    for key in keys:
+        version = found.get(key)
+        if version is None:
+            version = _new_version()
+            if not _add_version(cache, key, version):
+                version = cache.get(key, version)
+        versions.append(version)
+    return versions
+
+
+def get_version(namespace):
+    """ Текущая версия пространства ключей
+    """
+    return get_versions([namespace])[0]
+
+
+def bump_version(namespace):
+    """
+    Инвалидация всех ключей пространства (во всех кэшах магазина): старые версии просто перестают читаться.
+    Версия - случайная метка, а не счётчик: смена версии - одна запись без чтения, поэтому одновременные смены
+    не теряются (incr файлового кэша - это чтение и запись), а вытесненный из кэша ключ версии не вернёт
+    одну из старых версий
+    """
+    version = _new_version()
+    get_cache().set(_version_key(namespace), version, None)
+    return version
+
+
+def make_key(namespace, *parts):
+    """ Ключ значения: namespace - пространство ключей или список пространств, тогда значение действует,
+        пока не сменится версия ни одного из них (общее пространство товаров и пространство одного товара)
+    """
+    namespaces = [namespace] if isinstance(namespace, str) else list(namespace)
+    versioned = [
+        '{}:{}'.format(name, version) for name, version in zip(namespaces, get_versions(namespaces))
+    ]
+    return ':'.join([KEY_PREFIX] + versioned + [str(part) for part in parts])
+
+
+def _lock_path(cache, lock_key):
+    return cache._key_to_file(lock_key) + '.lock'
+
+
+def acquire_lock(cache, lock_key):
+    """
+    Берём блокировку перестройки ключа. В memcached, БД и locmem cache.add атомарен, а в файловом кэше это
+    проверка и запись - там блокировка создаётся файлом с O_EXCL (файлы .lock не трогает очистка кэша)
+    :return: True, если блокировка наша
+    """
+    if not isinstance(cache, FileBasedCache):
+        return cache.add(lock_key, 1, LOCK_TIMEOUT)
+    path = _lock_path(cache, lock_key)
+    for _ in range(2):
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+        except FileExistsError:
+            # Блокировку упавшего воркера снимаем по LOCK_TIMEOUT
+            try:
+                if time.time() - os.path.getmtime(path) < LOCK_TIMEOUT:
+                    return False
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return False
+
+
+def release_lock(cache, lock_key):
+    if not isinstance(cache, FileBasedCache):
+        cache.delete(lock_key)
+        return
+    try:
+        os.remove(_lock_path(cache, lock_key))
+    except FileNotFoundError:
+        pass
+
+
+def _build_and_store(cache, key, lock_key, build, timeout):
+    try:
+        value = build()
+        if timeout is None:
+            cache.set(key, CachedValue(value, None), None)
+        else:
+            cache.set(key, CachedValue(value, time.time() + timeout), timeout + STALE_GRACE)
+        return value
+    finally:
+        if lock_key:
+            release_lock(cache, lock_key)
+
+
+def _is_fresh(entry):
+    return entry.stale_at is None or entry.stale_at > time.time()
+
+
+def _build_locked(cache, key, lock_key, build, timeout):
+    """ Строим значение под взятой блокировкой. Между нашим чтением и блокировкой значение мог сохранить
+        и отпустить блокировку другой воркер - тогда отдаём его, не строя повторно
+    """
+    entry = cache.get(key)
+    if isinstance(entry, CachedValue) and _is_fresh(entry):
+        release_lock(cache, lock_key)
+        return entry.value
+    return _build_and_store(cache, key, lock_key, build, timeout)
+
+
+def get_or_build(namespace, parts, build, timeout=SOFT_TIMEOUT, alias=CATALOG_CACHE):
+    """
+    Читаем значение из кэша, при промахе строим и сохраняем. Перестраивает значение только один воркер
+    (блокировка acquire_lock): после мягкого срока остальные отдают устаревшее значение, а при пустом кэше
+    (сразу после выкладки или смены версии) ждут, пока его построят, вместо одновременных запросов к БД
+    :param namespace: Пространство ключей или список пространств (инвалидируются через bump_version)
+    :param parts: Части ключа внутри пространства
+    :param build: Функция без аргументов, строящая значение
+    :param timeout: Мягкий срок жизни в секундах (None - пока не сменится версия)
+    :param alias: Алиас кэша (CATALOG_CACHE или FRAGMENTS_CACHE)
+    """
+    cache = get_cache(alias)
+    key = make_key(namespace, *parts)
+    lock_key = key + ':lock'
+    entry = cache.get(key)
+    if isinstance(entry, CachedValue):
+        if _is_fresh(entry) or not acquire_lock(cache, lock_key):
+            record_cache(True)
+            return entry.value
+        record_cache(False)
+        return _build_locked(cache, key, lock_key, build, timeout)
+
+    record_cache(False)
+    if acquire_lock(cache, lock_key):
+        return _build_locked(cache, key, lock_key, build, timeout)
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if isinstance(entry, CachedValue):
+            return entry.value
+    # Воркер с блокировкой не успел (или упал) - строим сами
+    return _build_and_store(cache, key, None, build, timeout)
+
+
+# Кэшированные данные магазина
+
+CATEGORIES = 'categories'
+# Общее пространство товаров: списки (блок товаров главной), его смена сбрасывает и кэш отдельных товаров.
+# Сохранение одного товара меняет версию только его пространства и пространства его модели
+PRODUCTS = 'products'
+
+
+def product_namespace(model_name, slug):
+    """ Пространство ключей одного товара (страница и фрагменты товара по его адресу)
+    """
+    return 'product:{}:{}'.format(model_name, slug)
+
+
+def model_namespace(model_name):
+    """ Пространство ключей данных по всем товарам модели (фасеты)
+    """
+    return 'products:{}'.format(model_name)
+
+
+# Мягкий срок жизни кэша блока товаров главной страницы (None - до изменения товаров)
+MAIN_PAGE_TIMEOUT = getattr(settings, 'SHOP_MAIN_PAGE_TIMEOUT', SOFT_TIMEOUT)
+
+
+def get_categories():
+    """ Подкатегории для навигации (с родительской категорией, чтобы шаблоны не делали запросов)
+    """
+    from .models import Category
+
+    return get_or_build(
+        CATEGORIES, ['category'], lambda: list(Category.objects.select_related('category').order_by('name'))
+    )
+
+
+def get_parent_categories():
+    """ Родительские категории для навигации
+    """
+    from .models import ParentCategory
+
+    return get_or_build(CATEGORIES, ['parent_category'], lambda: list(ParentCategory.objects.order_by('name')))
+
+
+def get_main_page_products(*model_names, with_respect_to=None):
+    """ Последние товары для главной страницы. Сортировка with_respect_to выполняется по кэшированному списку
+    """
+    from .models import LatestProducts
+
+    products = get_or_build(
+        PRODUCTS,
+        ['main_page', ','.join(model_names)],
+        lambda: LatestProducts.objects.get_products_for_main_page(*model_names),
+        MAIN_PAGE_TIMEOUT,
+    )
+    return LatestProducts.objects.sort_with_respect_to(products, model_names, with_respect_to)
+
+
+def get_main_page_products_html(*model_names, with_respect_to=None):
+    """ Готовый HTML блока товаров главной страницы
+    """
+    return get_or_build(
+        PRODUCTS,
+        ['main_page_html', ','.join(model_names), with_respect_to or ''],
+        lambda: render_to_string(
+            'shop/main_products.html',
+            {'products': get_main_page_products(*model_names, with_respect_to=with_respect_to)}
+        ),
+        MAIN_PAGE_TIMEOUT,
+        alias=FRAGMENTS_CACHE,
+    )
+
+
+def get_product(model, slug, build):
+    """ Товар для страницы товара, до изменения этого товара
+    """
+    return get_or_build([PRODUCTS, product_namespace(model._meta.model_name, slug)], ['product'], build)
+
+
+def get_fragment(parts, build, timeout=SOFT_TIMEOUT, product=None):
+    """ Готовый фрагмент HTML страниц товаров (тег cached_fragment), до изменения товаров
+        (фрагмент одного товара product - до изменения этого товара)
+    """
+    namespace = PRODUCTS
+    if product is not None:
+        namespace = [PRODUCTS, product_namespace(product._meta.model_name, product.slug)]
+    return get_or_build(namespace, ['fragment', *parts], build, timeout, alias=FRAGMENTS_CACHE)
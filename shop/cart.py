@@ -0,0 +1,316 @@
+import json
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+
+from .instrumentation import record_cache
+from .inventory import RESERVATION_MINUTES, reserve_stock, set_reserved_stock, release_stock
+from .models import Cart, Customer
+from .utils import (
+    get_cart_lines, attach_cart_products, get_product_content_key,
+    add_cart_product, change_cart_product_qty, merge_cart_products, remove_cart_product, write_atomic,
+)
+
+
+# Ключ сессии, в котором храним идентификаторы и итоги корзины
+CART_SESSION_KEY = 'shop_cart'
+
+# Сколько секунд итоги корзины из сессии считаются актуальными (для значка корзины в шапке)
+CART_STATE_TTL = getattr(settings, 'SHOP_CART_STATE_TTL', 60)
+
+# Подписанная cookie с корзиной анонимного покупателя
+GUEST_CART_COOKIE = 'shop_guest_cart'
+GUEST_CART_SALT = 'shop.guest_cart'
+GUEST_CART_MAX_AGE = getattr(settings, 'SHOP_GUEST_CART_MAX_AGE', 60 * 60 * 24 * 30)
+GUEST_CART_MAX_LINES = getattr(settings, 'SHOP_GUEST_CART_MAX_LINES', 50)
+
+
+class GuestCartFull(Exception):
+    """ В корзине анонимного покупателя уже GUEST_CART_MAX_LINES разных товаров (больше не помещается в cookie)
+    """
+
+    def get_message(self):
+        return 'В корзине уже {} разных товаров - войдите на сайт, чтобы добавить больше'.format(
+            GUEST_CART_MAX_LINES
+        )
+
+
+
+class GuestCartLine:
+    """ Строка корзины анонимного покупателя (повторяет интерфейс CartProduct для шаблонов)
+    """
+
+    def __init__(self, content_type_id, object_id, qty, price):
+        self.content_type_id = content_type_id
+        self.object_id = object_id
+        self.qty = qty
+        self.price = price
+        self.product = None
+
+    @property
+    def final_price(self):
+        return self.qty * self.price
+
+
+
+class GuestCart:
+    """ Корзина анонимного покупателя. Хранится в подписанной cookie, в БД не пишется,
+        пока покупатель не войдёт на сайт (тогда переносится в его корзину)
+    """
+    pk = None
+    owner_id = None
+    in_order = False
+    for_anonymous_user = True
+
+    def __init__(self, data=None):
+        self.lines = {}
+        for content_type_id, object_id, qty, price in data or []:
+            self.lines[(content_type_id, object_id)] = GuestCartLine(content_type_id, object_id, qty, Decimal(price))
+        self.modified = False
+
+    def __str__(self):
+        return 'guest'
+
+    @property
+    def total_product(self):
+        return len(self.lines)
+
+    @property
+    def final_price(self):
+        return sum((line.final_price for line in self.lines.values()), Decimal(0))
+
+    def add(self, product, qty=1):
+        """
+        Добавляем товар в корзину
+        :raise GuestCartFull: новый товар, а в корзине уже GUEST_CART_MAX_LINES строк
+        """
+        key = get_product_content_key(product)
+        if key in self.lines:
+            self.lines[key].qty += qty
+        elif len(self.lines) < GUEST_CART_MAX_LINES:
+            self.lines[key] = GuestCartLine(*key, qty, product.price)
+        else:
+            raise GuestCartFull()
+        self.modified = True
+
+    def change_qty(self, product, qty):
+        key = get_product_content_key(product)
+        if key in self.lines:
+            self.lines[key].qty = qty
+            self.modified = True
+
+    def remove(self, product):
+        if self.lines.pop(get_product_content_key(product), None) is not None:
+            self.modified = True
+
+    def get_lines(self):
+        return attach_cart_products(list(self.lines.values()))
+
+    def dumps(self):
+        return json.dumps(
+            [[line.content_type_id, line.object_id, line.qty, str(line.price)] for line in self.lines.values()],
+            separators=(',', ':')
+        )
+
+
+
+class CartService:
+    """ Определение покупателя и корзины текущего запроса.
+        Для пользователя идентификаторы покупателя и корзины хранятся в сессии, сама корзина загружается
+        лениво - только когда представление или шаблон к ней обращается. Корзина анонимного покупателя
+        живёт в подписанной cookie и переносится в БД при входе на сайт
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.user = request.user
+        self._cart = None
+        self._guest_cart = None
+        self._drop_guest_cookie = False
+
+    def _get_state(self):
+        state = self.request.session.get(CART_SESSION_KEY)
+        if not state or state.get('user_id') != self.user.pk:
+            return {}
+        return state
+
+    def _load_guest_cart(self):
+        if self._guest_cart is None:
+            raw = self.request.get_signed_cookie(
+                GUEST_CART_COOKIE, default=None, salt=GUEST_CART_SALT, max_age=GUEST_CART_MAX_AGE
+            )
+            try:
+                data = json.loads(raw) if raw else []
+            except ValueError:
+                data = []
+            self._guest_cart = GuestCart(data)
+        return self._guest_cart
+
+    @property
+    def is_guest(self):
+        return not self.user.is_authenticated
+
+    @property
+    def customer_id(self):
+        if self.is_guest:
+            return None
+        state = self._get_state()
+        if state.get('customer_id'):
+            return state['customer_id']
+        return self.get_cart().owner_id
+
+    def get_customer(self):
+        """ Покупатель текущего пользователя (создаётся при первом обращении)
+        """
+        customer, _ = Customer.objects.get_or_create(user=self.user)
+        return customer
+
+    def get_cart(self):
+        """ Корзина текущего запроса: для гостя - из cookie, для пользователя - один запрос по id из сессии,
+            иначе get_or_create
+        """
+        if self.is_guest:
+            return self._load_guest_cart()
+        if self._cart is not None:
+            return self._cart
+
+        cart_id = self._get_state().get('cart_id')
+        if cart_id:
+            self._cart = Cart.objects.filter(pk=cart_id, in_order=False).first()
+
+        if self._cart is None:
+            record_cache(False)
+            # Корзина пользователя - одним запросом через покупателя, покупатель и корзина создаются, только если их нет
+            self._cart = Cart.objects.filter(owner__user=self.user, in_order=False).order_by('pk').first()
+            if self._cart is None:
+                self._cart, _ = Cart.objects.get_or_create(owner=self.get_customer(), in_order=False)
+            self.remember(self._cart)
+        return self._cart
+
+    def get_lazy_cart(self):
+        return SimpleLazyObject(self.get_cart)
+
+    def get_lines(self):
+        """ Строки корзины с подгруженными товарами
+        """
+        if self.is_guest:
+            return self._load_guest_cart().get_lines()
+        return get_cart_lines(self.get_cart())
+
+    @property
+    def total_product(self):
+        """ Колличество товаров в корзине для шапки сайта без обращения к БД, пока данные в сессии свежие
+        """
+        if self.is_guest:
+            return self._load_guest_cart().total_product
+        state = self._get_state()
+        if state and time.time() - state.get('ts', 0) < CART_STATE_TTL:
+            return state['total_product']
+        # Итоги в сессии - тот же кэш: устаревшие перечитываются из корзины (холодный запрос)
+        record_cache(False)
+        return self.remember(self.get_cart())['total_product']
+
+    def get_line(self, product):
+        """ Строка корзины с товаром (None, если товара в корзине нет)
+        """
+        key = get_product_content_key(product)
+        if self.is_guest:
+            return self._load_guest_cart().lines.get(key)
+        content_type_id, object_id = key
+        return self.get_cart().related_products.filter(
+            content_type_id=content_type_id, object_id=object_id
+        ).first()
+
+    def add_product(self, product, qty=1):
+        if self.is_guest:
+            self._load_guest_cart().add(product, qty)
+            return
+        with write_atomic():
+            if RESERVATION_MINUTES:
+                reserve_stock(self.get_cart(), product, qty)
+            add_cart_product(self.get_cart(), product, qty)
+        self.remember(self.get_cart())
+
+    def change_qty(self, product, qty):
+        if self.is_guest:
+            self._load_guest_cart().change_qty(product, qty)
+            return
+        with write_atomic():
+            # Резерв меняется только для товара, который есть в корзине: иначе его некому было бы снять
+            if change_cart_product_qty(self.get_cart(), product, qty) and RESERVATION_MINUTES:
+                set_reserved_stock(self.get_cart(), product, qty)
+        self.remember(self.get_cart())
+
+    def remove_product(self, product):
+        if self.is_guest:
+            self._load_guest_cart().remove(product)
+            return
+        with write_atomic():
+            if RESERVATION_MINUTES:
+                release_stock(self.get_cart(), product)
+            remove_cart_product(self.get_cart(), product)
+        self.remember(self.get_cart())
+
+    def merge_guest_cart(self):
+        """ Переносим корзину из cookie в корзину вошедшего пользователя
+        """
+        if self.is_guest or GUEST_CART_COOKIE not in self.request.COOKIES:
+            return
+        self._drop_guest_cookie = True
+        guest_cart = self._load_guest_cart()
+        if not guest_cart.lines:
+            # Пустая или испорченная cookie: корзину пользователя не трогаем и сессию не перезаписываем
+            return
+        merge_cart_products(self.get_cart(), [
+            (line.product, line.qty) for line in guest_cart.get_lines() if line.product is not None
+        ])
+        self.remember(self.get_cart())
+
+    def remember(self, cart):
+        """ Запоминаем идентификаторы и итоги корзины в сессии. Если в сессии те же и ещё свежие данные
+            (изменилось колличество уже лежащего в корзине товара), сессия не перезаписывается -
+            это лишняя транзакция с UPDATE сессии в БД
+        """
+        state = {
+            'user_id': self.user.pk,
+            'customer_id': cart.owner_id,
+            'cart_id': cart.pk,
+            'total_product': cart.total_product,
+            'ts': time.time(),
+        }
+        current = self._get_state()
+        if current and state['ts'] - current.get('ts', 0) < CART_STATE_TTL and all(
+                current.get(key) == value for key, value in state.items() if key != 'ts'):
+            return current
+        self.request.session[CART_SESSION_KEY] = state
+        return state
+
+    def forget(self):
+        self.request.session.pop(CART_SESSION_KEY, None)
+        self._cart = None
+
+    def save(self, response):
+        """ Записываем изменения гостевой корзины в cookie ответа
+        """
+        if self._drop_guest_cookie:
+            response.delete_cookie(GUEST_CART_COOKIE)
+        elif self._guest_cart is not None and self._guest_cart.modified:
+            response.set_signed_cookie(
+                GUEST_CART_COOKIE,
+                self._guest_cart.dumps(),
+                salt=GUEST_CART_SALT,
+                max_age=GUEST_CART_MAX_AGE,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
+
+
+def get_cart_service(request):
+    """ Сервис корзины, один на запрос
+    """
+    if not hasattr(request, '_cart_service'):
+        request._cart_service = CartService(request)
+    return request._cart_service
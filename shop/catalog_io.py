@@ -0,0 +1,279 @@
+import csv
+import json
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.utils import timezone
+
+from .cache import bump_version, PRODUCTS
+from .models import CatalogProduct, Category
+from .search import index_products
+from .utils import bulk_update_rows, write_atomic
+
+
+# Размер пачки для bulk_create/bulk_update при импорте и для чтения при экспорте
+BATCH_SIZE = getattr(settings, 'SHOP_CATALOG_IO_BATCH_SIZE', 1000)
+
+# Сколько ошибок в строках файла запоминаем для отчёта
+MAX_REPORTED_ERRORS = 50
+
+FORMATS = ('csv', 'jsonl')
+
+# Поля, которые не импортируются и не экспортируются: первичный ключ и даты, которые ставит сама модель
+SKIPPED_FIELDS = ('id', 'created', 'updated')
+
+TRUE_VALUES = ('1', 'true', 't', 'yes', 'y', 'да')
+
+
+def detect_format(path, fmt=None):
+    """ Формат файла: явно указанный или по расширению (.csv, .jsonl/.ndjson)
+    """
+    if fmt:
+        return fmt
+    if path.endswith('.csv'):
+        return 'csv'
+    if path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    raise ValueError('Не удалось определить формат файла {}, укажите --format'.format(path))
+
+
+def get_fields(model):
+    """ Импортируемые/экспортируемые поля модели товаров: код товара первым, подкатегория - по адресу (slug)
+    """
+    fields = [
+        field for field in model._meta.concrete_fields
+        if field.name not in SKIPPED_FIELDS and field.name != 'product_key'
+    ]
+    return [model._meta.get_field('product_key')] + fields
+
+
+def read_rows(stream, fmt):
+    """
+    Построчное чтение файла, в памяти одна строка
+    :return: Генератор пар (номер строки, словарь колонка -> значение); None вместо словаря - строка не разобрана
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_num, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_num, row if isinstance(row, dict) else None
+
+
+class CatalogImporter:
+    """ Импорт товаров одной модели пачками. Строки сопоставляются с товарами по коду (product_key):
+        существующие обновляются (только колонки из файла) через bulk_update_rows, новые создаются через bulk_create.
+        Сводный каталог, поисковый индекс и кэш обновляются здесь же, т.к. массовые операции не вызывают сигналов
+    """
+
+    def __init__(self, model, batch_size=BATCH_SIZE, create=True, on_batch=None, dry_run=False):
+        self.model = model
+        self.batch_size = batch_size
+        self.create = create
+        self.dry_run = dry_run
+        self.on_batch = on_batch
+        self.fields = {field.name: field for field in get_fields(model)}
+        self.categories = dict(Category.objects.values_list('slug', 'pk')) if 'category' in self.fields else {}
+        self.search_fields = {'name', 'description', 'product_key'} | {
+            field.name for field in self.fields.values() if isinstance(field, models.CharField)
+        }
+        self.rows = self.created = self.updated = self.skipped = 0
+        self.errors = []
+        self.started = None
+
+    @property
+    def rate(self):
+        elapsed = time.perf_counter() - self.started if self.started else 0
+        return self.rows / elapsed if elapsed else 0
+
+    def add_error(self, line_num, message):
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line_num, message))
+
+    def clean_value(self, field, raw):
+        # Список или объект из JSON CharField превратил бы в строку "['...']" - такие значения не принимаем
+        if isinstance(raw, (list, dict)):
+            raise ValidationError('ожидается одно значение')
+        if field.name == 'category':
+            if raw not in self.categories:
+                raise ValidationError('неизвестная подкатегория "{}"'.format(raw))
+            return self.categories[raw]
+        if isinstance(raw, str):
+            raw = raw.strip()
+            if isinstance(field, models.BooleanField):
+                raw = raw.lower() in TRUE_VALUES
+            elif raw == '' and (field.null or field.blank):
+                raw = None if field.null else ''
+        return field.clean(raw, None)
+
+    def clean_row(self, row):
+        """ Значения строки по attname полей модели (неизвестные колонки пропускаются)
+        """
+        if not row.get('product_key'):
+            raise ValidationError('нет кода товара (product_key)')
+        values = {}
+        for name, raw in row.items():
+            field = self.fields.get(name)
+            if field is None:
+                continue
+            try:
+                values[field.attname] = self.clean_value(field, raw)
+            except ValidationError as error:
+                raise ValidationError('{}: {}'.format(name, '; '.join(error.messages)))
+            except (TypeError, ValueError) as error:
+                # Значение неожиданного типа (например, число вместо строки в JSON) - ошибка строки, а не импорта
+                raise ValidationError('{}: недопустимое значение ({})'.format(name, error))
+        return values
+
+    def run(self, rows):
+        """
+        Импорт строк из генератора read_rows. При dry_run весь импорт выполняется в одной транзакции,
+        которая откатывается: счётчики и ошибки те же, что при настоящем импорте, но в БД ничего не остаётся
+        :return: self (счётчики created, updated, skipped, errors)
+        """
+        if not self.dry_run:
+            self._run(rows)
+            bump_version(PRODUCTS)
+            return self
+        with write_atomic():
+            self._run(rows)
+            transaction.set_rollback(True)
+        return self
+
+    def _run(self, rows):
+        self.started = time.perf_counter()
+        batch = {}
+        for line_num, row in rows:
+            self.rows += 1
+            if row is None:
+                self.add_error(line_num, 'строка не разобрана')
+                continue
+            try:
+                values = self.clean_row(row)
+            except ValidationError as error:
+                self.add_error(line_num, '; '.join(error.messages))
+                continue
+            # Повтор кода товара в одной пачке: побеждает последняя строка
+            batch[values['product_key']] = (line_num, values)
+            if len(batch) >= self.batch_size:
+                self.flush(batch)
+                batch = {}
+        if batch:
+            self.flush(batch)
+
+    def flush(self, batch):
+        existing = dict(
+            self.model._base_manager.filter(product_key__in=batch).values_list('product_key', 'pk')
+        )
+        to_create, to_update = [], {}
+        now = timezone.now()
+        for product_key, (line_num, values) in batch.items():
+            if product_key in existing:
+                product = self.model(pk=existing[product_key], updated=now, **values)
+                to_update.setdefault(tuple(sorted(values)), []).append(product)
+            elif self.create:
+                product = self.model(**values)
+                try:
+                    product.full_clean(exclude=['category'], validate_unique=False)
+                except ValidationError as error:
+                    self.add_error(line_num, '; '.join(error.messages))
+                    continue
+                to_create.append((line_num, product))
+            else:
+                self.add_error(line_num, 'товар с кодом {} не найден'.format(product_key))
+        to_create = self.check_slugs(to_create)
+
+        reindex_keys = []
+        with write_atomic():
+            for attnames, products in to_update.items():
+                bulk_update_rows(products, [*attnames, 'updated'])
+                self.updated += len(products)
+                CatalogProduct.objects.refresh_from_products(
+                    self.model, [product.pk for product in products], [*attnames, 'updated']
+                )
+                # Код товара - ключ сопоставления и у существующих товаров не меняется
+                if self.search_fields.intersection(
+                        self.model._meta.get_field(attname).name for attname in attnames if attname != 'product_key'):
+                    reindex_keys.extend(product.product_key for product in products)
+
+            self.model._base_manager.bulk_create([product for _, product in to_create], batch_size=self.batch_size)
+            self.created += len(to_create)
+            created_keys = [product.product_key for _, product in to_create]
+            if created_keys:
+                created = list(self.model._base_manager.filter(product_key__in=created_keys))
+                CatalogProduct.objects.sync_many(self.model, created, batch_size=self.batch_size)
+                index_products(self.model, created)
+            if reindex_keys:
+                index_products(self.model, self.model._base_manager.filter(product_key__in=reindex_keys))
+        if self.on_batch:
+            self.on_batch(self)
+
+    def check_slugs(self, to_create):
+        """ Новые товары с уже занятым адресом (slug) пропускаем, иначе упадёт вся пачка
+        """
+        if not to_create:
+            return to_create
+        taken = set(self.model._base_manager.filter(
+            slug__in=[product.slug for _, product in to_create]
+        ).values_list('slug', flat=True))
+        checked = []
+        for line_num, product in to_create:
+            if product.slug in taken:
+                self.add_error(line_num, 'адрес (slug) "{}" уже занят'.format(product.slug))
+                continue
+            taken.add(product.slug)
+            checked.append((line_num, product))
+        return checked
+
+
+
+def export_rows(model, batch_size=BATCH_SIZE):
+    """
+    Товары модели для выгрузки: values_list по курсору, без создания объектов моделей
+    :return: (названия колонок, генератор кортежей значений)
+    """
+    fields = get_fields(model)
+    columns = [field.name for field in fields]
+    lookups = ['category__slug' if field.name == 'category' else field.attname for field in fields]
+    rows = model._base_manager.order_by('pk').values_list(*lookups).iterator(chunk_size=batch_size)
+    return columns, rows
+
+
+def _export_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def write_rows(stream, fmt, columns, rows):
+    """
+    Запись строк в файл по одной
+    :return: Колличество записанных строк
+    """
+    total = 0
+    if fmt == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            total += 1
+        return total
+    for row in rows:
+        stream.write(json.dumps(
+            dict(zip(columns, (_export_value(value) for value in row))), ensure_ascii=False
+        ))
+        stream.write('\n')
+        total += 1
+    return total
@@ -0,0 +1,20 @@
+from django.utils.functional import SimpleLazyObject
+
+from .cache import get_categories, get_parent_categories
+from .cart import get_cart_service
+
+
+def cart(request):
+    """ Колличество товаров в корзине для шапки сайта (вычисляется только при выводе)
+    """
+    service = get_cart_service(request)
+    return {'cart_total_product': SimpleLazyObject(lambda: service.total_product)}
+
+
+def categories(request):
+    """ Дерево категорий для навигации из кэша (в том числе на страницах allauth)
+    """
+    return {
+        'category': SimpleLazyObject(get_categories),
+        'parent_category': SimpleLazyObject(get_parent_categories),
+    }
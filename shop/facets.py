@@ -0,0 +1,162 @@
+import hashlib
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+
+from .cache import get_or_build, model_namespace, PRODUCTS
+
+
+# Поля, по которым фильтруем диапазоном значений
+RANGE_FIELDS = ('price', 'weight', 'long')
+
+# Общие поля товара, которые не являются фасетами
+EXCLUDED_FIELDS = ('name', 'slug', 'available')
+
+TRUE_VALUES = ('1', 'on', 'true')
+
+
+def get_model_facets(model):
+    """
+    Фасеты модели по метаданным полей: индексированные строковые поля - значения на выбор,
+    логические поля - флаги, числовые поля из RANGE_FIELDS - диапазоны
+    :return: (choices, flags, ranges) - списки полей модели
+    """
+    choices, flags, ranges = [], [], []
+    for field in model._meta.concrete_fields:
+        if field.name in EXCLUDED_FIELDS:
+            continue
+        if isinstance(field, models.CharField) and field.db_index:
+            choices.append(field)
+        elif isinstance(field, models.BooleanField):
+            flags.append(field)
+    for name in RANGE_FIELDS:
+        try:
+            ranges.append(model._meta.get_field(name))
+        except FieldDoesNotExist:
+            pass
+    return choices, flags, ranges
+
+
+class FacetFilter:
+    """ Фильтр товаров категории по фасетам из GET-параметров и подсчёт товаров по каждому фасету.
+        Подсчёт - один сгруппированный запрос на фасет значений с учётом всех остальных фильтров
+        и один общий запрос для флагов и диапазонов
+    """
+
+    def __init__(self, model, params):
+        self.model = model
+        self.choices, self.flags, self.ranges = get_model_facets(model)
+        self.selected = {}
+        for field in self.choices:
+            values = [value for value in params.getlist(field.name) if value]
+            if values:
+                self.selected[field.name] = values
+        for field in self.flags:
+            if params.get(field.name, '').lower() in TRUE_VALUES:
+                self.selected[field.name] = True
+        self.bounds = {}
+        for field in self.ranges:
+            for suffix, lookup in (('min', 'gte'), ('max', 'lte')):
+                value = self._parse_number(params.get('{}_{}'.format(field.name, suffix)))
+                if value is not None:
+                    self.bounds[(field.name, suffix)] = (lookup, value)
+
+    @staticmethod
+    def _parse_number(value):
+        if not value:
+            return None
+        try:
+            number = Decimal(value.replace(',', '.'))
+        except InvalidOperation:
+            return None
+        # Infinity и NaN Decimal принимает, но ни фильтровать по ним, ни вывести их в шаблоне нельзя
+        return number if number.is_finite() else None
+
+    @property
+    def is_active(self):
+        return bool(self.selected or self.bounds)
+
+    def get_conditions(self, exclude=()):
+        """ Условия всех выбранных фильтров, кроме фасетов из exclude
+        """
+        conditions = models.Q()
+        for name, value in self.selected.items():
+            if name in exclude:
+                continue
+            if value is True:
+                conditions &= models.Q(**{name: True})
+            else:
+                conditions &= models.Q(**{'{}__in'.format(name): value})
+        for (name, _), (lookup, value) in self.bounds.items():
+            if name not in exclude:
+                conditions &= models.Q(**{'{}__{}'.format(name, lookup): value})
+        return conditions
+
+    def filter(self, queryset):
+        return queryset.filter(self.get_conditions())
+
+    def _cache_parts(self):
+        selected = sorted(
+            (name, value if value is True else tuple(sorted(value))) for name, value in self.selected.items()
+        )
+        bounds = sorted((name, suffix, str(value)) for (name, suffix), (_, value) in self.bounds.items())
+        digest = hashlib.md5(repr((selected, bounds)).encode()).hexdigest()
+        return [self.model._meta.model_name, 'facets', digest]
+
+    def get_facets(self, queryset):
+        """ Фасеты с колличеством товаров; результат кэшируется до изменения товаров этой модели
+        """
+        namespaces = [PRODUCTS, model_namespace(self.model._meta.model_name)]
+        return get_or_build(namespaces, self._cache_parts(), lambda: self._count_facets(queryset))
+
+    def _count_facets(self, queryset):
+        choices = []
+        for field in self.choices:
+            rows = (
+                queryset.filter(self.get_conditions(exclude=[field.name]))
+                .values_list(field.name)
+                .annotate(count=models.Count('pk'))
+                .order_by(field.name)
+            )
+            selected = self.selected.get(field.name, [])
+            choices.append({
+                'name': field.name,
+                'label': field.verbose_name,
+                'options': [
+                    {'value': value, 'count': count, 'selected': value in selected} for value, count in rows
+                ],
+            })
+
+        # Флаги и границы диапазонов - одним агрегирующим запросом: у каждого агрегата свои условия (FILTER)
+        aggregates = {}
+        for field in self.flags:
+            conditions = self.get_conditions(exclude=[field.name]) & models.Q(**{field.name: True})
+            aggregates['{}_count'.format(field.name)] = models.Count('pk', filter=conditions)
+        if self.ranges:
+            range_conditions = self.get_conditions(exclude=[field.name for field in self.ranges])
+            for field in self.ranges:
+                aggregates['{}_min'.format(field.name)] = models.Min(field.name, filter=range_conditions)
+                aggregates['{}_max'.format(field.name)] = models.Max(field.name, filter=range_conditions)
+        limits = queryset.aggregate(**aggregates) if aggregates else {}
+
+        flags = []
+        for field in self.flags:
+            flags.append({
+                'name': field.name,
+                'label': field.verbose_name,
+                'count': limits['{}_count'.format(field.name)],
+                'selected': self.selected.get(field.name, False),
+            })
+
+        ranges = []
+        for field in self.ranges:
+            ranges.append({
+                'name': field.name,
+                'label': field.verbose_name,
+                'min': limits['{}_min'.format(field.name)],
+                'max': limits['{}_max'.format(field.name)],
+                'value_min': self.bounds.get((field.name, 'min'), (None, ''))[1],
+                'value_max': self.bounds.get((field.name, 'max'), (None, ''))[1],
+            })
+        return {'choices': choices, 'flags': flags, 'ranges': ranges}
@@ -1,4 +1,5 @@
 from django import forms
+from .bulk import PRICE_AMOUNT, PRICE_PERCENT, STOCK_DELTA, STOCK_SET
 from .models import Order
 
 
@@ -21,4 +22,57 @@ class OrderForm(forms.ModelForm):
         model = Order
         fields = (
             'first_name', 'last_name', 'phone', 'address', 'buying_type', 'order_date', 'comment'
-        )
\ No newline at end of file
+        )
+
+
+class ProductBulkEditForm(forms.Form):
+    """ Массовое изменение цен, остатков и доступности выбранных в админке товаров
+    """
+    PRICE_CHOICES = (
+        ('', 'Не менять'),
+        (PRICE_PERCENT, 'Изменить на процент'),
+        (PRICE_AMOUNT, 'Изменить на сумму'),
+    )
+    STOCK_CHOICES = (
+        ('', 'Не менять'),
+        (STOCK_DELTA, 'Прибавить (отрицательное - убавить)'),
+        (STOCK_SET, 'Установить'),
+    )
+    AVAILABLE_CHOICES = (
+        ('', 'Не менять'),
+        ('1', 'Доступно'),
+        ('0', 'Недоступно'),
+    )
+
+    price_change = forms.ChoiceField(label='Цена', choices=PRICE_CHOICES, required=False)
+    price_value = forms.DecimalField(
+        label='Процент или сумма', max_digits=10, decimal_places=2, required=False,
+        help_text='Например 10 - поднять на 10% (или на 10 руб), -15 - снизить'
+    )
+    stock_change = forms.ChoiceField(label='Остаток', choices=STOCK_CHOICES, required=False)
+    stock_value = forms.IntegerField(label='Колличество', required=False)
+    available = forms.ChoiceField(label='Доступность', choices=AVAILABLE_CHOICES, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('price_change') and cleaned_data.get('price_value') is None:
+            self.add_error('price_value', 'Укажите процент или сумму')
+        if cleaned_data.get('price_change') == PRICE_PERCENT and (cleaned_data.get('price_value') or 0) <= -100:
+            self.add_error('price_value', 'Цену нельзя снизить на 100% и больше')
+        if cleaned_data.get('stock_change') and cleaned_data.get('stock_value') is None:
+            self.add_error('stock_value', 'Укажите колличество')
+        if cleaned_data.get('stock_change') == STOCK_SET and (cleaned_data.get('stock_value') or 0) < 0:
+            self.add_error('stock_value', 'Остаток не может быть отрицательным')
+        return cleaned_data
+
+    def get_changes(self):
+        """ Аргументы для bulk_edit_products
+        """
+        available = self.cleaned_data['available']
+        return dict(
+            price_change=self.cleaned_data['price_change'] or None,
+            price_value=self.cleaned_data['price_value'],
+            stock_change=self.cleaned_data['stock_change'] or None,
+            stock_value=self.cleaned_data['stock_value'],
+            available=None if available == '' else available == '1',
+        )
@@ -0,0 +1,299 @@
+import atexit
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+logger = logging.getLogger(__name__)
+
+# Сбор статистики запросов (число и время SQL, дубли, отрисовка шаблонов, кэш) и заголовок Server-Timing.
+# По умолчанию включен только в режиме отладки
+ENABLED = getattr(settings, 'SHOP_INSTRUMENTATION', settings.DEBUG)
+
+# Отдавать ли статистику запроса в заголовке Server-Timing (видна в DevTools браузера)
+SERVER_TIMING = getattr(settings, 'SHOP_INSTRUMENTATION_SERVER_TIMING', True)
+
+# Раз в сколько секунд процесс сбрасывает накопленную статистику в кэш магазина (её читает команда shop_stats)
+FLUSH_INTERVAL = getattr(settings, 'SHOP_INSTRUMENTATION_FLUSH_INTERVAL', 10)
+
+# Сколько последних длительностей запроса храним на адрес для перцентилей
+SAMPLES = getattr(settings, 'SHOP_INSTRUMENTATION_SAMPLES', 500)
+
+STATS_KEY = 'shop:instrumentation:{}'
+PROCESSES_KEY = 'shop:instrumentation:processes'
+
+_current = contextvars.ContextVar('shop_request_stats', default=None)
+
+
+class RequestStats:
+    """ Статистика одного запроса
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.statements = Counter()
+        self.render_depth = 0
+        # Асинхронные представления выполняют запросы параллельно в нескольких потоках
+        self.lock = threading.Lock()
+
+    @property
+    def duplicates(self):
+        """ Сколько запросов повторили уже выполненный (тот же SQL с теми же параметрами)
+        """
+        return sum(count - 1 for count in self.statements.values() if count > 1)
+
+    @property
+    def total_time(self):
+        return time.perf_counter() - self.started
+
+    def get_duplicate_statements(self):
+        return [(sql, count) for (sql, _), count in self.statements.most_common() if count > 1]
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        """ Обёртка выполнения SQL для connection.execute_wrapper
+        """
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self.lock:
+                self.sql_time += time.perf_counter() - started
+                self.queries += 1
+                self.statements[(sql, repr(params))] += 1
+
+    def get_server_timing(self):
+        """ Значение заголовка Server-Timing (длительности в миллисекундах)
+        """
+        return ', '.join([
+            'sql;dur={:.1f};desc="{} queries"'.format(self.sql_time * 1000, self.queries),
+            'dup;desc="{} duplicate queries"'.format(self.duplicates),
+            'render;dur={:.1f}'.format(self.render_time * 1000),
+            'cache;desc="{} hits, {} misses"'.format(self.cache_hits, self.cache_misses),
+            'total;dur={:.1f}'.format(self.total_time * 1000),
+        ])
+
+
+def get_current_stats():
+    """ Статистика текущего запроса (None вне запроса или если сбор выключен)
+    """
+    return _current.get()
+
+
+def start_request():
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def finish_request(token):
+    _current.reset(token)
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    return stats.execute_wrapper(execute, sql, params, many, context)
+
+
+def instrument_connection(connection, **kwargs):
+    """ Учёт SQL-запросов подключения в статистике текущего запроса. Статистика берётся из контекста,
+        поэтому учитываются и запросы из потоков sync_to_async (в них копируется контекст запроса)
+    """
+    if _execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute_wrapper)
+
+
+def instrument_connections():
+    """ Подключаем учёт запросов ко всем подключениям: открытым в этом потоке и новым (в любом потоке)
+    """
+    connection_created.connect(instrument_connection, dispatch_uid='shop_instrumentation')
+    for connection in connections.all():
+        instrument_connection(connection)
+
+
+def record_cache(hit):
+    """ Учитываем обращение к кэшу магазина в статистике текущего запроса
+    """
+    stats = _current.get()
+    if stats is None:
+        return
+    if hit:
+        stats.cache_hits += 1
+    else:
+        stats.cache_misses += 1
+
+
+def instrument_templates():
+    """
+    Замеряем время отрисовки шаблонов: оборачиваем Template.render бэкенда Django (через него идут render,
+    render_to_string и TemplateResponse; вложенные include его не вызывают). Учитывается только внешний вызов
+    """
+    from django.template.backends.django import Template
+
+    if getattr(Template.render, 'instrumented', False):
+        return
+    original = Template.render
+
+    def render(self, context=None, request=None):
+        stats = _current.get()
+        if stats is None:
+            return original(self, context, request)
+        stats.render_depth += 1
+        started = time.perf_counter()
+        try:
+            return original(self, context, request)
+        finally:
+            stats.render_depth -= 1
+            if not stats.render_depth:
+                stats.render_time += time.perf_counter() - started
+
+    render.instrumented = True
+    Template.render = render
+
+
+class StatsAggregator:
+    """ Накопленная статистика процесса по именам адресов. Периодически сбрасывается в кэш магазина,
+        откуда команда shop_stats собирает её по всем процессам
+    """
+
+    FIELDS = ('requests', 'queries', 'max_queries', 'sql_ms', 'duplicates', 'render_ms', 'cache_hits',
+              'cache_misses', 'over_budget')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+        # Первый запрос процесса сразу регистрирует его в кэше
+        self.flushed = None
+
+    def add(self, url_name, stats, over_budget=False):
+        with self.lock:
+            entry = self.data.get(url_name)
+            if entry is None:
+                entry = self.data[url_name] = dict.fromkeys(self.FIELDS, 0)
+                entry['durations'] = deque(maxlen=SAMPLES)
+            entry['requests'] += 1
+            entry['queries'] += stats.queries
+            entry['max_queries'] = max(entry['max_queries'], stats.queries)
+            entry['sql_ms'] += stats.sql_time * 1000
+            entry['duplicates'] += stats.duplicates
+            entry['render_ms'] += stats.render_time * 1000
+            entry['cache_hits'] += stats.cache_hits
+            entry['cache_misses'] += stats.cache_misses
+            entry['over_budget'] += int(over_budget)
+            entry['durations'].append(round(stats.total_time * 1000, 2))
+        if self.flushed is None or time.monotonic() - self.flushed >= FLUSH_INTERVAL:
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                url_name: dict(entry, durations=list(entry['durations']))
+                for url_name, entry in self.data.items()
+            }
+
+    def flush(self):
+        from .cache import get_cache
+
+        self.flushed = time.monotonic()
+        cache = get_cache()
+        key = STATS_KEY.format(os.getpid())
+        cache.set(key, self.snapshot(), None)
+        processes = cache.get(PROCESSES_KEY) or set()
+        if key not in processes:
+            cache.set(PROCESSES_KEY, processes | {key}, None)
+
+    def reset(self):
+        with self.lock:
+            self.data = {}
+
+
+aggregator = StatsAggregator()
+
+
+@atexit.register
+def _flush_at_exit():
+    # Недосброшенная статистика завершающегося процесса (воркер перезапущен, короткий скрипт)
+    if aggregator.data:
+        try:
+            aggregator.flush()
+        except Exception:
+            logger.exception('Статистика запросов не сохранена')
+
+
+def collect_stats():
+    """
+    Статистика всех процессов из кэша магазина, сведённая по именам адресов
+    :return: {имя адреса: словарь счётчиков со списком длительностей durations}
+    """
+    from .cache import get_cache
+
+    cache = get_cache()
+    merged = {}
+    for snapshot in cache.get_many(cache.get(PROCESSES_KEY) or ()).values():
+        for url_name, entry in snapshot.items():
+            total = merged.get(url_name)
+            if total is None:
+                total = merged[url_name] = dict.fromkeys(StatsAggregator.FIELDS, 0)
+                total['durations'] = []
+            for field in StatsAggregator.FIELDS:
+                if field == 'max_queries':
+                    total[field] = max(total[field], entry[field])
+                else:
+                    total[field] += entry[field]
+            total['durations'].extend(entry['durations'])
+    return merged
+
+
+def reset_stats():
+    """ Удаляем накопленную статистику всех процессов
+    """
+    from .cache import get_cache
+
+    cache = get_cache()
+    cache.delete_many(list(cache.get(PROCESSES_KEY) or ()) + [PROCESSES_KEY])
+    aggregator.reset()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def get_query_budget(view_func, cold=False):
+    """ Бюджет запросов к БД представления (атрибут query_budget класса или функции), None - не задан.
+        Для холодного запроса (был промах кэша) - cold_query_budget, если он задан
+    """
+    view = getattr(view_func, 'view_class', None) or view_func
+    budget = getattr(view, 'query_budget', None)
+    if cold:
+        return getattr(view, 'cold_query_budget', None) or budget
+    return budget
+
+
+def query_budget(queries, cold=None):
+    """
+    Декоратор бюджета запросов к БД для представления-функции или класса (у классов можно просто задать
+    атрибуты query_budget и cold_query_budget). Бюджет - точное число запросов для авторизованного покупателя
+    при прогретом кэше, cold - для запроса с промахом кэша (каталог, сессия, итоги корзины в сессии перестраиваются).
+    Превышение пишется в лог и в статистику, а в тестах проверяется shop.testing.assert_query_budget
+    """
+    def decorator(view):
+        view.query_budget = queries
+        if cold is not None:
+            view.cold_query_budget = cold
+        return view
+    return decorator
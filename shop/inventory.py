@@ -0,0 +1,241 @@
+import random
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import OperationalError, connection, models, transaction
+from django.utils import timezone
+
+from .models import CatalogProduct, StockReservation
+from .utils import get_product_content_key, write_atomic
+
+
+# На сколько минут товар резервируется при добавлении в корзину (0 - резерв отключен,
+# остаток списывается только при оформлении заказа)
+RESERVATION_MINUTES = getattr(settings, 'SHOP_STOCK_RESERVATION_MINUTES', 0)
+
+# Сколько просроченных резервов снимается за один проход
+RELEASE_BATCH_SIZE = getattr(settings, 'SHOP_STOCK_RELEASE_BATCH_SIZE', 500)
+
+# Сколько раз повторяем транзакцию со списанием остатков при конфликте блокировок
+LOCK_RETRIES = getattr(settings, 'SHOP_STOCK_LOCK_RETRIES', 10)
+
+
+class InsufficientStock(Exception):
+    """ Товара на складе меньше, чем требуется. shortages - список словарей с наименованием товара,
+        запрошенным и доступным колличеством
+    """
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__(self.get_message())
+
+    def get_message(self):
+        return 'Недостаточно товара на складе: {}'.format(', '.join(
+            '{} (доступно {} шт.)'.format(item['name'], item['available']) for item in self.shortages
+        ))
+
+
+
+class _Shortage(Exception):
+    """ Условный UPDATE обновил не все строки - откатываем точку сохранения и собираем нехватку
+    """
+
+
+
+def _group_by_model(amounts):
+    """
+    Группируем изменения остатков по таблицам товаров в постоянном порядке (id типа контента, id товара),
+    чтобы параллельные транзакции блокировали строки в одной и той же последовательности
+    :param amounts: {(id типа контента, id товара): колличество}
+    :return: [(модель, id типа контента, {id товара: колличество})]
+    """
+    grouped = defaultdict(dict)
+    for (content_type_id, object_id), qty in amounts.items():
+        if qty:
+            grouped[content_type_id][object_id] = qty
+    return [
+        (ContentType.objects.get_for_id(content_type_id).model_class(), content_type_id, grouped[content_type_id])
+        for content_type_id in sorted(grouped)
+    ]
+
+
+def _qty_case(amounts, field='pk'):
+    return models.Case(
+        *[models.When(**{field: object_id}, then=models.Value(qty)) for object_id, qty in amounts.items()],
+        output_field=models.IntegerField()
+    )
+
+
+def _lock_rows(queryset):
+    """ Блокируем строки товаров по возрастанию id (на SQLite запись и так сериализуется транзакцией)
+    """
+    if connection.features.has_select_for_update:
+        list(queryset.select_for_update().order_by('pk').values_list('pk', flat=True))
+
+
+def _sync_catalog_stock(model, content_type_id, object_ids):
+    """ Переносим остатки в сводный каталог одним UPDATE с подзапросом к таблице товаров
+    """
+    CatalogProduct.objects.filter(content_type_id=content_type_id, object_id__in=object_ids).update(
+        stock=models.Subquery(model._base_manager.filter(pk=models.OuterRef('object_id')).values('stock')[:1])
+    )
+
+
+def decrement_stock(amounts):
+    """
+    Списываем остатки: один условный UPDATE ... WHERE stock >= qty на таблицу товаров.
+    Если хотя бы одного товара не хватает, ничего не списывается
+    :param amounts: {(id типа контента, id товара): колличество}
+    :raise InsufficientStock: товара на складе меньше, чем требуется
+    """
+    with write_atomic(savepoint=False):
+        for model, content_type_id, model_amounts in _group_by_model(amounts):
+            products = model._base_manager.filter(pk__in=model_amounts)
+            _lock_rows(products)
+            qty = _qty_case(model_amounts)
+            try:
+                with transaction.atomic():
+                    updated = products.filter(stock__gte=qty).update(stock=models.F('stock') - qty)
+                    if updated != len(model_amounts):
+                        raise _Shortage
+            except _Shortage:
+                stocks = {pk: (name, stock) for pk, name, stock in products.values_list('pk', 'name', 'stock')}
+                raise InsufficientStock([
+                    {'name': stocks.get(pk, (model._meta.verbose_name, 0))[0], 'requested': requested,
+                     'available': stocks.get(pk, (None, 0))[1]}
+                    for pk, requested in sorted(model_amounts.items())
+                    if stocks.get(pk, (None, 0))[1] < requested
+                ])
+            _sync_catalog_stock(model, content_type_id, model_amounts)
+
+
+def increment_stock(amounts):
+    """
+    Возвращаем остатки на склад: один UPDATE на таблицу товаров
+    :param amounts: {(id типа контента, id товара): колличество}
+    """
+    with write_atomic(savepoint=False):
+        for model, content_type_id, model_amounts in _group_by_model(amounts):
+            products = model._base_manager.filter(pk__in=model_amounts)
+            _lock_rows(products)
+            products.update(stock=models.F('stock') + _qty_case(model_amounts))
+            _sync_catalog_stock(model, content_type_id, model_amounts)
+
+
+def _change_reservation(cart, product, get_qty):
+    """
+    Меняем резерв товара под корзину: со склада списывается (или возвращается) только разница,
+    срок резерва продлевается
+    :param cart: Корзина покупателя (сохранённая в БД)
+    :param product: Товар (наследник Product или CatalogProduct)
+    :param get_qty: Функция: текущий резерв -> новый резерв (0 - снять резерв)
+    :raise InsufficientStock: товара на складе меньше, чем требуется
+    """
+    key = get_product_content_key(product)
+    content_type_id, object_id = key
+    with write_atomic():
+        reservation = StockReservation.objects.select_for_update().filter(
+            cart=cart, content_type_id=content_type_id, object_id=object_id
+        ).first()
+        reserved = reservation.qty if reservation is not None else 0
+        qty = get_qty(reserved)
+        if qty > reserved:
+            decrement_stock({key: qty - reserved})
+        elif qty < reserved:
+            increment_stock({key: reserved - qty})
+
+        if not qty:
+            if reservation is not None:
+                reservation.delete()
+            return
+        expires = timezone.now() + timedelta(minutes=RESERVATION_MINUTES)
+        if reservation is None:
+            StockReservation.objects.create(
+                cart=cart, content_type_id=content_type_id, object_id=object_id, qty=qty, expires=expires
+            )
+        else:
+            StockReservation.objects.filter(pk=reservation.pk).update(qty=qty, expires=expires)
+
+
+def reserve_stock(cart, product, qty=1):
+    """ Добавляем qty штук товара к резерву корзины
+    """
+    _change_reservation(cart, product, lambda reserved: reserved + qty)
+
+
+def set_reserved_stock(cart, product, qty):
+    """ Резерв товара под корзину становится равным qty
+    """
+    _change_reservation(cart, product, lambda reserved: qty)
+
+
+def release_stock(cart, product):
+    """ Снимаем резерв товара корзины
+    """
+    _change_reservation(cart, product, lambda reserved: 0)
+
+
+def _release_reservations(reservations):
+    amounts = defaultdict(int)
+    for content_type_id, object_id, qty in reservations.values_list('content_type_id', 'object_id', 'qty'):
+        amounts[(content_type_id, object_id)] += qty
+    reservations.delete()
+    increment_stock(amounts)
+
+
+def commit_cart_stock(cart):
+    """
+    Списываем остатки под заказ: резервы корзины снимаются, а все её строки списываются одним заходом.
+    Вызывается внутри транзакции оформления заказа - при нехватке товара заказ не создаётся
+    :param cart: Корзина покупателя
+    :raise InsufficientStock: товара на складе меньше, чем в корзине
+    """
+    with write_atomic(savepoint=False):
+        reservations = StockReservation.objects.select_for_update().filter(cart=cart)
+        reserved_ids = list(reservations.order_by('pk').values_list('pk', flat=True))
+        if reserved_ids:
+            _release_reservations(StockReservation.objects.filter(pk__in=reserved_ids))
+        amounts = defaultdict(int)
+        for content_type_id, object_id, qty in cart.related_products.values_list(
+                'content_type_id', 'object_id', 'qty'):
+            amounts[(content_type_id, object_id)] += qty
+        decrement_stock(amounts)
+
+
+def release_expired_reservations(now=None, batch_size=RELEASE_BATCH_SIZE):
+    """
+    Снимаем просроченные резервы пачками: товар возвращается на склад одним UPDATE на таблицу товаров.
+    Резервы, заблокированные оформляемым прямо сейчас заказом, пропускаются
+    :return: Колличество снятых резервов
+    """
+    now = now or timezone.now()
+    released = 0
+    while True:
+        with write_atomic():
+            expired = StockReservation.objects.filter(expires__lte=now).order_by('pk')
+            if connection.features.has_select_for_update_skip_locked:
+                expired = expired.select_for_update(skip_locked=True)
+            ids = list(expired.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return released
+            _release_reservations(StockReservation.objects.filter(pk__in=ids))
+            released += len(ids)
+
+
+def atomic_with_retry(func, *args, **kwargs):
+    """
+    Выполняем func в отдельной транзакции. При конфликте блокировок (database is locked на SQLite,
+    deadlock на PostgreSQL) транзакция откатывается целиком и повторяется с нарастающей случайной паузой
+    :return: Результат func
+    """
+    for attempt in range(LOCK_RETRIES + 1):
+        try:
+            with write_atomic():
+                return func(*args, **kwargs)
+        except OperationalError:
+            if attempt == LOCK_RETRIES or connection.in_atomic_block:
+                raise
+            time.sleep(random.uniform(0, min(0.5, 0.02 * 2 ** attempt)))
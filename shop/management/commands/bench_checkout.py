@@ -0,0 +1,73 @@
+import statistics
+import time
+import uuid
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+
+from shop.inventory import increment_stock
+from shop.models import CatalogProduct, Cart, Customer
+from shop.utils import add_cart_product
+
+
+class Command(BaseCommand):
+    help = 'Замеряет время оформления заказа (POST /make-order/) на временном покупателе. ' \
+           'Остатки товаров после замера возвращаются, покупатель с корзинами и заказами удаляется'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help='Сколько заказов оформить')
+        parser.add_argument('--lines', type=int, default=3, help='Сколько разных товаров в корзине')
+
+    def handle(self, *args, **options):
+        products = list(
+            CatalogProduct.objects.filter(available=True, stock__gte=options['iterations'])
+            .order_by('pk')[:options['lines']]
+        )
+        if len(products) < options['lines']:
+            raise CommandError('Нет {} товаров с остатком от {} шт.'.format(options['lines'], options['iterations']))
+
+        setup_test_environment()
+        user = User.objects.create_user('bench-checkout-{}'.format(uuid.uuid4().hex[:12]))
+        customer = Customer.objects.create(user=user)
+        client = Client()
+        client.force_login(user)
+        form = {
+            'first_name': 'Бенчмарк', 'last_name': 'Оформления', 'phone': '0', 'address': '-',
+            'buying_type': 'self', 'order_date': time.strftime('%Y-%m-%d'), 'comment': '',
+        }
+        consumed = defaultdict(int)
+        timings, queries = [], []
+        try:
+            for _ in range(options['iterations']):
+                cart = Cart.objects.create(owner=customer)
+                for product in products:
+                    add_cart_product(cart, product)
+                with CaptureQueriesContext(connection) as context:
+                    started = time.perf_counter()
+                    response = client.post('/make-order/', form)
+                    timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 302 or response.url != '/':
+                    raise CommandError('Заказ не оформлен: {} {}'.format(response.status_code, response.get('Location')))
+                queries.append(len(context.captured_queries))
+                for product in products:
+                    consumed[(product.content_type_id, product.object_id)] += 1
+        finally:
+            increment_stock(consumed)
+            user.delete()
+            teardown_test_environment()
+
+        timings.sort()
+        self.stdout.write('Заказов: {}, товаров в корзине: {}'.format(len(timings), len(products)))
+        self.stdout.write('Запросов к БД на заказ: {}'.format(statistics.median(queries)))
+        self.stdout.write(self.style.SUCCESS(
+            'Время, мс: min {:.1f}  p50 {:.1f}  p95 {:.1f}  max {:.1f}'.format(
+                timings[0],
+                statistics.median(timings),
+                timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+                timings[-1],
+            )
+        ))
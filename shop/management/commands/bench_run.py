@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from shop.benchmarks import (
+    compare_results, get_bench_users, get_environment, load_results, run_client, run_load, save_results, SCENARIOS,
+)
+
+
+MODES = ('client', 'wsgi')
+
+
+class Command(BaseCommand):
+    help = 'Замеряет пропускную способность и задержки (p50/p95/p99) горячих адресов магазина на данных bench_seed: ' \
+           'последовательно через тестовый клиент и конкурентно через локальный WSGI-сервер. ' \
+           'Результаты сохраняются в JSON и сравниваются с базовым замером'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+        parser.add_argument('--mode', choices=MODES + ('all',), default='all')
+        parser.add_argument('--iterations', type=int, default=200, help='Запросов на сценарий (тестовый клиент)')
+        parser.add_argument('--concurrency', type=int, default=8, help='Параллельных покупателей (WSGI)')
+        parser.add_argument('--requests', type=int, default=50, help='Запросов на покупателя (WSGI)')
+        parser.add_argument('--warmup', type=int, default=5, help='Запросов прогрева (не учитываются)')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Файл JSON для результатов')
+        parser.add_argument('--baseline', help='Файл JSON базового замера для сравнения')
+        parser.add_argument('--max-regression', type=float,
+                            help='Ошибка, если p95 какого-то сценария вырос больше чем на столько процентов')
+
+    def handle(self, *args, **options):
+        modes = MODES if options['mode'] == 'all' else (options['mode'],)
+        if options['iterations'] < 1 or options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--iterations, --requests и --concurrency должны быть положительными')
+        try:
+            bench_users = get_bench_users(max(options['concurrency'], 1), seed=options['seed'])
+        except ValueError as error:
+            raise CommandError(error)
+
+        results = {'environment': get_environment(), 'options': {
+            name: options[name] for name in ('iterations', 'concurrency', 'requests', 'warmup', 'seed')
+        }, 'results': {}}
+        setup_test_environment()
+        try:
+            for mode in modes:
+                results['results'][mode] = {}
+                for scenario in options['scenarios']:
+                    if mode == 'client':
+                        summary = run_client(scenario, bench_users[0], options['iterations'], options['warmup'])
+                    else:
+                        summary = run_load(
+                            scenario, bench_users[:options['concurrency']], options['requests'], options['warmup']
+                        )
+                    results['results'][mode][scenario] = summary
+                    self.write_summary(mode, scenario, summary)
+        finally:
+            teardown_test_environment()
+
+        if options['output']:
+            save_results(options['output'], results)
+            self.stdout.write('Результаты сохранены в {}'.format(options['output']))
+        if options['baseline']:
+            self.compare(results, load_results(options['baseline']), options['max_regression'])
+
+    def write_summary(self, mode, scenario, summary):
+        line = '{:<7}{:<17} {:>5} запр. {:>4} ош. {:>9.1f} rps  p50 {:>7.1f}  p95 {:>7.1f}  p99 {:>7.1f} мс'.format(
+            mode, scenario, summary['requests'], summary['errors'], summary['throughput_rps'],
+            summary['p50_ms'], summary['p95_ms'], summary['p99_ms']
+        )
+        if 'queries_median' in summary:
+            line += '  SQL {}'.format(summary['queries_median'])
+        self.stdout.write(self.style.ERROR(line) if summary['errors'] else line)
+
+    def compare(self, results, baseline, max_regression):
+        self.stdout.write('Сравнение с базовым замером ({}):'.format(baseline.get('environment', {}).get('commit', '?')))
+        regressions = []
+        for mode, scenario, metric, before, after, change in compare_results(results, baseline):
+            worse = change < 0 if metric == 'throughput_rps' else change > 0
+            line = '{:<7}{:<17}{:<15}{:>10} -> {:<10} {:+.1f}%'.format(mode, scenario, metric, before, after, change)
+            self.stdout.write(self.style.WARNING(line) if worse else line)
+            if metric == 'p95_ms' and max_regression is not None and change > max_regression:
+                regressions.append('{} {}: p95 {:+.1f}%'.format(mode, scenario, change))
+        if regressions:
+            raise CommandError('Замедление больше {}%: {}'.format(max_regression, '; '.join(regressions)))
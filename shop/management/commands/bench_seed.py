@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from shop.benchmarks import clear_bench_data, seed_catalog
+
+
+class Command(BaseCommand):
+    help = 'Заполняет базу синтетическим каталогом для bench_run (товары и пользователи с префиксом bench-). ' \
+           'Прежние синтетические данные удаляются. Запускать на копии базы, не на рабочей'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--parents', type=int, default=3, help='Категорий')
+        parser.add_argument('--categories', type=int, default=12, help='Подкатегорий (для навигации)')
+        parser.add_argument('--wobblers', type=int, default=2000, help='Воблеров')
+        parser.add_argument('--spoons', type=int, default=2000, help='Блесен')
+        parser.add_argument('--customers', type=int, default=50, help='Покупателей с корзинами')
+        parser.add_argument('--max-cart-lines', type=int, default=8, help='Максимум строк в корзине')
+        parser.add_argument('--seed', type=int, default=42, help='Зерно генератора случайных чисел')
+        parser.add_argument('--clear', action='store_true', help='Только удалить синтетические данные')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            deleted = clear_bench_data()
+            self.stdout.write(self.style.SUCCESS('Удалено объектов: {}'.format(deleted)))
+            return
+        created = seed_catalog(
+            parents=options['parents'],
+            categories=options['categories'],
+            wobblers=options['wobblers'],
+            spoons=options['spoons'],
+            customers=options['customers'],
+            max_cart_lines=options['max_cart_lines'],
+            seed=options['seed'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            'Создано: ' + ', '.join('{} {}'.format(name, count) for name, count in created.items())
+        ))
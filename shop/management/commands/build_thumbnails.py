@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from shop.cache import bump_version, PRODUCTS
+from shop.thumbnails import generate_thumbnails, get_executor, get_image_models
+
+
+class Command(BaseCommand):
+    help = 'Строит превью картинок подкатегорий и товаров (уже готовые и свежие превью пропускаются)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Перестроить все превью')
+
+    def handle(self, *args, **options):
+        names = set()
+        for model in get_image_models():
+            names.update(model._base_manager.exclude(image='').values_list('image', flat=True))
+
+        written = failed = 0
+        futures = {name: get_executor().submit(generate_thumbnails, name, options['force']) for name in sorted(names)}
+        for name, future in futures.items():
+            try:
+                written += future.result()
+            except Exception as error:
+                failed += 1
+                self.stderr.write('{}: {}'.format(name, error))
+        if written:
+            bump_version(PRODUCTS)
+        self.stdout.write(self.style.SUCCESS(
+            'Картинок: {}, записано превью: {}, с ошибкой: {}'.format(len(names), written, failed)
+        ))
@@ -0,0 +1,39 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.catalog_io import BATCH_SIZE, FORMATS, detect_format, export_rows, write_rows
+from shop.registry import registry
+
+
+class Command(BaseCommand):
+    help = 'Выгрузка товаров в CSV или JSON Lines в формате, который принимает import_catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Модель товаров (имя модели или адрес подкатегории), например wobblers')
+        parser.add_argument('path', nargs='?', default='-', help='Путь к файлу (по умолчанию - stdout)')
+        parser.add_argument('--format', choices=FORMATS, help='Формат файла (по умолчанию - по расширению)')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Сколько строк читать из БД за раз')
+
+    def handle(self, *args, **options):
+        model = registry.get_model(options['model'])
+        if model is None:
+            raise CommandError('Неизвестная модель товаров: {}'.format(options['model']))
+        path = options['path']
+        try:
+            fmt = detect_format(path, options['format'] or ('csv' if path == '-' else None))
+        except ValueError as error:
+            raise CommandError(error)
+
+        started = time.perf_counter()
+        columns, rows = export_rows(model, batch_size=options['batch_size'])
+        if path == '-':
+            total = write_rows(sys.stdout, fmt, columns, rows)
+        else:
+            with open(path, 'w', newline='', encoding='utf-8') as stream:
+                total = write_rows(stream, fmt, columns, rows)
+        elapsed = time.perf_counter() - started
+        self.stderr.write(self.style.SUCCESS('Выгружено строк: {} ({:.0f} строк/с)'.format(
+            total, total / elapsed if elapsed else 0
+        )))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.catalog_io import BATCH_SIZE, FORMATS, CatalogImporter, detect_format, read_rows
+from shop.registry import registry
+
+
+class Command(BaseCommand):
+    help = 'Импорт товаров из CSV или JSON Lines: существующие товары (по коду product_key) обновляются, ' \
+           'новые создаются. Подкатегория указывается адресом (slug)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Модель товаров (имя модели или адрес подкатегории), например wobblers')
+        parser.add_argument('path', help='Путь к файлу')
+        parser.add_argument('--format', choices=FORMATS, help='Формат файла (по умолчанию - по расширению)')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Размер пачки bulk_create/bulk_update')
+        parser.add_argument('--update-only', action='store_true', help='Только обновлять существующие товары')
+        parser.add_argument('--dry-run', action='store_true', help='Проверить файл: импорт выполняется и откатывается')
+
+    def handle(self, *args, **options):
+        model = registry.get_model(options['model'])
+        if model is None:
+            raise CommandError('Неизвестная модель товаров: {}'.format(options['model']))
+        try:
+            fmt = detect_format(options['path'], options['format'])
+        except ValueError as error:
+            raise CommandError(error)
+
+        importer = CatalogImporter(
+            model,
+            batch_size=options['batch_size'],
+            create=not options['update_only'],
+            dry_run=options['dry_run'],
+            on_batch=self.report_progress if options['verbosity'] > 1 else None,
+        )
+        with open(options['path'], newline='', encoding='utf-8-sig') as stream:
+            importer.run(read_rows(stream, fmt))
+
+        for line_num, message in sorted(importer.errors):
+            self.stderr.write('Строка {}: {}'.format(line_num, message))
+        self.stdout.write(self.style.SUCCESS(
+            'Строк: {}, создано: {}, обновлено: {}, пропущено: {} ({:.0f} строк/с)'.format(
+                importer.rows, importer.created, importer.updated, importer.skipped, importer.rate
+            )
+        ))
+        if options['dry_run']:
+            self.stdout.write('Пробный запуск: изменения не сохранены')
+
+    def report_progress(self, importer):
+        self.stdout.write('... {} строк ({:.0f} строк/с)'.format(importer.rows, importer.rate))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from shop.cache import bump_version, PRODUCTS
+from shop.models import CatalogProduct
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает сводный каталог товаров по всем моделям товаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Размер пачки для bulk_create')
+
+    def handle(self, *args, **options):
+        total = CatalogProduct.objects.rebuild(batch_size=options['batch_size'])
+        bump_version(PRODUCTS)
+        self.stdout.write(self.style.SUCCESS('Каталог перестроен: {} товаров'.format(total)))
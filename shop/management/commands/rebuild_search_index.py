@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from shop.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает поисковый индекс по всем моделям товаров'
+
+    def handle(self, *args, **options):
+        total = rebuild_index()
+        self.stdout.write(self.style.SUCCESS('Поисковый индекс перестроен: {} товаров'.format(total)))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shop.inventory import release_expired_reservations, RELEASE_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Снимает просроченные резервы товаров и возвращает товар на склад (запускается по расписанию)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=RELEASE_BATCH_SIZE, help='Размер пачки резервов')
+
+    def handle(self, *args, **options):
+        released = release_expired_reservations(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Снято резервов: {}'.format(released)))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.tasks import run_pending_tasks, release_stale_tasks
+
+
+class Command(BaseCommand):
+    help = 'Выполняет задачи заказов из очереди (уведомления и т.п.), включая повторы после ошибок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100, help='Сколько задач выполнить за проход')
+        parser.add_argument('--loop', action='store_true', help='Работать постоянно, опрашивая очередь')
+        parser.add_argument('--interval', type=float, default=5, help='Пауза между проходами в режиме --loop, сек')
+
+    def handle(self, *args, **options):
+        while True:
+            release_stale_tasks()
+            done, failed = run_pending_tasks(limit=options['limit'])
+            if done or failed or not options['loop']:
+                self.stdout.write('Выполнено задач: {}, с ошибкой: {}'.format(done, failed))
+            if not options['loop']:
+                return
+            if not done and not failed:
+                time.sleep(options['interval'])
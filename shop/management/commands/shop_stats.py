@@ -0,0 +1,60 @@
+import json
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+
+from shop.cache import get_cache
+from shop.instrumentation import aggregator, collect_stats, percentile, reset_stats
+
+
+class Command(BaseCommand):
+    help = 'Статистика запросов по адресам магазина, собранная InstrumentationMiddleware во всех процессах: ' \
+           'число и время SQL-запросов, дубли, отрисовка шаблонов, кэш, перцентили длительности'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='Вывести в JSON')
+        parser.add_argument('--reset', action='store_true', help='Удалить накопленную статистику')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            reset_stats()
+            self.stdout.write(self.style.SUCCESS('Статистика удалена'))
+            return
+
+        aggregator.flush()
+        rows = []
+        for url_name, entry in sorted(collect_stats().items()):
+            requests = entry['requests'] or 1
+            rows.append(dict(
+                url_name=url_name,
+                requests=entry['requests'],
+                avg_queries=round(entry['queries'] / requests, 1),
+                max_queries=entry['max_queries'],
+                avg_sql_ms=round(entry['sql_ms'] / requests, 2),
+                duplicates=entry['duplicates'],
+                avg_render_ms=round(entry['render_ms'] / requests, 2),
+                cache_hits=entry['cache_hits'],
+                cache_misses=entry['cache_misses'],
+                over_budget=entry['over_budget'],
+                p50_ms=percentile(entry['durations'], 0.5),
+                p95_ms=percentile(entry['durations'], 0.95),
+            ))
+
+        if options['json']:
+            self.stdout.write(json.dumps(rows, ensure_ascii=False, indent=2))
+            return
+        if not rows:
+            self.stdout.write('Статистики нет: включите SHOP_INSTRUMENTATION')
+            if isinstance(get_cache(), LocMemCache):
+                # Статистика серверов пишется в кэш их процессов - команде нужен общий кэш
+                self.stdout.write('Кэш магазина locmem виден только своему процессу: задайте DJANGO_CACHE_DIR '
+                                  'или DJANGO_CACHE_BACKEND')
+            return
+        self.stdout.write('{:<28}{:>8}{:>9}{:>7}{:>9}{:>6}{:>10}{:>12}{:>8}{:>9}{:>9}'.format(
+            'адрес', 'запросы', 'SQL ср.', 'макс.', 'SQL мс', 'дубли', 'шабл. мс', 'кэш +/-', 'превыш.', 'p50 мс',
+            'p95 мс'
+        ))
+        for row in rows:
+            self.stdout.write('{url_name:<28}{requests:>8}{avg_queries:>9}{max_queries:>7}{avg_sql_ms:>9}'
+                              '{duplicates:>6}{avg_render_ms:>10}{cache:>12}{over_budget:>8}{p50_ms:>9}'
+                              '{p95_ms:>9}'.format(cache='{}/{}'.format(row['cache_hits'], row['cache_misses']), **row))
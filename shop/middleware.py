@@ -0,0 +1,65 @@
+import asyncio
+import logging
+
+from django.core.exceptions import MiddlewareNotUsed
+
+from .instrumentation import (
+    aggregator, ENABLED, finish_request, get_query_budget, instrument_connections, instrument_templates,
+    SERVER_TIMING, start_request,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentationMiddleware:
+    """ Статистика запроса: число и время SQL-запросов по всем подключениям, дубли запросов, время отрисовки
+        шаблонов, попадания в кэш магазина. Отдаётся в заголовке Server-Timing и копится по именам адресов
+        (команда shop_stats). Ставится первым в MIDDLEWARE, чтобы учитывать запросы сессий и авторизации
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        instrument_connections()
+        instrument_templates()
+        if asyncio.iscoroutinefunction(get_response):
+            # Под ASGI не переводим каждый запрос в синхронный поток ради этой middleware
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats, token = start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            finish_request(token)
+        return self.process_stats(request, response, stats)
+
+    async def __acall__(self, request):
+        stats, token = start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            finish_request(token)
+        return self.process_stats(request, response, stats)
+
+    def process_stats(self, request, response, stats):
+        match = getattr(request, 'resolver_match', None)
+        url_name = match.view_name if match else 'unresolved'
+        # Промах кэша - холодный запрос: у него свой, больший бюджет
+        budget = get_query_budget(match.func, cold=stats.cache_misses > 0) if match else None
+        over_budget = budget is not None and stats.queries > budget
+        if over_budget:
+            logger.warning('%s %s: %s запросов к БД при бюджете %s', request.method, url_name, stats.queries, budget)
+        if stats.duplicates:
+            logger.info('%s %s: повторные запросы %s', request.method, url_name, stats.get_duplicate_statements())
+        aggregator.add(url_name, stats, over_budget)
+        if SERVER_TIMING:
+            response['Server-Timing'] = stats.get_server_timing()
+        return response
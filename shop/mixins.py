@@ -1,43 +1,50 @@
+from django.conf import settings
 from django.views.generic.detail import SingleObjectMixin
 from django.views.generic import View
 
-from .models import (
-    Category, ParentCategory,
-    Cart, Customer,
-    Wobblers, Spoons, WinterFishing, SpinningRods, Libras, DryAdditives, CoilsInertial, Hooks,
-    LineMonofilament, CoilsMulty, Leashes, Floats, SlingShots,
-)
+from .cache import get_categories, get_parent_categories
+from .cart import get_cart_service
+from .facets import FacetFilter
+from .pagination import KeysetPaginator
+from .registry import CATEGORY_SLUG2PRODUCT_MODEL
+from .models import Category, ParentCategory, Wobblers, Spoons
 
 
-class CategoryDetailMixin(SingleObjectMixin):
+class KeysetPaginationMixin:
+    """ Постраничный вывод товаров по ключу сортировки (курсоры after/before в GET-параметрах)
+    """
+    page_size = getattr(settings, 'SHOP_PAGE_SIZE', 24)
+    page_ordering = ('name', 'id')
 
-    CATEGORY_SLUG2PRODUCT_MODEL = {
-        'voblery': Wobblers,
-        'blesny': Spoons,
-        'aksessuary-dlya-zimnej-rybalki': WinterFishing,
-        'spinningovye-udilisha': SpinningRods,
-        'vesy': Libras,
-        'dobavki-suhie': DryAdditives,
-        'inercionnye-katushki': CoilsInertial,
-        'kryuchki': Hooks,
-        'leska-monofilnaya': LineMonofilament,
-        'multiplikatornye-katushki': CoilsMulty,
-        'povodki': Leashes,
-        'poplavki': Floats,
-        'rogatki': SlingShots
-    }
+    def paginate_keyset(self, queryset):
+        paginator = KeysetPaginator(queryset, self.page_size, self.page_ordering)
+        return paginator.get_page(
+            after=self.request.GET.get('after'),
+            before=self.request.GET.get('before'),
+            params=self.request.GET,
+        )
+
+
+
+class CategoryDetailMixin(KeysetPaginationMixin, SingleObjectMixin):
+
+    CATEGORY_SLUG2PRODUCT_MODEL = CATEGORY_SLUG2PRODUCT_MODEL
 
 
     def get_context_data(self, **kwargs):
-        if isinstance(self.get_object(), Category):
-            model = self.CATEGORY_SLUG2PRODUCT_MODEL[self.get_object().slug]
+        if isinstance(self.object, Category):
+            model = self.CATEGORY_SLUG2PRODUCT_MODEL[self.object.slug]
             context = super().get_context_data(**kwargs)
-            context['category'] = Category.objects.order_by('name')
-            context['product'] = model.objects.all()
+            context['category'] = get_categories()
+            facet_filter = FacetFilter(model, self.request.GET)
+            context['facets'] = facet_filter.get_facets(model.objects.all())
+            context['facet_filter'] = facet_filter
+            context['page'] = self.paginate_keyset(facet_filter.filter(model.objects.all()))
+            context['product'] = context['page'].object_list
             return context
 
         context = super().get_context_data(**kwargs)
-        context['category'] = Category.objects.order_by('name')
+        context['category'] = get_categories()
         return context
 
 
@@ -45,31 +52,27 @@ class CategoryDetailMixin(SingleObjectMixin):
 class CartMixin(View):
 
     def dispatch(self, request, *args, **kwargs):
-        if request.user.is_authenticated:
-            customer = Customer.objects.filter(user=request.user).first()
-            if not customer:
-                customer = Customer.objects.create(user=request.user)
-
-            cart = Cart.objects.filter(owner=customer, in_order=False).first()
-            if not cart:
-                cart = Cart.objects.create(owner=customer)
-
-        else:
-            cart = Cart.objects.filter(for_anonymous_user=True).first()
-            if not cart:
-                cart = Cart.objects.create(for_anonymous_user=True)
-
-        self.cart = cart
+        self.cart_service = get_cart_service(request)
+        self.cart_service.merge_guest_cart()
+        self.cart = self.cart_service.get_lazy_cart()
         self.user = request.user
-        return super().dispatch(request, *args, **kwargs)
+        response = super().dispatch(request, *args, **kwargs)
+        return self.cart_service.save(response)
+
+    def get_cart_lines(self):
+        """ Строки корзины с товарами, загруженные фиксированным числом запросов
+        """
+        if not hasattr(self, '_cart_lines'):
+            self._cart_lines = self.cart_service.get_lines()
+        return self._cart_lines
 
 
 
 class CategoryMixin(View):
 
     def dispatch(self, request, *args, **kwargs):
-        self.category = Category.objects.order_by('name')
-        self.parent_category =  ParentCategory.objects.order_by('name')
+        self.category = get_categories()
+        self.parent_category = get_parent_categories()
         return super().dispatch(request, *args, **kwargs)
 
 
@@ -91,14 +94,14 @@ class ParentCategoryDetailMixin(SingleObjectMixin):
 
 
     def get_context_data(self, **kwargs):
-        if isinstance(self.get_object(), ParentCategory):
-            models = self.CATEGORY_SLUG2PRODUCT_MODEL[self.get_object().slug]
+        if isinstance(self.object, ParentCategory):
+            models = self.CATEGORY_SLUG2PRODUCT_MODEL[self.object.slug]
             context = super().get_context_data(**kwargs)
-            context['parent_category'] = ParentCategory.objects.order_by('name')
+            context['parent_category'] = get_parent_categories()
             for model in models:
                 context[model.slug] = model.objects.all()
             return context
 
         context = super().get_context_data(**kwargs)
-        context['parent_category'] = ParentCategory.objects.order_by('name')
+        context['parent_category'] = get_parent_categories()
         return context
\ No newline at end of file
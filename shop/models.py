@@ -1,10 +1,13 @@
-from django.db import models
+from django.apps import apps
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.urls import reverse
 from django.utils import timezone
 
+from .utils import bulk_update_rows, write_atomic
+
 
 User = get_user_model()
 
@@ -18,6 +21,12 @@ def get_model_url(obj, viewname):
     return reverse(viewname=viewname, kwargs={'ct_model': ct_model, 'slug': obj.slug})
 
 
+def get_product_models():
+    """ Все конкретные модели товаров (наследники Product)
+    """
+    return [model for model in apps.get_models() if issubclass(model, Product)]
+
+
 
 class CategoryManager(models.Manager):
     def get_queryset(self):
@@ -34,25 +43,168 @@ class CategoryManager(models.Manager):
 
 
 
+class CatalogProductManager(models.Manager):
+    """ Менеджер сводного каталога товаров
+    """
+    # Колонки каталога, которые копируются из одноимённых колонок товара
+    MIRRORED_FIELDS = (
+        'product_key', 'name', 'slug', 'price', 'stock', 'available', 'category_id', 'image', 'updated'
+    )
+
+    @staticmethod
+    def get_product_data(product):
+        """
+        Общие поля товара для записи в каталог
+        :param product: Экземпляр наследника Product
+        :return: Словарь значений полей CatalogProduct
+        """
+        image = getattr(product, 'image', None)
+        return dict(
+            model_name=product._meta.model_name,
+            product_key=product.product_key,
+            name=product.name,
+            slug=product.slug,
+            price=product.price,
+            stock=product.stock,
+            available=product.available,
+            category_id=getattr(product, 'category_id', None),
+            image=image.name if image else '',
+            updated=product.updated,
+        )
+
+    def sync(self, product):
+        """
+        Создаём или обновляем запись каталога для товара
+        :return: Прежние значения полей записи (по ним видно, что изменилось), None - записи не было
+        """
+        content_type = ContentType.objects.get_for_model(product)
+        data = self.get_product_data(product)
+        entries = self.filter(content_type=content_type, object_id=product.pk)
+        with write_atomic(savepoint=False):
+            previous = entries.select_for_update().values(*data).first()
+            if previous is not None:
+                entries.update(**data)
+                return previous
+            try:
+                with transaction.atomic():
+                    self.create(content_type=content_type, object_id=product.pk, **data)
+            except IntegrityError:
+                # Запись успел создать параллельный запрос
+                entries.update(**data)
+        return None
+
+    def sync_many(self, model, products, batch_size=500):
+        """
+        Создаём или обновляем записи каталога для пачки товаров одной модели: один SELECT,
+        обновление существующих записей (bulk_update_rows) и bulk_create новых
+        :param model: Модель товаров
+        :param products: Экземпляры модели
+        """
+        content_type = ContentType.objects.get_for_model(model)
+        products = {product.pk: product for product in products}
+        existing = dict(
+            self.filter(content_type=content_type, object_id__in=products).values_list('object_id', 'pk')
+        )
+        to_update, to_create = [], []
+        for object_id, product in products.items():
+            entry = self.model(content_type=content_type, object_id=object_id, **self.get_product_data(product))
+            if object_id in existing:
+                entry.pk = existing[object_id]
+                to_update.append(entry)
+            else:
+                to_create.append(entry)
+        if to_update:
+            bulk_update_rows(to_update, list(self.get_product_data(next(iter(products.values())))))
+        if to_create:
+            self.bulk_create(to_create, batch_size=batch_size)
+
+    def refresh_from_products(self, model, object_ids, fields):
+        """
+        Переносим изменённые колонки товаров в каталог одним UPDATE с подзапросами к таблице товаров
+        (без загрузки товаров в память)
+        :param model: Модель товаров
+        :param object_ids: id изменённых товаров
+        :param fields: attname изменённых полей товара (поля, которых нет в каталоге, пропускаются)
+        """
+        mirrored = [attname for attname in fields if attname in self.MIRRORED_FIELDS]
+        if not mirrored:
+            return 0
+        products = model._base_manager.filter(pk=models.OuterRef('object_id'))
+        return self.filter(
+            content_type=ContentType.objects.get_for_model(model), object_id__in=object_ids
+        ).update(**{
+            attname: models.Subquery(products.values(attname)[:1]) for attname in mirrored
+        })
+
+    def remove(self, product):
+        """ Удаляем запись каталога для товара
+        """
+        content_type = ContentType.objects.get_for_model(product)
+        self.filter(content_type=content_type, object_id=product.pk).delete()
+
+    def rebuild(self, batch_size=500):
+        """
+        Полностью перестраиваем каталог по всем моделям товаров в одной транзакции: записи обновляем на месте
+        и досоздаём пачками (sync_many), записи удалённых товаров удаляем. До фиксации читатели видят прежний
+        каталог, а не пустой или заполненный наполовину, а при ошибке каталог остаётся прежним
+        :return: Колличество записей в каталоге
+        """
+        total = 0
+        content_types = []
+        with write_atomic():
+            for model in get_product_models():
+                content_type = ContentType.objects.get_for_model(model)
+                content_types.append(content_type)
+                batch = []
+                for product in model._base_manager.iterator(chunk_size=batch_size):
+                    batch.append(product)
+                    if len(batch) == batch_size:
+                        self.sync_many(model, batch, batch_size=batch_size)
+                        total += len(batch)
+                        batch = []
+                if batch:
+                    self.sync_many(model, batch, batch_size=batch_size)
+                    total += len(batch)
+                self.filter(content_type=content_type).exclude(
+                    object_id__in=model._base_manager.values('pk')
+                ).delete()
+            self.exclude(content_type__in=content_types).delete()
+        return total
+
+    def latest_for_models(self, *model_names, limit=3):
+        """ Последние limit товаров каждой из моделей model_names одним запросом
+        """
+        latest = self.filter(model_name=models.OuterRef('model_name')).order_by('-object_id').values('pk')[:limit]
+        return self.filter(
+            model_name__in=model_names, pk__in=models.Subquery(latest)
+        ).select_related('category').order_by('model_name', '-object_id')
+
+    def listing(self, **filters):
+        """ Доступные товары всех моделей одним запросом (для общих списков)
+        """
+        return self.filter(available=True, **filters).select_related('category')
+
+
+
 class LatestProductsManager:
 
     @staticmethod
     def get_products_for_main_page(*args, **kwargs):
-        with_respect_to = kwargs.get('with_respect_to')
-        products = []
-        ct_models = ContentType.objects.filter(model__in=args)
-        for ct_model in ct_models:
-            model_products = ct_model.model_class()._base_manager.all().order_by('-id')[:3]
-            products.extend(model_products)
-        if with_respect_to:
-            ct_model = ContentType.objects.filter(model=with_respect_to)
-            if ct_model.exists():
-                if with_respect_to in args:
-                    return sorted(
-                        products,
-                        key=lambda x: x.__class__._meta.model_name.startswith(with_respect_to),
-                        reverse=True
-                    )
+        """ Последние товары заданных моделей одним запросом к каталогу (по 3 на модель)
+        """
+        products = list(CatalogProduct.objects.latest_for_models(*args, limit=3))
+        return LatestProductsManager.sort_with_respect_to(products, args, kwargs.get('with_respect_to'))
+
+    @staticmethod
+    def sort_with_respect_to(products, model_names, with_respect_to=None):
+        """ Поднимаем товары модели with_respect_to в начало списка
+        """
+        if with_respect_to and with_respect_to in model_names:
+            return sorted(
+                products,
+                key=lambda x: x.get_model_name().startswith(with_respect_to),
+                reverse=True
+            )
         return products
 
 
@@ -83,12 +235,15 @@ class CartProduct(models.Model):
     class Meta:
         verbose_name = '- Товары в корзинах -'
         verbose_name_plural = '- Товары в корзинах -'
+        unique_together = ('cart', 'content_type', 'object_id')
 
     def __str__(self):
         return "Товар {} (для корзины)".format(self.content_object.name)
 
     def save(self, *args, **kwargs):
-        self.final_price = self.qty * self.content_object.price
+        # Цену строки передаёт код корзины; товар подгружаем только если её не указали
+        if self.final_price is None:
+            self.final_price = self.qty * self.content_object.price
         super().save(*args, **kwargs)
 
     def get_model_name(self):
@@ -100,7 +255,6 @@ class Cart(models.Model):
     """ Корзина
     """
     owner = models.ForeignKey('Customer', null=True, verbose_name='Владелец', on_delete=models.CASCADE)
-    products = models.ManyToManyField(CartProduct, blank=True, related_name='related_card')
     total_product = models.PositiveIntegerField(default=0)
     final_price = models.DecimalField(max_digits=9, default=0, decimal_places=2, verbose_name='Итоговая цена')
     in_order = models.BooleanField(default=False)
@@ -116,13 +270,35 @@ class Cart(models.Model):
 
 
 
+class StockReservation(models.Model):
+    """ Резерв товара под корзину: списан с остатка до оформления заказа или до истечения срока
+    """
+    cart = models.ForeignKey(Cart, verbose_name='Корзина', related_name='reservations', on_delete=models.CASCADE)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    qty = models.PositiveIntegerField(default=0, verbose_name='Колличество')
+    expires = models.DateTimeField(db_index=True, verbose_name='Действует до')
+
+    class Meta:
+        verbose_name = '- Резерв товара -'
+        verbose_name_plural = '- Резервы товаров -'
+        unique_together = ('cart', 'content_type', 'object_id')
+
+    def __str__(self):
+        return 'Резерв {} шт. (корзина {})'.format(self.qty, self.cart_id)
+
+
+
+
 class Customer(models.Model):
     """ Покупатель
     """
+    # Связь orders (ManyToMany на Order) удалена: она дублировала Order.customer. Миграций у приложения нет
+    # (таблицы создаёт migrate --run-syncdb), поэтому таблица shop_customer_orders в существующих базах
+    # остаётся, но больше нигде не читается и не пишется - её можно удалить вручную
     user = models.ForeignKey(User, verbose_name='Пользователь', on_delete=models.CASCADE)
     phone = models.CharField(max_length=20, verbose_name='Номер телефона', null=True, blank=True)
     address = models.CharField(max_length=255, verbose_name='Адрес', null=True, blank=True)
-    orders = models.ManyToManyField('Order', verbose_name='Заказы покупателя', related_name='related_customer')
 
     class Meta:
         verbose_name = '- Покупатель -'
@@ -186,6 +362,41 @@ class Order(models.Model):
         return str(self.id)
 
 
+
+class OrderTask(models.Model):
+    """ Задача, выполняемая после оформления заказа (уведомления и т.п.). Очередь в БД: строка создаётся
+        в транзакции заказа, выполняется после её фиксации
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Ожидает выполнения'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_DONE, 'Выполнена'),
+        (STATUS_FAILED, 'Ошибка'),
+    )
+
+    order = models.ForeignKey(Order, verbose_name='Заказ', related_name='tasks', on_delete=models.CASCADE)
+    name = models.CharField(max_length=100, verbose_name='Задача')
+    key = models.CharField(max_length=150, unique=True, verbose_name='Ключ идемпотентности')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name='Статус')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Попыток')
+    run_after = models.DateTimeField(default=timezone.now, verbose_name='Выполнить после')
+    last_error = models.TextField(blank=True, verbose_name='Последняя ошибка')
+    updated = models.DateTimeField(auto_now=True, verbose_name='Обновлено')
+
+    class Meta:
+        verbose_name = '- Задача заказа -'
+        verbose_name_plural = '- Задачи заказов -'
+        index_together = (('status', 'run_after'),)
+
+    def __str__(self):
+        return self.key
+
+
 # Модели категорий товаров
 
 class ParentCategory(models.Model):
@@ -288,7 +499,7 @@ class Wobblers(Product):
         ordering = ('name',)
         verbose_name = 'Воблер'
         verbose_name_plural = 'Воблеры'
-        index_together = (('id', 'slug'),)
+        index_together = (('id', 'slug'), ('name', 'id'))
 
     def __str__(self):
         return self.name
@@ -321,7 +532,7 @@ class Spoons(Product):
         ordering = ('name',)
         verbose_name = 'Блесна'
         verbose_name_plural = 'Блесны'
-        index_together = (('id', 'slug'),)
+        index_together = (('id', 'slug'), ('name', 'id'))
 
     def __str__(self):
         return self.name
@@ -404,4 +615,69 @@ class Floats(Product):
 class SlingShots(Product):
     """ Рогатки
     """
-    pass
\ No newline at end of file
+    pass
+
+
+
+# Сводный каталог товаров
+
+class CatalogProduct(models.Model):
+    """ Денормализованная запись каталога с общими полями всех моделей товаров.
+        Синхронизируется сигналами при сохранении и удалении товара (см. signals.py)
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+    model_name = models.CharField(max_length=100, db_index=True, verbose_name='Модель товара')
+    product_key = models.PositiveIntegerField(db_index=True, verbose_name='Код товара')
+    name = models.CharField(max_length=200, db_index=True, verbose_name='Имя')
+    slug = models.SlugField(max_length=200, verbose_name='URL')
+    price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Цена')
+    stock = models.PositiveIntegerField(verbose_name='Остаток')
+    available = models.BooleanField(default=True, verbose_name='Доступно')
+    category = models.ForeignKey(
+        Category,
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name='catalog_products',
+        verbose_name='Категория'
+    )
+    image = models.ImageField(blank=True, verbose_name='Изображение')
+    updated = models.DateTimeField(verbose_name='Обновлено')
+    objects = CatalogProductManager()
+
+    class Meta:
+        ordering = ('name',)
+        verbose_name = '- Каталог товаров -'
+        verbose_name_plural = '- Каталог товаров -'
+        unique_together = (('content_type', 'object_id'),)
+        index_together = (('model_name', 'object_id'), ('available', 'name'))
+
+    def __str__(self):
+        return self.name
+
+    def get_model_name(self):
+        return self.model_name
+
+    def get_absolute_url(self):
+        return reverse(viewname='product_detail', kwargs={'ct_model': self.model_name, 'slug': self.slug})
+
+
+
+class SearchToken(models.Model):
+    """ Запись поискового индекса для СУБД без FTS5 (см. search.TokenSearchBackend): основа слова товара
+        и её вес. Поиск по префиксу основы идёт по индексу token
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    token = models.CharField(max_length=64, db_index=True, verbose_name='Основа слова')
+    weight = models.FloatField(verbose_name='Вес')
+
+    class Meta:
+        verbose_name = '- Поисковый индекс -'
+        verbose_name_plural = '- Поисковый индекс -'
+        index_together = (('content_type', 'object_id'),)
+
+    def __str__(self):
+        return self.token
@@ -0,0 +1,140 @@
+import base64
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import QueryDict
+
+
+# Типы значений полей сортировки в курсоре (после json.loads)
+CURSOR_TYPES = (str, int, float, type(None))
+
+
+class KeysetPage:
+    """ Страница списка, полученная поиском по ключу (без OFFSET)
+    """
+
+    def __init__(self, object_list, has_next, has_previous, next_cursor=None, previous_cursor=None, params=None):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.params = params if params is not None else QueryDict(mutable=True)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def _query(self, name, cursor):
+        params = self.params.copy()
+        params[name] = cursor
+        return '?' + params.urlencode()
+
+    @property
+    def next_query(self):
+        """ Строка запроса следующей страницы (с сохранением остальных GET-параметров)
+        """
+        return self._query('after', self.next_cursor) if self.has_next else ''
+
+    @property
+    def previous_query(self):
+        return self._query('before', self.previous_cursor) if self.has_previous else ''
+
+
+
+class KeysetPaginator:
+    """ Постраничный вывод по ключу сортировки (seek pagination).
+        Курсор - значения полей сортировки последней (первой) записи страницы, поэтому глубокие
+        страницы выбираются так же быстро, как первая
+    """
+
+    def __init__(self, queryset, per_page, ordering=('name', 'id')):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = tuple(ordering)
+
+    @staticmethod
+    def _field(order):
+        return order.lstrip('-')
+
+    def encode_cursor(self, obj):
+        values = [getattr(obj, self._field(order)) for order in self.ordering]
+        raw = json.dumps(values, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """ Значения полей сортировки из курсора (ValueError для повреждённого курсора).
+            Курсор приходит из адреса, поэтому принимаем только список скаляров нужной длины
+        """
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except (TypeError, ValueError) as exc:
+            raise ValueError('Invalid cursor') from exc
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise ValueError('Invalid cursor')
+        if any(isinstance(value, bool) or not isinstance(value, CURSOR_TYPES) for value in values):
+            raise ValueError('Invalid cursor')
+        return values
+
+    def _seek(self, values, forward):
+        """ Условие "строго после (до) курсора" для составного ключа сортировки
+        """
+        condition = Q()
+        for index, order in enumerate(self.ordering):
+            descending = order.startswith('-')
+            lookup = 'gt' if forward != descending else 'lt'
+            step = Q(**{'{}__{}'.format(self._field(order), lookup): values[index]})
+            for prev_order, prev_value in zip(self.ordering[:index], values[:index]):
+                step &= Q(**{self._field(prev_order): prev_value})
+            condition |= step
+        return condition
+
+    @staticmethod
+    def _reverse(order):
+        return order[1:] if order.startswith('-') else '-' + order
+
+    def get_page(self, after=None, before=None, params=None):
+        """
+        Страница после курсора after или до курсора before (без курсора - первая страница)
+        :param params: GET-параметры запроса, которые сохраняются в ссылках на соседние страницы
+        """
+        params = params.copy() if params is not None else QueryDict(mutable=True)
+        for name in ('after', 'before'):
+            params.pop(name, None)
+
+        queryset = self.queryset
+        forward = True
+        try:
+            if before:
+                queryset = queryset.filter(self._seek(self.decode_cursor(before), forward=False))
+                forward = False
+            elif after:
+                queryset = queryset.filter(self._seek(self.decode_cursor(after), forward=True))
+        except (TypeError, ValueError):
+            # Повреждённый или подделанный курсор - отдаём первую страницу
+            after = before = None
+            queryset = self.queryset
+            forward = True
+
+        ordering = self.ordering if forward else tuple(self._reverse(order) for order in self.ordering)
+        rows = list(queryset.order_by(*ordering)[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if not forward:
+            rows.reverse()
+
+        if forward:
+            has_next, has_previous = has_more, bool(after)
+        else:
+            has_next, has_previous = True, has_more
+        return KeysetPage(
+            rows,
+            has_next=has_next and bool(rows),
+            has_previous=has_previous and bool(rows),
+            next_cursor=self.encode_cursor(rows[-1]) if rows else None,
+            previous_cursor=self.encode_cursor(rows[0]) if rows else None,
+            params=params,
+        )
@@ -0,0 +1,69 @@
+from django.contrib.contenttypes.models import ContentType
+from django.http import Http404
+
+from .models import (
+    get_product_models,
+    Wobblers, Spoons, WinterFishing, SpinningRods, Libras, DryAdditives, CoilsInertial, Hooks,
+    LineMonofilament, CoilsMulty, Leashes, Floats, SlingShots,
+)
+
+
+# Адрес (slug) подкатегории -> модель товаров этой подкатегории
+CATEGORY_SLUG2PRODUCT_MODEL = {
+    'voblery': Wobblers,
+    'blesny': Spoons,
+    'aksessuary-dlya-zimnej-rybalki': WinterFishing,
+    'spinningovye-udilisha': SpinningRods,
+    'vesy': Libras,
+    'dobavki-suhie': DryAdditives,
+    'inercionnye-katushki': CoilsInertial,
+    'kryuchki': Hooks,
+    'leska-monofilnaya': LineMonofilament,
+    'multiplikatornye-katushki': CoilsMulty,
+    'povodki': Leashes,
+    'poplavki': Floats,
+    'rogatki': SlingShots
+}
+
+
+class ProductRegistry:
+    """ Реестр типов товаров: адрес подкатегории или имя модели (ct_model в URL) -> модель и id типа контента.
+        Заполняется при старте приложения (ShopConfig.ready), дальше все обращения - в памяти
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._content_type_ids = {}
+
+    def build(self):
+        self._models = {model._meta.model_name: model for model in get_product_models()}
+        self._models.update(CATEGORY_SLUG2PRODUCT_MODEL)
+        self._content_type_ids = {}
+
+    @property
+    def models(self):
+        return set(self._models.values())
+
+    def get_model(self, key):
+        """ Модель по адресу подкатегории или имени модели (None, если такой нет)
+        """
+        if not self._models:
+            self.build()
+        return self._models.get(key)
+
+    def get_model_or_404(self, key):
+        model = self.get_model(key)
+        if model is None:
+            raise Http404('Неизвестный тип товара: {}'.format(key))
+        return model
+
+    def get_content_type_id(self, model):
+        """ id типа контента модели; при первом обращении загружаются сразу все типы товаров
+        """
+        if not self._content_type_ids:
+            content_types = ContentType.objects.get_for_models(*self.models)
+            self._content_type_ids = {model: content_type.pk for model, content_type in content_types.items()}
+        return self._content_type_ids[model._meta.concrete_model]
+
+
+registry = ProductRegistry()
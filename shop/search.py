@@ -0,0 +1,362 @@
+import re
+from collections import Counter, defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, connections, DEFAULT_DB_ALIAS, models
+
+from .utils import write_atomic
+
+
+SEARCH_TABLE = 'shop_search_index'
+
+# Веса колонок при ранжировании (bm25): совпадение в названии важнее совпадения в описании
+NAME_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Длина основы в таблице SearchToken
+TOKEN_LENGTH = 64
+
+# Сколько товаров переиндексируется за раз при полной перестройке индекса
+REBUILD_BATCH_SIZE = 500
+
+
+# Стемминг русских слов (упрощённый алгоритм Snowball для русского языка)
+
+VOWELS = 'аеиоуыэюя'
+
+PERFECTIVE_GERUND_RE = re.compile(r'(?:(?<=[ая])(?:в|вши|вшись)|ив|ивши|ившись|ыв|ывши|ывшись)$')
+REFLEXIVE_RE = re.compile(r'(?:ся|сь)$')
+ADJECTIVE_RE = re.compile(
+    r'(?:ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$'
+)
+PARTICIPLE_RE = re.compile(r'(?:(?<=[ая])(?:ем|нн|вш|ющ|щ)|ивш|ывш|ующ)$')
+VERB_RE = re.compile(
+    r'(?:(?<=[ая])(?:ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)|ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|'
+    r'ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)$'
+)
+NOUN_RE = re.compile(
+    r'(?:а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$'
+)
+DERIVATIONAL_RE = re.compile(r'(?:ост|ость)$')
+SUPERLATIVE_RE = re.compile(r'(?:ейше|ейш)$')
+
+
+def _regions(word):
+    """ Области RV и R2 алгоритма Snowball (индексы начала)
+    """
+    rv = r1 = r2 = len(word)
+    for index, char in enumerate(word):
+        if char in VOWELS:
+            rv = index + 1
+            break
+    for index in range(1, len(word)):
+        if word[index] not in VOWELS and word[index - 1] in VOWELS:
+            r1 = index + 1
+            break
+    for index in range(r1 + 1, len(word)):
+        if word[index] not in VOWELS and word[index - 1] in VOWELS:
+            r2 = index + 1
+            break
+    return rv, r2
+
+
+def stem(word):
+    """ Основа русского слова; слова на латинице и числа возвращаются как есть
+    """
+    word = word.lower().replace('ё', 'е')
+    if not re.search('[а-я]', word):
+        return word
+    rv, r2 = _regions(word)
+    head, tail = word[:rv], word[rv:]
+
+    # Шаг 1
+    stripped = PERFECTIVE_GERUND_RE.sub('', tail, count=1)
+    if stripped == tail:
+        tail = REFLEXIVE_RE.sub('', tail, count=1)
+        stripped = ADJECTIVE_RE.sub('', tail, count=1)
+        if stripped != tail:
+            stripped = PARTICIPLE_RE.sub('', stripped, count=1)
+        else:
+            stripped = VERB_RE.sub('', tail, count=1)
+            if stripped == tail:
+                stripped = NOUN_RE.sub('', tail, count=1)
+    tail = stripped
+
+    # Шаг 2
+    if tail.endswith('и'):
+        tail = tail[:-1]
+
+    # Шаг 3
+    match = DERIVATIONAL_RE.search(tail)
+    if match and rv + match.start() >= r2:
+        tail = tail[:match.start()]
+
+    # Шаг 4
+    if tail.endswith('нн'):
+        tail = tail[:-1]
+    else:
+        tail = SUPERLATIVE_RE.sub('', tail, count=1)
+        if tail.endswith('нн'):
+            tail = tail[:-1]
+        elif tail.endswith('ь'):
+            tail = tail[:-1]
+    return head + tail
+
+
+def tokenize(text):
+    """ Основы слов текста для индекса и запросов
+    """
+    return [stem(word) for word in WORD_RE.findall(str(text))]
+
+
+def get_product_document(product):
+    """
+    Текст товара для индекса: название отдельно, остальное - описание, код товара и строковые характеристики
+    :return: (name, body) - уже разбитые на основы слов
+    """
+    body = [product.description, product.product_key]
+    for field in product._meta.concrete_fields:
+        if isinstance(field, models.CharField) and field.name not in ('name', 'slug'):
+            body.append(getattr(product, field.attname) or '')
+    return ' '.join(tokenize(product.name)), ' '.join(tokenize(' '.join(str(part) for part in body)))
+
+
+def get_rowid(content_type_id, object_id):
+    """ rowid записи индекса из пары (тип контента, id товара): удаление и замена без просмотра всей таблицы
+    """
+    return (content_type_id << 32) | object_id
+
+
+class SQLiteSearchBackend:
+    """ Индекс на виртуальной таблице SQLite FTS5 (ранжирование bm25, поиск по префиксу)
+    """
+
+    def __init__(self):
+        self._ready = set()
+
+    def ensure_table(self, using=DEFAULT_DB_ALIAS):
+        """ Таблица создаётся после migrate (create_search_table). Здесь - страховка для баз, созданных раньше:
+            созданной внутри транзакции таблицы после отката уже нет, поэтому готовность запоминается
+            только вне транзакции
+        """
+        connection = connections[using]
+        if using in self._ready:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5('
+                'content_type_id UNINDEXED, object_id UNINDEXED, name, body, '
+                'tokenize="unicode61 remove_diacritics 2")'.format(SEARCH_TABLE)
+            )
+        if not connection.in_atomic_block:
+            self._ready.add(using)
+
+    def index(self, content_type_id, object_id, name, body):
+        self.ensure_table()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM {} WHERE rowid = %s'.format(SEARCH_TABLE), [get_rowid(content_type_id, object_id)]
+            )
+            cursor.execute(
+                'INSERT INTO {} (rowid, content_type_id, object_id, name, body) '
+                'VALUES (%s, %s, %s, %s, %s)'.format(SEARCH_TABLE),
+                [get_rowid(content_type_id, object_id), content_type_id, object_id, name, body]
+            )
+
+    def index_many(self, content_type_id, documents):
+        """ Переиндексация пачки товаров одного типа: documents - список (object_id, name, body)
+        """
+        self.ensure_table()
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'DELETE FROM {} WHERE rowid = %s'.format(SEARCH_TABLE),
+                [(get_rowid(content_type_id, object_id),) for object_id, _, _ in documents]
+            )
+            cursor.executemany(
+                'INSERT INTO {} (rowid, content_type_id, object_id, name, body) '
+                'VALUES (%s, %s, %s, %s, %s)'.format(SEARCH_TABLE),
+                [
+                    (get_rowid(content_type_id, object_id), content_type_id, object_id, name, body)
+                    for object_id, name, body in documents
+                ]
+            )
+
+    def remove(self, content_type_id, object_id):
+        self.ensure_table()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM {} WHERE rowid = %s'.format(SEARCH_TABLE), [get_rowid(content_type_id, object_id)]
+            )
+
+    def clear(self):
+        self.ensure_table()
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM {}'.format(SEARCH_TABLE))
+
+    def search(self, tokens, limit):
+        """ Пары (content_type_id, object_id) в порядке релевантности
+        """
+        self.ensure_table()
+        match = ' AND '.join('"{}"*'.format(token.replace('"', '')) for token in tokens)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT content_type_id, object_id FROM {table} WHERE {table} MATCH %s '
+                'ORDER BY bm25({table}, 0, 0, %s, %s) LIMIT %s'.format(table=SEARCH_TABLE),
+                [match, NAME_WEIGHT, BODY_WEIGHT, limit]
+            )
+            return [(int(content_type_id), int(object_id)) for content_type_id, object_id in cursor.fetchall()]
+
+
+
+class TokenSearchBackend:
+    """ Индекс для СУБД без FTS5: таблица основ слов SearchToken (основа, товар, вес). Запрос - один
+        сгруппированный SELECT по индексу token (поиск по префиксу основы), ранжирование по сумме весов
+    """
+
+    @staticmethod
+    def get_token_weights(name, body):
+        """ Вес основы в товаре: число вхождений с весом колонки (название важнее описания)
+        """
+        weights = Counter()
+        for token in name.split():
+            weights[token[:TOKEN_LENGTH]] += NAME_WEIGHT
+        for token in body.split():
+            weights[token[:TOKEN_LENGTH]] += BODY_WEIGHT
+        return weights
+
+    def index(self, content_type_id, object_id, name, body):
+        self.index_many(content_type_id, [(object_id, name, body)])
+
+    def index_many(self, content_type_id, documents):
+        """ Переиндексация пачки товаров одного типа: documents - список (object_id, name, body)
+        """
+        from .models import SearchToken
+
+        with write_atomic():
+            SearchToken.objects.filter(
+                content_type_id=content_type_id, object_id__in=[object_id for object_id, _, _ in documents]
+            ).delete()
+            SearchToken.objects.bulk_create([
+                SearchToken(content_type_id=content_type_id, object_id=object_id, token=token, weight=weight)
+                for object_id, name, body in documents
+                for token, weight in self.get_token_weights(name, body).items()
+            ], batch_size=1000)
+
+    def remove(self, content_type_id, object_id):
+        from .models import SearchToken
+
+        SearchToken.objects.filter(content_type_id=content_type_id, object_id=object_id).delete()
+
+    def clear(self):
+        from .models import SearchToken
+
+        SearchToken.objects.all().delete()
+
+    def search(self, tokens, limit):
+        """ Пары (content_type_id, object_id) товаров, в которых есть все слова запроса, по убыванию веса
+        """
+        from .models import SearchToken
+
+        condition = models.Q()
+        matched = {}
+        for number, token in enumerate(dict.fromkeys(tokens)):
+            prefix = models.Q(token__startswith=token[:TOKEN_LENGTH])
+            condition |= prefix
+            matched['match_{}'.format(number)] = models.Max(
+                models.Case(models.When(prefix, then=1), default=0, output_field=models.IntegerField())
+            )
+        rows = (
+            SearchToken.objects.filter(condition)
+            .values('content_type_id', 'object_id')
+            .annotate(rank=models.Sum('weight'), **matched)
+            .filter(**dict.fromkeys(matched, 1))
+            .order_by('-rank', 'object_id')[:limit]
+        )
+        return [(row['content_type_id'], row['object_id']) for row in rows]
+
+
+def get_backend():
+    if connection.vendor == 'sqlite':
+        return _sqlite_backend
+    return _token_backend
+
+
+_sqlite_backend = SQLiteSearchBackend()
+_token_backend = TokenSearchBackend()
+
+
+def create_search_table(using=DEFAULT_DB_ALIAS, **kwargs):
+    """ Создаём таблицу FTS5 после migrate (сигнал post_migrate), вне транзакций запросов
+    """
+    if connections[using].vendor == 'sqlite':
+        _sqlite_backend.ensure_table(using)
+
+
+def index_product(product):
+    name, body = get_product_document(product)
+    get_backend().index(ContentType.objects.get_for_model(product).pk, product.pk, name, body)
+
+
+def index_products(model, products):
+    """ Переиндексация пачки товаров одной модели
+    """
+    documents = [(product.pk, *get_product_document(product)) for product in products]
+    if documents:
+        get_backend().index_many(ContentType.objects.get_for_model(model).pk, documents)
+
+
+def remove_product(product):
+    get_backend().remove(ContentType.objects.get_for_model(product).pk, product.pk)
+
+
+def rebuild_index():
+    """ Полная переиндексация всех моделей товаров
+    :return: Колличество проиндексированных товаров
+    """
+    from .models import get_product_models
+
+    backend = get_backend()
+    backend.clear()
+    total = 0
+    for model in get_product_models():
+        content_type_id = ContentType.objects.get_for_model(model).pk
+        documents = []
+        for product in model._base_manager.iterator(chunk_size=REBUILD_BATCH_SIZE):
+            documents.append((product.pk, *get_product_document(product)))
+            if len(documents) == REBUILD_BATCH_SIZE:
+                backend.index_many(content_type_id, documents)
+                total += len(documents)
+                documents = []
+        if documents:
+            backend.index_many(content_type_id, documents)
+            total += len(documents)
+    return total
+
+
+def search_products(query, limit=48):
+    """
+    Поиск товаров по запросу (каждое слово запроса ищется как префикс основы)
+    :return: Список записей сводного каталога в порядке релевантности
+    """
+    from .models import CatalogProduct
+
+    tokens = [token for token in tokenize(query) if token][:10]
+    if not tokens:
+        return []
+    keys = get_backend().search(tokens, limit)
+    if not keys:
+        return []
+
+    ids_by_content_type = defaultdict(set)
+    for content_type_id, object_id in keys:
+        ids_by_content_type[content_type_id].add(object_id)
+    condition = models.Q()
+    for content_type_id, object_ids in ids_by_content_type.items():
+        condition |= models.Q(content_type_id=content_type_id, object_id__in=object_ids)
+    entries = {
+        (entry.content_type_id, entry.object_id): entry
+        for entry in CatalogProduct.objects.filter(condition, available=True).select_related('category')
+    }
+    return [entries[key] for key in keys if key in entries]
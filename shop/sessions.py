@@ -0,0 +1,13 @@
+from django.contrib.sessions.backends import cached_db
+
+from .instrumentation import record_cache
+
+
+class SessionStore(cached_db.SessionStore):
+    """ Сессии из кэша с записью в БД (cached_db), промах кэша сессий учитывается в статистике запроса:
+        сессия читается из БД, и это холодный запрос со своим бюджетом запросов
+    """
+
+    def _get_session_from_db(self):
+        record_cache(False)
+        return super()._get_session_from_db()
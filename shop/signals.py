@@ -0,0 +1,79 @@
+from django.db.models.signals import post_save, post_delete
+
+from .cache import bump_version, CATEGORIES, model_namespace, product_namespace, PRODUCTS
+from .models import CatalogProduct, Category, ParentCategory, get_product_models
+from .search import index_product, remove_product
+from .thumbnails import get_image_models, schedule_thumbnails
+
+
+# Поля каталога, которые выводятся в списках товаров (блок товаров главной): их изменение сбрасывает
+# общее пространство товаров, остальные поля - только пространство самого товара
+LIST_FIELDS = ('name', 'slug', 'price', 'image', 'category_id')
+
+
+def invalidate_product(product, previous=None, listed=True):
+    """
+    Сбрасываем кэш товара (страница и фрагменты, в том числе по прежнему адресу) и фасеты его модели
+    :param previous: Прежние значения полей каталога товара (CatalogProductManager.sync)
+    :param listed: Изменились списки товаров (товар добавлен, удалён или изменились поля LIST_FIELDS) -
+        сбрасываем и общее пространство товаров
+    """
+    model_name = product._meta.model_name
+    slugs = {product.slug, previous['slug'] if previous else product.slug}
+    for slug in slugs:
+        bump_version(product_namespace(model_name, slug))
+    bump_version(model_namespace(model_name))
+    if listed:
+        bump_version(PRODUCTS)
+
+
+def sync_catalog_product(sender, instance, raw=False, **kwargs):
+    """ Обновляем запись сводного каталога, поисковый индекс и кэш товара при сохранении товара
+    """
+    if raw:
+        return
+    previous = CatalogProduct.objects.sync(instance)
+    index_product(instance)
+    data = CatalogProduct.objects.get_product_data(instance)
+    listed = previous is None or any(previous[name] != data[name] for name in LIST_FIELDS)
+    invalidate_product(instance, previous, listed)
+
+
+def remove_catalog_product(sender, instance, **kwargs):
+    """ Удаляем запись сводного каталога и поискового индекса вместе с товаром
+    """
+    CatalogProduct.objects.remove(instance)
+    remove_product(instance)
+    invalidate_product(instance)
+
+
+def invalidate_categories(sender, **kwargs):
+    """ Сбрасываем кэш навигации по категориям и товаров (страницы товаров выводят их подкатегорию)
+    """
+    bump_version(CATEGORIES)
+    bump_version(PRODUCTS)
+
+
+def build_thumbnails(sender, instance, raw=False, **kwargs):
+    """ Строим превью загруженной картинки в фоне (уже готовые превью пропускаются)
+    """
+    if raw:
+        return
+    schedule_thumbnails(instance.image.name)
+
+
+def connect_signals():
+    for model in (Category, ParentCategory):
+        post_save.connect(invalidate_categories, sender=model, dispatch_uid='categories_save_{}'.format(model.__name__))
+        post_delete.connect(
+            invalidate_categories, sender=model, dispatch_uid='categories_delete_{}'.format(model.__name__)
+        )
+
+    for model in get_product_models():
+        post_save.connect(sync_catalog_product, sender=model, dispatch_uid='catalog_sync_{}'.format(model.__name__))
+        post_delete.connect(
+            remove_catalog_product, sender=model, dispatch_uid='catalog_remove_{}'.format(model.__name__)
+        )
+
+    for model in get_image_models():
+        post_save.connect(build_thumbnails, sender=model, dispatch_uid='thumbnails_{}'.format(model.__name__))
@@ -0,0 +1,186 @@
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import send_mail
+from django.db import connections, models, transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import OrderTask
+
+
+logger = logging.getLogger(__name__)
+
+# Задачи, которые ставятся в очередь для каждого нового заказа
+ORDER_TASKS = getattr(settings, 'SHOP_ORDER_TASKS', ['notify_manager', 'notify_customer'])
+
+# Где выполняются задачи: 'thread' - пул потоков процесса сразу после фиксации заказа (упавшие и недоделанные
+# задачи добирает команда run_order_tasks), 'command' - только команда run_order_tasks (как у превью,
+# SHOP_THUMBNAILS_EXECUTOR). 'queue' - прежнее название 'command'
+EXECUTORS = ('thread', 'command', 'queue')
+EXECUTOR = getattr(settings, 'SHOP_ORDER_TASKS_EXECUTOR', 'thread')
+if EXECUTOR not in EXECUTORS:
+    raise ImproperlyConfigured('SHOP_ORDER_TASKS_EXECUTOR: {!r}, допустимо одно из {}'.format(
+        EXECUTOR, ', '.join(EXECUTORS)
+    ))
+WORKERS = getattr(settings, 'SHOP_ORDER_TASKS_WORKERS', 2)
+
+# Повторы с экспоненциальной паузой: RETRY_DELAY * 2 ** (номер попытки - 1) секунд
+MAX_ATTEMPTS = getattr(settings, 'SHOP_ORDER_TASKS_MAX_ATTEMPTS', 5)
+RETRY_DELAY = getattr(settings, 'SHOP_ORDER_TASKS_RETRY_DELAY', 30)
+
+# Через сколько минут задача в статусе "выполняется" считается брошенной (процесс упал) и возвращается в очередь
+STALE_MINUTES = getattr(settings, 'SHOP_ORDER_TASKS_STALE_MINUTES', 15)
+
+# Адреса менеджеров для уведомлений о заказах
+MANAGER_EMAILS = getattr(settings, 'SHOP_MANAGER_EMAILS', [email for _, email in getattr(settings, 'MANAGERS', [])])
+
+_handlers = {}
+_executor = None
+
+
+def order_task(name):
+    """ Регистрируем обработчик задачи заказа: функция (order, task) -> None
+    """
+    def decorator(func):
+        _handlers[name] = func
+        return func
+    return decorator
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='order-tasks')
+    return _executor
+
+
+def enqueue_order_tasks(order, names=None):
+    """
+    Ставим задачи заказа в очередь. Строки задач пишутся в текущей транзакции одним INSERT (повторная
+    постановка той же задачи для того же заказа игнорируется по ключу идемпотентности), а выполнение
+    начинается только после фиксации транзакции
+    :param order: Заказ
+    :param names: Имена задач (по умолчанию SHOP_ORDER_TASKS)
+    """
+    names = ORDER_TASKS if names is None else names
+    OrderTask.objects.bulk_create(
+        [OrderTask(order=order, name=name, key='order-{}:{}'.format(order.pk, name)) for name in names],
+        ignore_conflicts=True
+    )
+    if EXECUTOR == 'thread' and names:
+        order_id = order.pk
+        transaction.on_commit(lambda: get_executor().submit(_run_in_thread, order_id))
+
+
+def _run_in_thread(order_id):
+    try:
+        run_pending_tasks(order_id=order_id)
+    except Exception:
+        logger.exception('Задачи заказа %s не выполнены', order_id)
+    finally:
+        connections.close_all()
+
+
+def _claim(task_id, now):
+    """ Забираем задачу себе условным UPDATE: параллельный исполнитель её уже не получит
+    """
+    return OrderTask.objects.filter(
+        pk=task_id, status=OrderTask.STATUS_PENDING, run_after__lte=now
+    ).update(status=OrderTask.STATUS_RUNNING, attempts=models.F('attempts') + 1, updated=now)
+
+
+def run_task(task):
+    """
+    Выполняем задачу. При ошибке задача возвращается в очередь с паузой RETRY_DELAY * 2 ** (попытка - 1)
+    секунд, после MAX_ATTEMPTS попыток помечается как ошибочная
+    :return: True, если задача выполнена, False - если упала, None - если её уже забрал другой исполнитель
+    """
+    now = timezone.now()
+    if not _claim(task.pk, now):
+        return None
+    task.attempts += 1
+    try:
+        handler = _handlers[task.name]
+        handler(task.order, task)
+    except Exception:
+        error = traceback.format_exc()
+        logger.warning('Задача %s, попытка %s: %s', task.key, task.attempts, error)
+        if task.attempts >= MAX_ATTEMPTS:
+            status, run_after = OrderTask.STATUS_FAILED, now
+        else:
+            status = OrderTask.STATUS_PENDING
+            run_after = now + timedelta(seconds=RETRY_DELAY * 2 ** (task.attempts - 1))
+        OrderTask.objects.filter(pk=task.pk).update(
+            status=status, run_after=run_after, last_error=error, updated=timezone.now()
+        )
+        return False
+    OrderTask.objects.filter(pk=task.pk).update(status=OrderTask.STATUS_DONE, last_error='', updated=timezone.now())
+    return True
+
+
+def release_stale_tasks():
+    """ Возвращаем в очередь задачи, зависшие в статусе "выполняется"
+    """
+    return OrderTask.objects.filter(
+        status=OrderTask.STATUS_RUNNING, updated__lt=timezone.now() - timedelta(minutes=STALE_MINUTES)
+    ).update(status=OrderTask.STATUS_PENDING)
+
+
+def run_pending_tasks(order_id=None, limit=None):
+    """
+    Выполняем задачи, срок которых наступил
+    :param order_id: Только задачи этого заказа
+    :param limit: Не больше limit задач за вызов
+    :return: (выполнено, с ошибкой)
+    """
+    tasks = OrderTask.objects.filter(
+        status=OrderTask.STATUS_PENDING, run_after__lte=timezone.now()
+    ).select_related('order__customer__user', 'order__cart').order_by('run_after', 'pk')
+    if order_id is not None:
+        tasks = tasks.filter(order_id=order_id)
+    if limit:
+        tasks = tasks[:limit]
+    done = failed = 0
+    for task in tasks:
+        result = run_task(task)
+        if result:
+            done += 1
+        elif result is False:
+            failed += 1
+    return done, failed
+
+
+# Встроенные задачи
+
+@order_task('notify_manager')
+def notify_manager(order, task):
+    """ Письмо менеджерам о новом заказе
+    """
+    if not MANAGER_EMAILS:
+        return
+    send_mail(
+        'Новый заказ №{}'.format(order.pk),
+        render_to_string('shop/email/order_manager.txt', {'order': order}),
+        None,
+        MANAGER_EMAILS,
+    )
+
+
+@order_task('notify_customer')
+def notify_customer(order, task):
+    """ Подтверждение заказа покупателю
+    """
+    email = order.customer.user.email
+    if not email:
+        return
+    send_mail(
+        'Ваш заказ №{} принят'.format(order.pk),
+        render_to_string('shop/email/order_customer.txt', {'order': order}),
+        None,
+        [email],
+    )
@@ -0,0 +1,40 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from shop.cache import get_fragment
+
+
+register = template.Library()
+
+
+class CachedFragmentNode(template.Node):
+
+    def __init__(self, nodelist, parts, product=None):
+        self.nodelist = nodelist
+        self.parts = parts
+        self.product = product
+
+    def render(self, context):
+        parts = [part.resolve(context) for part in self.parts]
+        product = self.product.resolve(context) if self.product is not None else None
+        return mark_safe(get_fragment(parts, lambda: self.nodelist.render(context), product=product))
+
+
+@register.tag
+def cached_fragment(parser, token):
+    """
+    Кэширует HTML блока до изменения товаров (или мягкого срока), перестраивает его один воркер.
+    С "for товар" блок сбрасывается только при изменении этого товара (и общих изменениях каталога).
+    Блок не должен зависеть от пользователя (корзина, CSRF-токен)
+    Пример: {% cached_fragment 'product_detail' ct_model for product %} ... {% endcached_fragment %}
+    """
+    bits = token.split_contents()
+    product = None
+    if len(bits) > 2 and bits[-2] == 'for':
+        product = parser.compile_filter(bits[-1])
+        bits = bits[:-2]
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError('{} ожидает хотя бы одну часть ключа'.format(bits[0]))
+    nodelist = parser.parse(('endcached_fragment',))
+    parser.delete_first_token()
+    return CachedFragmentNode(nodelist, [parser.compile_filter(bit) for bit in bits[1:]], product)
@@ -1,6 +1,13 @@
+import threading
+from collections import OrderedDict
+
 from django import template
+from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
 
+from shop.models import Product
+from shop.registry import registry
+
 
 register = template.Library()
 
@@ -22,45 +29,70 @@ TABLE_CONTENT = """
                     </tr>
                 """
 
-#TODO Сделать для остальных категорий
-# Словари с названиями характеристик товаров
-PRODUCT_SPEC = {
-    'wobblers': {
-        'Вес': 'weight',
-        'Длинна': 'long',
-        'Тип ловли': 'type_of_fishing',
-        'Плавучесть': 'deepening',
-        'Защита от зацепов': 'snag_protection',
-        'Система дальнего заброса': 'long_distance_casting_system',
-        'Страна производитель': 'manufacturer_country',
-        'Тип плавучести': 'type_of_buoyancy',
-        'Тип': 'type',
-        'Шумовые эффекты': 'noise_effects',
-    },
-    'spoons': {
-        'Вес': 'weight',
-        'Длинна': 'long',
-        'Тип ловли': 'type_of_fishing',
-        'Защита от зацепов': 'snag_protection',
-        'Система дальнего заброса': 'long_distance_casting_system',
-        'Страна производитель': 'manufacturer_country',
-        'Тип': 'type',
-    },
+# Поля, которые не выводятся в характеристиках: общие поля товара, связи и изображения
+EXCLUDED_FIELDS = {field.name for field in Product._meta.fields} | {'id', 'category', 'image'}
+
+# Сколько готовых таблиц держим в памяти процесса
+SPEC_CACHE_SIZE = 2048
+
+
+class SpecTable:
+    """ Заранее собранная таблица характеристик модели: список полей и шаблон всей таблицы,
+        в который подставляются значения одним вызовом format
+    """
+
+    def __init__(self, model):
+        self.attnames = []
+        rows = []
+        for field in model._meta.concrete_fields:
+            if field.name in EXCLUDED_FIELDS or field.is_relation:
+                continue
+            name = conditional_escape(str(field.verbose_name)).replace('{', '{{').replace('}', '}}')
+            rows.append(TABLE_CONTENT.format(name=name, value='{%d}' % len(self.attnames)))
+            self.attnames.append(field.attname)
+        self.template = ''.join([TABLE_HEAD, *rows, TABLE_TAIL])
+
+    def render(self, product):
+        return self.template.format(*[conditional_escape(getattr(product, attname)) for attname in self.attnames])
+
+
+# Таблицы характеристик всех моделей товаров, собираются один раз при загрузке модуля
+SPEC_TABLES = {
+    model._meta.model_name: SpecTable(model) for model in registry.models
 }
 
+# Готовый HTML таблиц (LRU). Общий для потоков процесса (многопоточный WSGI, пул асинхронных представлений),
+# поэтому изменяется только под блокировкой
+_rendered = OrderedDict()
+_rendered_lock = threading.Lock()
+
 
 def get_product_spec(product, model_name):
     """
-    Достаём характеристики товара из PRODUCT_SPEC и записываем их в тело таблицы характеристик TABLE_CONTENT
+    Заполненная таблица характеристик товара. Готовый HTML кэшируется по (модель, pk, дата обновления),
+    поэтому повторный вывод неизменённого товара - это одно обращение к словарю. Таблица собирается
+    вне блокировки: два потока могут одновременно собрать одну и ту же, результат одинаковый
     :param product: Наименование объекта в models.py
     :param model_name: Наименование товара в БД
-    :return: table_content - заполненное тело таблицы характеристик
+    :return: HTML таблицы характеристик
     """
-    table_content = ''
-    for name, value in PRODUCT_SPEC[model_name].items():
-        table_content += TABLE_CONTENT.format(name=name, value=getattr(product, value))
+    key = (model_name, product.pk, getattr(product, 'updated', None))
+    with _rendered_lock:
+        html = _rendered.get(key)
+        if html is not None:
+            _rendered.move_to_end(key)
+            return html
 
-    return table_content
+    spec_table = SPEC_TABLES.get(model_name)
+    if spec_table is None:
+        spec_table = SPEC_TABLES.setdefault(model_name, SpecTable(product.__class__))
+    html = spec_table.render(product)
+    with _rendered_lock:
+        _rendered[key] = html
+        _rendered.move_to_end(key)
+        while len(_rendered) > SPEC_CACHE_SIZE:
+            _rendered.popitem(last=False)
+    return html
 
 
 @register.filter
@@ -68,10 +100,10 @@ def product_spec(product):
     """
     Генерируем готовую таблицу характеристик для определенного продукта
     :param product:  Наименование объекта в models.py
-    :return: Заполненная таблица ГОЛОВА + ТЕЛО + ХВОСТ (Тело генерируется в функции get_product_spec, хвост и голова
-             берутся из шаблонов TABLE_HEAD и TABLE_TAIL)
+    :return: Заполненная таблица ГОЛОВА + ТЕЛО + ХВОСТ (строки характеристик берутся из метаданных полей модели
+             в SpecTable, готовый HTML кэшируется в get_product_spec)
              Функция mark_safe представляет передаваемый текст как html код. Без неё на странице выведется
              текст с тегами
     """
     model_name = product.__class__._meta.model_name
-    return mark_safe(TABLE_HEAD + get_product_spec(product, model_name) + TABLE_TAIL)
\ No newline at end of file
+    return mark_safe(get_product_spec(product, model_name))
@@ -0,0 +1,37 @@
+from django import template
+from django.forms.utils import flatatt
+from django.utils.html import format_html
+
+from shop.thumbnails import FALLBACK, get_thumbnail_urls, WEBP
+
+
+register = template.Library()
+
+
+@register.simple_tag
+def thumbnail(image, rendition, **attrs):
+    """
+    Картинка в размере rendition: <picture> с WebP и запасным JPEG. Превью только берутся готовые
+    (их строит пул потоков при загрузке или команда build_thumbnails), пока их нет - выводится оригинал
+    Пример: {% thumbnail el.image 'card' width=400 height=132 class='card-img-top' alt=el.name %}
+    """
+    urls = get_thumbnail_urls(image, rendition)
+    if not urls:
+        return ''
+    attrs.setdefault('alt', '')
+    if None in urls:
+        return format_html('<img src="{}"{}>', urls[None], flatatt(attrs))
+    if WEBP not in urls:
+        return format_html('<img src="{}"{}>', urls[FALLBACK], flatatt(attrs))
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}"><img src="{}"{}></picture>',
+        urls[WEBP], urls[FALLBACK], flatatt(attrs)
+    )
+
+
+@register.simple_tag
+def thumbnail_url(image, rendition):
+    """ Адрес превью в запасном формате (или оригинала, если превью ещё нет)
+    """
+    urls = get_thumbnail_urls(image, rendition)
+    return urls.get(FALLBACK) or urls.get(None, '')
@@ -0,0 +1,53 @@
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+
+from .instrumentation import get_query_budget
+
+
+def format_queries(captured_queries):
+    return '\n'.join(
+        '{}. {}'.format(number, query['sql']) for number, query in enumerate(captured_queries, 1)
+    )
+
+
+def assert_query_budget(client, path, method='get', budget=None, using='default', warmup=False, cold=False,
+                        exact=False, **kwargs):
+    """
+    Выполняем запрос тестовым клиентом и проверяем, что представление уложилось в свой бюджет запросов к БД
+    (query_budget класса представления или явно переданный budget). Для тестов: новый N+1 в шаблоне
+    или миксине ломает сборку
+    :param client: django.test.Client (уже авторизованный, с наполненной корзиной и т.п.)
+    :param path: Адрес запроса
+    :param method: Метод клиента: get, post, ...
+    :param warmup: Сначала выполнить запрос без подсчёта (бюджеты заданы для прогретого кэша)
+    :param cold: Проверять бюджет холодного запроса (cold_query_budget)
+    :param exact: Запросов должно быть ровно столько, сколько в бюджете: бюджет - реальное число запросов,
+        а не запас сверху, и его нужно уменьшить вместе с оптимизацией
+    :return: Ответ
+    :raise AssertionError: запросов больше бюджета (в тексте ошибки - все выполненные запросы)
+    """
+    if budget is None:
+        budget = get_query_budget(resolve(path.split('?', 1)[0]).func, cold=cold)
+        if budget is None:
+            raise AssertionError('У представления {} не задан query_budget'.format(path))
+    if warmup:
+        getattr(client, method)(path, **kwargs)
+    with CaptureQueriesContext(connections[using]) as context:
+        response = getattr(client, method)(path, **kwargs)
+    count = len(context.captured_queries)
+    if count > budget or exact and count != budget:
+        raise AssertionError('{} {}: {} запросов к БД при бюджете {}\n{}'.format(
+            method.upper(), path, count, budget, format_queries(context.captured_queries)
+        ))
+    return response
+
+
+class QueryBudgetMixin:
+    """ Примесь к TestCase: self.assertQueryBudget(path, ...) - см. assert_query_budget
+    """
+
+    def assertQueryBudget(self, path, method='get', budget=None, warmup=False, cold=False, exact=False, **kwargs):
+        return assert_query_budget(
+            self.client, path, method=method, budget=budget, warmup=warmup, cold=cold, exact=exact, **kwargs
+        )
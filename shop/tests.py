@@ -1,3 +1,1931 @@
-from django.test import TestCase
+import asyncio
+import base64
+import importlib
+import importlib.util
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from contextlib import contextmanager
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+
+from django.contrib import messages
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured, SynchronousOnlyOperation
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, connections, transaction
+from django.http import QueryDict
+from django.test import Client, override_settings, RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches, resolve, reverse
+from django.utils import timezone
+
+import fishing_shop.urls
+from fishing_shop.routers import ReplicaRouter
+from fishing_shop.sqlite.base import DatabaseWrapper
+
+from . import async_views, inventory, search, tasks, thumbnails, urls
+from .bulk import bulk_edit_products, PRICE_PERCENT, STOCK_DELTA
+from .cache import (
+    _add_version, _version_key, bump_version, CachedValue, CATALOG_CACHE, CATEGORIES, check_shared_caches,
+    FRAGMENTS_CACHE, get_cache, get_or_build, get_version, make_key, model_namespace, product_namespace, PRODUCTS,
+)
+from .catalog_io import CatalogImporter, export_rows, read_rows, write_rows
+from .cart import CART_SESSION_KEY, CART_STATE_TTL, CartService, GUEST_CART_COOKIE, GuestCartFull
+from .facets import FacetFilter
+from .pagination import KeysetPaginator
+from .forms import OrderForm
+from .registry import registry
+from .testing import QueryBudgetMixin
+from .inventory import atomic_with_retry, commit_cart_stock, decrement_stock, increment_stock, InsufficientStock
+from .models import (
+    Cart, CartProduct, CatalogProduct, Category, Customer, Order, OrderTask, ParentCategory, SearchToken, Spoons,
+    StockReservation, Wobblers,
+)
+from .templatetags import specifications
+from .templatetags.specifications import get_product_spec, product_spec
+from .utils import (
+    add_cart_product, apply_cart_delta, change_cart_product_qty, get_product_content_key, merge_cart_products,
+    recalc_cart, remove_cart_product, write_atomic,
+)
+from .views import CartAlreadyOrdered, CartView, MakeOrderView
+
+
+def create_category(slug='voblery', name='Воблеры'):
+    parent, _ = ParentCategory.objects.get_or_create(slug='primanki', defaults={'name': 'Приманки'})
+    return Category.objects.create(category=parent, name=name, slug=slug)
+
+
+def create_wobbler(category, name, slug, description='', price=100, stock=10, **kwargs):
+    fields = dict(
+        product_key=1, weight=10, long=90, type_of_fishing='Спиннинг', deepening=1.5, manufacturer_country='Япония',
+        type_of_buoyancy='Плавающий', type='Минноу',
+    )
+    fields.update(kwargs)
+    return Wobblers.objects.create(
+        category=category, name=name, slug=slug, description=description, price=price, stock=stock, **fields
+    )
+
+
+def create_cart(username, *lines):
+    """ Корзина нового покупателя с товарами: lines - пары (товар, колличество)
+    """
+    user = User.objects.create_user(username, password='password')
+    cart = Cart.objects.create(owner=Customer.objects.create(user=user))
+    for product, qty in lines:
+        add_cart_product(cart, product, qty)
+    return cart
+
+
+def run_concurrently(func, args_list):
+    """
+    Выполняем func одновременно в нескольких потоках (по потоку на набор аргументов)
+    :return: (результаты, исключения) - в порядке завершения
+    """
+    barrier = threading.Barrier(len(args_list))
+    results, errors = [], []
+
+    def run(*args):
+        try:
+            barrier.wait()
+            results.append(func(*args))
+        except Exception as error:
+            errors.append(error)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=run, args=args) for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    if any(thread.is_alive() for thread in threads):
+        raise AssertionError('Потоки не завершились за минуту (взаимная блокировка?)')
+    return results, errors
+
+
+def create_spoon(category, name, slug, description='', price=100, stock=10):
+    return Spoons.objects.create(
+        category=category, name=name, slug=slug, description=description, price=price, stock=stock, product_key=2,
+        weight=12, long=50, type_of_fishing='Спиннинг', manufacturer_country='Россия', type='Колебалка',
+    )
+
+
+
+class SearchBackendTestsMixin:
+    """ Общие тесты поиска для обоих бэкендов индекса (FTS5 и таблица основ)
+    """
+    backend = None
+
+    def setUp(self):
+        patcher = mock.patch.object(search, 'get_backend', return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        wobblers = create_category()
+        spoons = create_category('blesny', 'Блесны')
+        self.wobbler = create_wobbler(wobblers, 'Воблер Kosadaka Ghost', 'kosadaka-ghost', 'Плавающий, для щуки')
+        self.perch_wobbler = create_wobbler(wobblers, 'Воблер Jackall Chubby', 'jackall-chubby', 'Для окуня')
+        self.spoon = create_spoon(spoons, 'Блесна Mepps Aglia', 'mepps-aglia', 'Ловит там, где воблеры бесполезны')
+
+    def search(self, query):
+        return [(entry.model_name, entry.slug) for entry in search.search_products(query)]
+
+    def test_stemming(self):
+        """ Словоформа запроса находит товар с другой формой слова
+        """
+        self.assertIn(('wobblers', 'kosadaka-ghost'), self.search('воблеры'))
+        self.assertEqual(self.search('щука'), [('wobblers', 'kosadaka-ghost')])
+
+    def test_prefix(self):
+        self.assertEqual(self.search('kosad'), [('wobblers', 'kosadaka-ghost')])
+        self.assertEqual(self.search('блес'), [('spoons', 'mepps-aglia')])
+
+    def test_all_words_required(self):
+        self.assertEqual(self.search('воблер окунь'), [('wobblers', 'jackall-chubby')])
+        self.assertEqual(self.search('блесна щука'), [])
+
+    def test_ranking(self):
+        """ Совпадение в названии выше совпадения в описании
+        """
+        results = self.search('воблер')
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[-1], ('spoons', 'mepps-aglia'))
+
+    def test_reindex_and_remove(self):
+        self.wobbler.name = 'Воблер Megabass Vision'
+        self.wobbler.save()
+        self.assertEqual(self.search('kosadaka'), [])
+        self.assertEqual(self.search('megabass'), [('wobblers', 'kosadaka-ghost')])
+
+        self.spoon.delete()
+        self.assertEqual(self.search('блесна'), [])
+
+    def test_rebuild(self):
+        self.backend.clear()
+        self.assertEqual(self.search('воблер'), [])
+        self.assertEqual(search.rebuild_index(), 3)
+        self.assertEqual(len(self.search('воблер')), 3)
+
+
+
+class SQLiteSearchTests(SearchBackendTestsMixin, TestCase):
+    backend = search._sqlite_backend
+
+
+
+class TokenSearchTests(SearchBackendTestsMixin, TestCase):
+    backend = search._token_backend
+
+    def test_index_rows(self):
+        """ Одна строка индекса на основу слова товара, вес названия больше веса описания
+        """
+        tokens = dict(
+            SearchToken.objects.filter(object_id=self.wobbler.pk, content_type__model='wobblers')
+            .values_list('token', 'weight')
+        )
+        self.assertEqual(tokens['воблер'], search.NAME_WEIGHT)
+        self.assertEqual(tokens['щук'], search.BODY_WEIGHT)
+
+
+
+class ProductSpecTests(TestCase):
+
+    def setUp(self):
+        self.wobbler = create_wobbler(create_category(), 'Воблер <b>Ghost</b>', 'ghost', type='Минноу & Шэд')
+        specifications._rendered.clear()
+        self.addCleanup(specifications._rendered.clear)
+
+    def test_spec_table(self):
+        html = product_spec(self.wobbler)
+        self.assertIn('Тип ловли', html)
+        self.assertIn('Минноу &amp; Шэд', html)
+        self.assertNotIn('Описание', html)
+
+    def test_spec_table_metadata(self):
+        """ Строки таблицы - собственные поля модели товара в порядке объявления, с подписями verbose_name
+        """
+        self.assertEqual(set(specifications.SPEC_TABLES), {model._meta.model_name for model in registry.models})
+        for model in registry.models:
+            with self.subTest(model=model.__name__):
+                fields = [
+                    field for field in model._meta.concrete_fields
+                    if field.name not in specifications.EXCLUDED_FIELDS and not field.is_relation
+                ]
+                spec_table = specifications.SPEC_TABLES[model._meta.model_name]
+                self.assertEqual(spec_table.attnames, [field.attname for field in fields])
+                self.assertEqual(
+                    re.findall(r'<td>([^<{]+)</td>', spec_table.template), [str(field.verbose_name) for field in fields]
+                )
+                for excluded in ('name', 'price', 'description', 'category', 'image', 'id'):
+                    self.assertNotIn(excluded, spec_table.attnames)
+
+    def test_values_are_not_format_fields(self):
+        self.wobbler.type = '{0} {attnames} <i>'
+        html = specifications.SpecTable(Wobblers).render(self.wobbler)
+        self.assertIn('<td>{0} {attnames} &lt;i&gt;</td>', html)
+
+    def test_cached_by_update_time(self):
+        spec_table = specifications.SPEC_TABLES['wobblers']
+        with mock.patch.object(spec_table, 'render', wraps=spec_table.render) as render:
+            first = get_product_spec(self.wobbler, 'wobblers')
+            self.assertIs(get_product_spec(self.wobbler, 'wobblers'), first)
+            self.assertEqual(render.call_count, 1)
+            # Сохранённый товар получает новую дату обновления - таблица собирается заново
+            self.wobbler.type = 'Крэнк'
+            self.wobbler.save()
+            self.assertIn('Крэнк', get_product_spec(self.wobbler, 'wobblers'))
+            self.assertEqual(render.call_count, 2)
+
+    @mock.patch.object(specifications, 'SPEC_CACHE_SIZE', 2)
+    def test_lru_eviction(self):
+        first, second, third = [Wobblers(pk=pk, **{
+            field.attname: getattr(self.wobbler, field.attname)
+            for field in Wobblers._meta.concrete_fields if field.attname != 'id'
+        }) for pk in (101, 102, 103)]
+        for product in (first, second, first, third):
+            get_product_spec(product, 'wobblers')
+        # Недавно выведенная таблица первого товара остаётся, вытесняется второй
+        self.assertEqual([key[1] for key in specifications._rendered], [101, 103])
+
+    def test_lru_under_threads(self):
+        """ Кэш таблиц не превышает размер и не ломается при одновременном выводе из нескольких потоков
+        """
+        products = [Wobblers(pk=number, **{
+            field.attname: getattr(self.wobbler, field.attname)
+            for field in Wobblers._meta.concrete_fields if field.attname != 'id'
+        }) for number in range(1, 200)]
+
+        def render():
+            for product in products:
+                self.assertIn('Тип ловли', get_product_spec(product, 'wobblers'))
+
+        with mock.patch.object(specifications, 'SPEC_CACHE_SIZE', 50):
+            threads = [threading.Thread(target=render) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertLessEqual(len(specifications._rendered), 50)
+
+
+
+class CatalogSyncTests(TestCase):
+
+    def setUp(self):
+        self.category = create_category()
+        self.wobbler = create_wobbler(self.category, 'Воблер A', 'wobbler-a', price=100)
+        self.spoon = create_spoon(create_category('blesny', 'Блёсны'), 'Блесна', 'blesna')
+
+    def assertCatalog(self, *products):
+        """ В каталоге ровно записи этих товаров с их текущими полями
+        """
+        fields = ('model_name', 'object_id', 'name', 'slug', 'price', 'stock', 'available', 'category_id')
+        expected = []
+        for product in products:
+            product.refresh_from_db()
+            data = CatalogProduct.objects.get_product_data(product)
+            expected.append(tuple(product.pk if field == 'object_id' else data[field] for field in fields))
+        self.assertEqual(sorted(CatalogProduct.objects.values_list(*fields)), sorted(expected))
+
+    def test_signal_sync(self):
+        self.assertCatalog(self.wobbler, self.spoon)
+        entry_pk = CatalogProduct.objects.get(model_name='wobblers').pk
+        self.wobbler.name, self.wobbler.price, self.wobbler.available = 'Воблер B', 150, False
+        self.wobbler.save()
+        self.assertCatalog(self.wobbler, self.spoon)
+        self.assertEqual(CatalogProduct.objects.get(model_name='wobblers').pk, entry_pk)
+        self.spoon.delete()
+        self.assertCatalog(self.wobbler)
+
+    def test_sync_many(self):
+        # Массовые изменения проходят мимо сигналов
+        Wobblers.objects.filter(pk=self.wobbler.pk).update(price=300, stock=1)
+        created = Wobblers.objects.bulk_create([
+            Wobblers(
+                category=self.category, name='Воблер {}'.format(num), slug='wobbler-{}'.format(num), price=num,
+                stock=num, product_key=num, weight=10, long=90, type_of_fishing='Спиннинг', deepening=1.5,
+                manufacturer_country='Япония', type_of_buoyancy='Плавающий', type='Минноу',
+            )
+            for num in range(1, 4)
+        ])
+        products = [self.wobbler, *Wobblers.objects.filter(slug__in=[product.slug for product in created])]
+        for product in products:
+            product.refresh_from_db()
+        # SELECT существующих записей, UPDATE (executemany) и INSERT новых
+        with self.assertNumQueries(3):
+            CatalogProduct.objects.sync_many(Wobblers, products)
+        self.assertCatalog(*products, self.spoon)
+
+    def test_rebuild(self):
+        entry_pk = CatalogProduct.objects.get(model_name='wobblers').pk
+        # Каталог разошёлся с товарами: изменение мимо сигналов, потерянная запись и запись удалённого товара
+        Wobblers.objects.filter(pk=self.wobbler.pk).update(name='Воблер C', stock=3)
+        other = create_wobbler(self.category, 'Воблер B', 'wobbler-b')
+        CatalogProduct.objects.filter(model_name='wobblers', object_id=other.pk).delete()
+        removed = create_spoon(self.spoon.category, 'Блесна B', 'blesna-b')
+        orphan = CatalogProduct.objects.get(model_name='spoons', object_id=removed.pk)
+        removed.delete()
+        orphan.save(force_insert=True)
+        for batch_size in (500, 1):
+            with self.subTest(batch_size=batch_size):
+                self.assertEqual(CatalogProduct.objects.rebuild(batch_size=batch_size), 3)
+                self.assertCatalog(self.wobbler, other, self.spoon)
+                # Записи обновляются на месте, а не пересоздаются
+                entry = CatalogProduct.objects.get(model_name='wobblers', object_id=self.wobbler.pk)
+                self.assertEqual(entry.pk, entry_pk)
+
+    def test_rebuild_rolls_back(self):
+        Wobblers.objects.filter(pk=self.wobbler.pk).update(name='Воблер C')
+        before = list(CatalogProduct.objects.order_by('pk').values())
+        sync_many = CatalogProduct.objects.sync_many
+
+        def failing_sync_many(model, products, **kwargs):
+            if model is Spoons:
+                raise RuntimeError('сбой')
+            return sync_many(model, products, **kwargs)
+
+        with mock.patch.object(CatalogProduct.objects, 'sync_many', failing_sync_many):
+            with self.assertRaises(RuntimeError):
+                CatalogProduct.objects.rebuild()
+        self.assertEqual(list(CatalogProduct.objects.order_by('pk').values()), before)
+
+
+class CatalogCacheTests(TestCase):
+
+    def setUp(self):
+        for alias in ('catalog', 'fragments'):
+            caches[alias].clear()
+        self.category = create_category()
+        self.wobbler = create_wobbler(self.category, 'Воблер A', 'wobbler-a', price=100)
+        self.other = create_wobbler(self.category, 'Воблер B', 'wobbler-b', price=200)
+        self.spoon = create_spoon(create_category('blesny', 'Блёсны'), 'Блесна', 'blesna')
+
+    # Кэшированные данные и пространства их ключей
+    ENTRIES = {
+        'main_page': PRODUCTS,
+        'wobbler-a': [PRODUCTS, product_namespace('wobblers', 'wobbler-a')],
+        'wobbler-b': [PRODUCTS, product_namespace('wobblers', 'wobbler-b')],
+        'wobblers_facets': [PRODUCTS, model_namespace('wobblers')],
+        'spoons_facets': [PRODUCTS, model_namespace('spoons')],
+    }
+
+    def get_keys(self):
+        return {name: make_key(namespaces) for name, namespaces in self.ENTRIES.items()}
+
+    @contextmanager
+    def assertInvalidated(self, *names):
+        """ После блока сменились ключи ровно этих данных из ENTRIES
+        """
+        before = self.get_keys()
+        yield
+        after = self.get_keys()
+        self.assertEqual({name for name in self.ENTRIES if before[name] != after[name]}, set(names))
+
+    def test_product_save_keeps_lists(self):
+        with self.assertInvalidated('wobbler-a', 'wobblers_facets'):
+            self.wobbler.stock = 3
+            self.wobbler.description = 'Новое описание'
+            self.wobbler.save()
+
+    def test_list_field_change(self):
+        with self.assertInvalidated(*self.ENTRIES):
+            self.wobbler.price = 150
+            self.wobbler.save()
+
+    def test_slug_change_invalidates_old_address(self):
+        new_key = make_key([PRODUCTS, product_namespace('wobblers', 'wobbler-new')])
+        with self.assertInvalidated(*self.ENTRIES):
+            self.wobbler.slug = 'wobbler-new'
+            self.wobbler.save()
+        self.assertNotEqual(make_key([PRODUCTS, product_namespace('wobblers', 'wobbler-new')]), new_key)
+
+    def test_create_and_delete(self):
+        with self.assertInvalidated(*self.ENTRIES):
+            create_wobbler(self.category, 'Воблер C', 'wobbler-c')
+        with self.assertInvalidated(*self.ENTRIES):
+            self.spoon.delete()
+
+    def test_category_change(self):
+        categories = get_version(CATEGORIES)
+        with self.assertInvalidated(*self.ENTRIES):
+            self.category.name = 'Воблеры и крэнки'
+            self.category.save()
+        self.assertNotEqual(get_version(CATEGORIES), categories)
+
+    def test_product_pages(self):
+        first, second = [
+            reverse('product_detail', kwargs={'ct_model': 'wobblers', 'slug': slug})
+            for slug in ('wobbler-a', 'wobbler-b')
+        ]
+        self.client.get(first)
+        self.client.get(second)
+        self.wobbler.description = 'Новое описание'
+        self.wobbler.save()
+        self.assertContains(self.client.get(first), 'Новое описание')
+        # Страница другого товара осталась в кэше
+        with self.assertNumQueries(0):
+            self.client.get(second)
+
+    def test_versions(self):
+        version = get_version('test')
+        self.assertEqual(get_version('test'), version)
+        bumped = bump_version('test')
+        self.assertNotEqual(bumped, version)
+        self.assertEqual(get_version('test'), bumped)
+        # Вытесненный ключ версии не возвращает старую версию
+        get_cache().delete('shop:version:test')
+        self.assertNotIn(get_version('test'), (version, bumped))
+
+    @contextmanager
+    def use_cache(self, backend):
+        if backend == 'file':
+            location = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, location)
+            cache = FileBasedCache(location, {})
+        else:
+            cache = get_cache()
+        with mock.patch('shop.cache.get_cache', return_value=cache):
+            yield cache
+
+    def test_concurrent_bumps(self):
+        for backend in ('locmem', 'file'):
+            with self.subTest(backend=backend), self.use_cache(backend):
+                version = get_version('test')
+                results, errors = run_concurrently(bump_version, [('test',)] * 8)
+                self.assertEqual(errors, [])
+                self.assertIn(get_version('test'), results)
+                self.assertNotEqual(get_version('test'), version)
+
+    def test_single_flight_build(self):
+        """ Пустой кэш: значение строит один поток, остальные ждут его
+        """
+        for backend in ('locmem', 'file'):
+            with self.subTest(backend=backend), self.use_cache(backend):
+                calls = []
+
+                def build():
+                    calls.append(threading.get_ident())
+                    time.sleep(0.2)
+                    return 'value'
+
+                results, errors = run_concurrently(lambda: get_or_build('test', ['single'], build), [()] * 6)
+                self.assertEqual(errors, [])
+                self.assertEqual(results, ['value'] * 6)
+                self.assertEqual(len(calls), 1)
+
+    def test_first_version_single(self):
+        """ Первые читатели пустого файлового кэша получают одну версию пространства
+        """
+        with self.use_cache('file') as cache:
+            key = _version_key('first')
+            self.assertTrue(_add_version(cache, key, 'a'))
+            self.assertFalse(_add_version(cache, key, 'b'))
+            self.assertEqual(cache.get(key), 'a')
+            has_key = cache.has_key
+
+            def slow_has_key(*args, **kwargs):
+                # Расширяем окно между проверкой и записью обычного add
+                found = has_key(*args, **kwargs)
+                time.sleep(0.05)
+                return found
+
+            with mock.patch.object(cache, 'has_key', slow_has_key):
+                results, errors = run_concurrently(get_version, [('fresh',)] * 8)
+            self.assertEqual(errors, [])
+            self.assertEqual(len(set(results)), 1)
+            self.assertEqual(get_version('fresh'), results[0])
+
+    def test_value_stored_before_lock(self):
+        """ Значение сохранил другой поток между нашим промахом и блокировкой: повторно не строим
+        """
+        key = make_key('test', 'raced')
+
+        def acquire_lock(cache, lock_key):
+            cache.set(key, CachedValue('other', None), None)
+            return True
+
+        build = mock.Mock(return_value='value')
+        with mock.patch('shop.cache.acquire_lock', acquire_lock), mock.patch('shop.cache.release_lock') as release:
+            self.assertEqual(get_or_build('test', ['raced'], build), 'other')
+        build.assert_not_called()
+        release.assert_called_once_with(get_cache(), key + ':lock')
+
+    def test_single_flight_stale(self):
+        """ После мягкого срока значение перестраивает один поток, остальные отдают устаревшее
+        """
+        for backend in ('locmem', 'file'):
+            with self.subTest(backend=backend), self.use_cache(backend) as cache:
+                cache.set(make_key('test', 'stale'), CachedValue('old', time.time() - 1), None)
+                calls = []
+
+                def build():
+                    calls.append(threading.get_ident())
+                    time.sleep(0.2)
+                    return 'new'
+
+                results, errors = run_concurrently(lambda: get_or_build('test', ['stale'], build), [()] * 6)
+                self.assertEqual(errors, [])
+                self.assertEqual(sorted(results), ['new'] + ['old'] * 5)
+                self.assertEqual(len(calls), 1)
+
+
+
+def load_project_settings(**environ):
+    """ Свежая копия модуля настроек проекта, прочитанная с переменными окружения environ (без остальных DJANGO_*)
+    """
+    spec = importlib.util.find_spec('fishing_shop.settings')
+    module = importlib.util.module_from_spec(spec)
+    clean = {key: value for key, value in os.environ.items() if not key.startswith('DJANGO_')}
+    clean.pop('WEB_CONCURRENCY', None)
+    with mock.patch.dict(os.environ, {**clean, **environ}, clear=True):
+        spec.loader.exec_module(module)
+    return module
+
+
+class SharedCacheTests(TestCase):
+    ALIASES = (CATALOG_CACHE, FRAGMENTS_CACHE, 'sessions')
+
+    def local_caches(self):
+        return {alias: LocMemCache(alias, {}) for alias in self.ALIASES}
+
+    def shared_caches(self):
+        return {alias: FileBasedCache(tempfile.gettempdir(), {}) for alias in self.ALIASES}
+
+    def test_default_backend(self):
+        project_settings = load_project_settings()
+        self.assertEqual(project_settings.CACHES[CATALOG_CACHE]['BACKEND'], LocMemCache.__module__ + '.LocMemCache')
+        for environ in ({'DJANGO_DEBUG': '0'}, {'DJANGO_CACHE_DIR': '/tmp/shop-cache'}):
+            project_settings = load_project_settings(**environ)
+            for alias in self.ALIASES:
+                self.assertEqual(
+                    project_settings.CACHES[alias]['BACKEND'], FileBasedCache.__module__ + '.FileBasedCache'
+                )
+        project_settings = load_project_settings(DJANGO_DEBUG='0', DJANGO_CACHE_BACKEND='locmem', WEB_CONCURRENCY='4')
+        self.assertEqual(project_settings.CACHES[CATALOG_CACHE]['BACKEND'], LocMemCache.__module__ + '.LocMemCache')
+        self.assertEqual(project_settings.SHOP_WORKERS, 4)
+        self.assertEqual(load_project_settings(DJANGO_WORKERS='2', WEB_CONCURRENCY='4').SHOP_WORKERS, 2)
+
+    def test_memcached_backend(self):
+        backend = load_project_settings(DJANGO_CACHE_BACKEND='memcached').CACHES[CATALOG_CACHE]['BACKEND']
+        self.assertIn(backend, (
+            'django.core.cache.backends.memcached.PyMemcacheCache', 'django.core.cache.backends.memcached.PyLibMCCache',
+        ))
+
+    def test_locmem_in_debug(self):
+        with override_settings(DEBUG=True), mock.patch('shop.cache.caches', self.local_caches()), \
+                mock.patch('shop.cache.WORKERS', 4), mock.patch('shop.cache.logger') as logger:
+            check_shared_caches()
+        logger.warning.assert_not_called()
+
+    def test_locmem_single_worker_warns(self):
+        with override_settings(DEBUG=False), mock.patch('shop.cache.caches', self.local_caches()), \
+                mock.patch('shop.cache.logger') as logger:
+            check_shared_caches()
+        logger.warning.assert_called_once()
+        self.assertIn(CATALOG_CACHE, logger.warning.call_args[0][1])
+
+    def test_locmem_many_workers_fails(self):
+        with override_settings(DEBUG=False), mock.patch('shop.cache.caches', self.local_caches()), \
+                mock.patch('shop.cache.WORKERS', 4):
+            with self.assertRaises(ImproperlyConfigured):
+                check_shared_caches()
+
+    def test_shared_caches(self):
+        with override_settings(DEBUG=False), mock.patch('shop.cache.caches', self.shared_caches()), \
+                mock.patch('shop.cache.WORKERS', 4), mock.patch('shop.cache.logger') as logger:
+            check_shared_caches()
+        logger.warning.assert_not_called()
+
+
+class CatalogImportExportTests(TestCase):
+    FIELDS = ('product_key', 'name', 'slug', 'price', 'stock', 'available', 'category_id', 'type', 'snag_protection')
+
+    def setUp(self):
+        self.category = create_category()
+        create_wobbler(self.category, 'Воблер A', 'wobbler-a', price=100, stock=5, product_key=101)
+        create_wobbler(self.category, 'Воблер B', 'wobbler-b', price='149.90', stock=0, product_key=102,
+                       snag_protection=True, available=False)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def snapshot(self):
+        return list(Wobblers.objects.order_by('product_key').values_list(*self.FIELDS))
+
+    def export(self, fmt):
+        stream = io.StringIO()
+        write_rows(stream, fmt, *export_rows(Wobblers))
+        return stream.getvalue()
+
+    def run_import(self, content, fmt='jsonl', **kwargs):
+        return CatalogImporter(Wobblers, **kwargs).run(read_rows(io.StringIO(content), fmt))
+
+    def test_round_trip(self):
+        for fmt in ('csv', 'jsonl'):
+            expected = self.snapshot()
+            content = self.export(fmt)
+            Wobblers.objects.all().delete()
+            importer = self.run_import(content, fmt)
+            self.assertEqual((importer.created, importer.updated, importer.skipped), (2, 0, 0), fmt)
+            self.assertEqual(self.snapshot(), expected, fmt)
+            self.assertEqual(
+                sorted(CatalogProduct.objects.values_list('slug', 'price', 'stock', 'available')),
+                [('wobbler-a', Decimal(100), 5, True), ('wobbler-b', Decimal('149.90'), 0, False)],
+                fmt,
+            )
+
+    def test_rerun_is_idempotent(self):
+        content = self.export('jsonl')
+        Wobblers.objects.filter(product_key=101).update(price=1, stock=1)
+        first = self.run_import(content)
+        expected = self.snapshot()
+        second = self.run_import(content)
+        self.assertEqual((first.created, first.updated), (0, 2))
+        self.assertEqual((second.created, second.updated, second.skipped), (0, 2, 0))
+        self.assertEqual(self.snapshot(), expected)
+        self.assertEqual(Wobblers.objects.count(), 2)
+        self.assertEqual(CatalogProduct.objects.count(), 2)
+        self.assertEqual(CatalogProduct.objects.get(slug='wobbler-a').price, Decimal(100))
+
+    def test_dry_run(self):
+        expected = self.snapshot()
+        content = '\n'.join([
+            json.dumps({'product_key': 101, 'price': '555'}),
+            json.dumps({'product_key': 103, 'name': 'Воблер C', 'slug': 'wobbler-c', 'price': '10', 'stock': 1,
+                        'category': 'voblery', 'weight': 5, 'long': 50, 'type_of_fishing': 'Спиннинг',
+                        'deepening': 1, 'manufacturer_country': 'Китай', 'type_of_buoyancy': 'Тонущий',
+                        'type': 'Минноу'}),
+            json.dumps({'product_key': 104, 'category': 'missing'}),
+        ])
+        importer = self.run_import(content, dry_run=True)
+        self.assertEqual((importer.created, importer.updated, importer.skipped), (1, 1, 1))
+        self.assertEqual(self.snapshot(), expected)
+        self.assertEqual(CatalogProduct.objects.count(), 2)
+
+    def test_error_report(self):
+        rows = [
+            json.dumps({'product_key': 101, 'price': '120'}),
+            json.dumps({'product_key': 102, 'category': ['voblery']}),
+            json.dumps({'product_key': 102, 'name': {'ru': 'Воблер'}}),
+            json.dumps({'product_key': 102, 'category': 'missing'}),
+            json.dumps({'product_key': 102, 'price': 'дорого'}),
+            json.dumps({'product_key': 102, 'stock': [1]}),
+            json.dumps({'name': 'Без кода'}),
+            '{not json',
+            json.dumps(['a list']),
+        ]
+        importer = self.run_import('\n'.join(rows), create=False)
+        self.assertEqual((importer.rows, importer.updated, importer.skipped), (9, 1, 8))
+        self.assertEqual([line_num for line_num, _ in importer.errors], list(range(2, 10)))
+        messages = dict(importer.errors)
+        self.assertIn('category', messages[2])
+        self.assertIn('name', messages[3])
+        self.assertIn('missing', messages[4])
+        self.assertIn('price', messages[5])
+        self.assertEqual(Wobblers.objects.get(product_key=101).price, Decimal(120))
+        self.assertEqual(Wobblers.objects.get(product_key=102).price, Decimal('149.90'))
+
+    def test_commands(self):
+        path = os.path.join(self.tmp_dir, 'wobblers.jsonl')
+        call_command('export_catalog', 'wobblers', path, stderr=io.StringIO())
+        Wobblers.objects.filter(product_key=101).update(price=1)
+        out = io.StringIO()
+        call_command('import_catalog', 'wobblers', path, '--dry-run', stdout=out, stderr=io.StringIO())
+        self.assertIn('создано: 0, обновлено: 2', out.getvalue())
+        self.assertEqual(Wobblers.objects.get(product_key=101).price, Decimal(1))
+        call_command('import_catalog', 'wobblers', path, stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(Wobblers.objects.get(product_key=101).price, Decimal(100))
+
+
+
+class FacetFilterTests(TestCase):
+
+    def setUp(self):
+        self.category = create_category()
+        create_wobbler(self.category, 'Воблер A', 'wobbler-a', price=100)
+        create_wobbler(self.category, 'Воблер B', 'wobbler-b', price=300)
+
+    def test_bounds(self):
+        facet_filter = FacetFilter(Wobblers, QueryDict('price_min=150&weight_max=12,5'))
+        self.assertEqual(facet_filter.bounds, {
+            ('price', 'min'): ('gte', Decimal(150)), ('weight', 'max'): ('lte', Decimal('12.5')),
+        })
+        self.assertEqual([product.slug for product in facet_filter.filter(Wobblers.objects.all())], ['wobbler-b'])
+
+    def test_malformed_and_non_finite_bounds(self):
+        for value in ('abc', '1..2', '', 'Infinity', '-Infinity', 'inf', 'nan', 'NaN', 'sNaN', '-nan'):
+            facet_filter = FacetFilter(Wobblers, QueryDict(mutable=True, query_string='price_min=' + value))
+            self.assertEqual(facet_filter.bounds, {}, value)
+            self.assertFalse(facet_filter.is_active, value)
+
+    def test_page_with_non_finite_bounds(self):
+        url = reverse('category_detail', kwargs={'slug': self.category.slug})
+        for query in ('price_min=Infinity', 'price_max=nan', 'weight_min=sNaN&long_max=-Infinity'):
+            response = self.client.get('{}?{}'.format(url, query))
+            self.assertEqual(response.status_code, 200, query)
+            self.assertEqual(len(response.context['product']), 2, query)
+
+
+
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        category = create_category()
+        # Одинаковые названия: порядок внутри них задаёт id
+        for number in range(7):
+            create_wobbler(category, 'Воблер {}'.format(number // 3), 'wobbler-{}'.format(number))
+        self.paginator = KeysetPaginator(Wobblers.objects.all(), 3)
+        self.slugs = list(Wobblers.objects.order_by('name', 'id').values_list('slug', flat=True))
+
+    @staticmethod
+    def slugs_of(page):
+        return [product.slug for product in page]
+
+    @staticmethod
+    def make_cursor(values):
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+    def test_ties_on_sort_key(self):
+        seen, page = [], self.paginator.get_page()
+        while True:
+            seen += self.slugs_of(page)
+            if not page.has_next:
+                break
+            page = self.paginator.get_page(after=page.next_cursor)
+        self.assertEqual(seen, self.slugs)
+
+    def test_previous_cursor(self):
+        first = self.paginator.get_page()
+        self.assertFalse(first.has_previous)
+        second = self.paginator.get_page(after=first.next_cursor)
+        self.assertTrue(second.has_previous)
+        back = self.paginator.get_page(before=second.previous_cursor)
+        self.assertEqual(self.slugs_of(back), self.slugs_of(first))
+        self.assertFalse(back.has_previous)
+        self.assertTrue(back.has_next)
+
+    def test_deep_page(self):
+        last = self.paginator.get_page(after=self.paginator.encode_cursor(Wobblers.objects.get(slug=self.slugs[5])))
+        self.assertEqual(self.slugs_of(last), self.slugs[6:])
+        self.assertFalse(last.has_next)
+        self.assertTrue(last.has_previous)
+        previous = self.paginator.get_page(before=last.previous_cursor)
+        self.assertEqual(self.slugs_of(previous), self.slugs[3:6])
+        self.assertTrue(previous.has_previous)
+
+    def test_tampered_cursor(self):
+        cursors = [
+            'not-base64!', self.make_cursor('a'), self.make_cursor(['Воблер 0']), self.make_cursor(['a', [1]]),
+            self.make_cursor(['a', {'x': 1}]), self.make_cursor(['a', True]), self.make_cursor(['a', 'abc']),
+            self.make_cursor([None, None]),
+        ]
+        first = self.slugs_of(self.paginator.get_page())
+        for cursor in cursors:
+            for name in ('after', 'before'):
+                page = self.paginator.get_page(**{name: cursor})
+                self.assertEqual(self.slugs_of(page), first, (name, cursor))
+                self.assertFalse(page.has_previous)
+
+    def test_page_keeps_params(self):
+        page = self.paginator.get_page(params=QueryDict('type=Минноу&after=x'))
+        self.assertEqual(QueryDict(page.next_query[1:]).getlist('type'), ['Минноу'])
+        self.assertEqual(QueryDict(page.next_query[1:])['after'], page.next_cursor)
+
+    def test_category_page_with_tampered_cursor(self):
+        url = reverse('category_detail', kwargs={'slug': 'voblery'})
+        response = self.client.get(url, {'after': self.make_cursor(['a', [1]])})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['product']), 7)
+
+
+
+class CartMutationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='password')
+        self.cart = Cart.objects.create(owner=Customer.objects.create(user=self.user))
+        category = create_category()
+        self.wobbler = create_wobbler(category, 'Воблер A', 'wobbler-a', price=100)
+        self.other = create_wobbler(category, 'Воблер B', 'wobbler-b', price=250)
+        add_cart_product(self.cart, self.wobbler, 2)
+        add_cart_product(self.cart, self.other)
+        self.client.force_login(self.user)
+
+    def assertTotals(self, total_product, final_price):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        self.assertEqual((cart.total_product, cart.final_price), (total_product, Decimal(final_price)))
+
+    def get_qty(self, product):
+        line = self.cart.related_products.filter(object_id=product.pk).first()
+        return line and line.qty
+
+    @override_settings(SHOP_CART_VERIFY_TOTALS=True)
+    def test_change_qty(self):
+        self.assertTrue(change_cart_product_qty(self.cart, self.wobbler, 5))
+        self.assertTotals(2, 750)
+        self.assertEqual((self.cart.total_product, self.cart.final_price), (2, Decimal(750)))
+        self.assertEqual(self.get_qty(self.wobbler), 5)
+
+    def test_change_qty_missing_line(self):
+        self.cart.related_products.filter(object_id=self.other.pk).delete()
+        self.cart.refresh_from_db()
+        self.assertFalse(change_cart_product_qty(self.cart, self.other, 3))
+        self.assertIsNone(self.get_qty(self.other))
+
+    @override_settings(SHOP_CART_VERIFY_TOTALS=True)
+    def test_remove(self):
+        self.assertTrue(remove_cart_product(self.cart, self.wobbler))
+        self.assertTotals(1, 250)
+        self.assertFalse(remove_cart_product(self.cart, self.wobbler))
+        self.assertTotals(1, 250)
+
+    @override_settings(SHOP_CART_VERIFY_TOTALS=True)
+    def test_merge(self):
+        spoon = create_spoon(create_category('blesny', 'Блёсны'), 'Блесна', 'blesna', price=50)
+        merge_cart_products(self.cart, [(self.wobbler, 1), (spoon, 2), (spoon, 1)])
+        self.assertEqual(self.get_qty(self.wobbler), 3)
+        self.assertEqual(self.cart.related_products.get(object_id=spoon.pk, content_type__model='spoons').qty, 3)
+        self.assertTotals(3, 700)
+
+    def get_statements(self, func, *args):
+        with CaptureQueriesContext(connection) as queries:
+            func(self.cart, *args)
+        return [query['sql'] for query in queries.captured_queries]
+
+    def test_totals_updated_in_place(self):
+        """ Итоги корзины меняются одним UPDATE с выражениями над колонками, строки корзины не перечитываются
+        """
+        cart_table = Cart._meta.db_table
+        for func, args, totals in (
+                (add_cart_product, (self.wobbler,), (2, 550)),
+                (change_cart_product_qty, (self.wobbler, 1), (2, 350)),
+                (remove_cart_product, (self.other,), (1, 100))):
+            with self.subTest(func=func.__name__):
+                statements = self.get_statements(func, *args)
+                cart_updates = [sql for sql in statements if sql.startswith('UPDATE "{}"'.format(cart_table))]
+                self.assertEqual(len(cart_updates), 1)
+                self.assertIn('("{}"."final_price" + '.format(cart_table), cart_updates[0])
+                self.assertIn('("{}"."total_product" + '.format(cart_table), cart_updates[0])
+                self.assertFalse(any('SUM(' in sql or 'COUNT(' in sql for sql in statements))
+                self.assertTotals(*totals)
+        # Добавление уже лежащего в корзине товара - UPDATE строки и UPDATE итогов
+        self.assertEqual(len(self.get_statements(add_cart_product, self.wobbler)), 2)
+
+    def test_stale_cart_objects(self):
+        """ Изменения через разные экземпляры одной корзины (параллельные запросы) не затирают друг друга
+        """
+        first, second = Cart.objects.get(pk=self.cart.pk), Cart.objects.get(pk=self.cart.pk)
+        spoon = create_spoon(create_category('blesny', 'Блёсны'), 'Блесна', 'blesna', price=50)
+        add_cart_product(first, spoon, 2)
+        add_cart_product(second, self.wobbler)
+        change_cart_product_qty(first, self.other, 2)
+        remove_cart_product(second, spoon)
+        self.assertTotals(2, 800)
+
+    def test_zero_delta_without_query(self):
+        with self.assertNumQueries(0):
+            apply_cart_delta(self.cart, 0, 0)
+        with self.assertNumQueries(2):
+            # Та же цена строки: UPDATE строки есть, а итоги не меняются
+            change_cart_product_qty(self.cart, self.wobbler, 2)
+        self.assertTotals(2, 450)
+
+    def test_matches_full_recalc(self):
+        spoon = create_spoon(create_category('blesny', 'Блёсны'), 'Блесна', 'blesna', price=50)
+        add_cart_product(self.cart, spoon, 3)
+        change_cart_product_qty(self.cart, self.wobbler, 4)
+        merge_cart_products(self.cart, [(self.other, 2), (spoon, 1)])
+        remove_cart_product(self.cart, self.wobbler)
+        add_cart_product(self.cart, self.wobbler)
+        incremental = (self.cart.total_product, self.cart.final_price)
+        self.assertTotals(*incremental)
+        recalc_cart(self.cart)
+        self.assertEqual((self.cart.total_product, self.cart.final_price), incremental)
+        self.assertEqual(incremental, (3, Decimal(100 + 750 + 200)))
+
+    def post_qty(self, qty):
+        url = reverse('change_qty', kwargs={'ct_model': 'wobblers', 'slug': 'wobbler-a'})
+        return self.client.post(url, {} if qty is None else {'qty': qty})
+
+    def test_change_qty_view_rejects_invalid_qty(self):
+        for qty in (None, '', 'abc', '1.5'):
+            response = self.post_qty(qty)
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(self.get_qty(self.wobbler), 2)
+        self.assertTotals(2, 450)
+
+    def test_change_qty_view(self):
+        self.post_qty('3')
+        self.assertEqual(self.get_qty(self.wobbler), 3)
+        self.assertTotals(2, 550)
+
+    def test_change_qty_view_removes_on_zero_or_negative(self):
+        self.post_qty('0')
+        self.assertIsNone(self.get_qty(self.wobbler))
+        self.assertTotals(1, 250)
+
+        add_cart_product(self.cart, self.wobbler, 2)
+        self.post_qty('-3')
+        self.assertIsNone(self.get_qty(self.wobbler))
+        self.assertTotals(1, 250)
+
+    def test_api_change_qty(self):
+        url = reverse('api_cart_change_qty', kwargs={'ct_model': 'wobblers', 'slug': 'wobbler-a'})
+        self.assertEqual(self.client.post(url, {'qty': 'abc'}).status_code, 400)
+        response = self.client.post(url, {'qty': '4'}).json()
+        self.assertEqual(response['line'], {'qty': 4, 'final_price': '400.00'})
+        self.assertEqual(response['cart'], {'total_product': 2, 'final_price': '650.00'})
+        response = self.client.post(url, {'qty': '0'}).json()
+        self.assertIsNone(response['line'])
+        self.assertEqual(response['cart'], {'total_product': 1, 'final_price': '250.00'})
+
+
+
+class CartSessionStateTests(TestCase):
+    """ Ленивая корзина: идентификаторы и итоги корзины в сессии, корзина загружается только при обращении
+    """
+
+    def setUp(self):
+        self.wobbler = create_wobbler(create_category(), 'Воблер A', 'wobbler-a', price=100)
+        self.cart = create_cart('buyer', (self.wobbler, 2))
+        self.user = self.cart.owner.user
+        self.session = {}
+
+    def get_service(self, user=None):
+        request = RequestFactory().get('/')
+        request.user = user or self.user
+        request.session = self.session
+        return CartService(request)
+
+    def test_first_request_remembers_cart(self):
+        service = self.get_service()
+        self.assertEqual(service.get_cart(), self.cart)
+        state = self.session[CART_SESSION_KEY]
+        self.assertEqual(
+            (state['user_id'], state['customer_id'], state['cart_id'], state['total_product']),
+            (self.user.pk, self.cart.owner_id, self.cart.pk, 1),
+        )
+
+    def test_cart_loaded_lazily(self):
+        self.get_service().get_cart()
+        service = self.get_service()
+        with self.assertNumQueries(0):
+            cart = service.get_lazy_cart()
+            self.assertEqual(service.customer_id, self.cart.owner_id)
+            self.assertEqual(service.total_product, 1)
+        # Корзина по id из сессии - один запрос, повторные обращения - без запросов
+        with self.assertNumQueries(1):
+            self.assertEqual(cart.pk, self.cart.pk)
+            self.assertEqual(service.get_cart().final_price, Decimal(200))
+
+    def test_stale_totals_reread(self):
+        self.get_service().get_cart()
+        self.session[CART_SESSION_KEY]['ts'] -= CART_STATE_TTL + 1
+        service = self.get_service()
+        with self.assertNumQueries(1):
+            self.assertEqual(service.total_product, 1)
+        self.assertGreater(self.session[CART_SESSION_KEY]['ts'], time.time() - CART_STATE_TTL)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_service().total_product, 1)
+
+    def test_state_of_other_user_ignored(self):
+        self.get_service().get_cart()
+        other = create_cart('other')
+        self.assertEqual(self.get_service(other.owner.user).get_cart(), other)
+        self.assertEqual(self.session[CART_SESSION_KEY]['cart_id'], other.pk)
+
+    def test_ordered_cart_replaced(self):
+        self.get_service().get_cart()
+        Cart.objects.filter(pk=self.cart.pk).update(in_order=True)
+        cart = self.get_service().get_cart()
+        self.assertNotEqual(cart.pk, self.cart.pk)
+        self.assertEqual((cart.owner_id, cart.in_order, cart.total_product), (self.cart.owner_id, False, 0))
+        self.assertEqual(self.session[CART_SESSION_KEY]['cart_id'], cart.pk)
+
+    def test_unchanged_state_not_rewritten(self):
+        service = self.get_service()
+        state = service.remember(service.get_cart())
+        self.assertIs(service.remember(service.get_cart()), state)
+        self.assertIs(self.session[CART_SESSION_KEY], state)
+        # Итоги изменились - сессия перезаписывается
+        service.add_product(create_wobbler(self.wobbler.category, 'Воблер B', 'wobbler-b'))
+        self.assertIsNot(self.session[CART_SESSION_KEY], state)
+        self.assertEqual(self.session[CART_SESSION_KEY]['total_product'], 2)
+
+    def test_guest_cart_without_queries(self):
+        service = self.get_service(AnonymousUser())
+        with self.assertNumQueries(0):
+            self.assertEqual(service.total_product, 0)
+            self.assertIsNone(service.customer_id)
+            service.add_product(self.wobbler, 2)
+            self.assertEqual((service.total_product, service.get_cart().final_price), (1, Decimal(200)))
+        self.assertEqual(self.session, {})
+
+
+class CartAPITests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='password')
+        category = create_category()
+        self.wobbler = create_wobbler(category, 'Воблер A', 'wobbler-a', price=100)
+
+    def api_url(self, name, slug='wobbler-a', ct_model='wobblers'):
+        return reverse(name, kwargs={'ct_model': ct_model, 'slug': slug})
+
+    def get_line(self):
+        return CartProduct.objects.filter(object_id=self.wobbler.pk).values_list('qty', flat=True).first()
+
+    def test_authenticated_add(self):
+        self.client.force_login(self.user)
+        response = self.client.post(self.api_url('api_cart_add')).json()
+        self.assertEqual(response['line'], {'qty': 1, 'final_price': '100.00'})
+        self.assertEqual(response['cart'], {'total_product': 1, 'final_price': '100.00'})
+        self.assertEqual(self.get_line(), 1)
+
+    def test_guest_add_and_remove(self):
+        response = self.client.post(self.api_url('api_cart_add'))
+        self.assertEqual(response.json()['line'], {'qty': 1, 'final_price': '100.00'})
+        self.assertEqual(response.json()['cart'], {'total_product': 1, 'final_price': '100.00'})
+        # Корзина гостя живёт в cookie, в БД ничего не пишется
+        self.assertIn(GUEST_CART_COOKIE, response.cookies)
+        self.assertIsNone(self.get_line())
+        self.assertFalse(Cart.objects.exists())
+
+        response = self.client.post(self.api_url('api_cart_change_qty'), {'qty': '3'}).json()
+        self.assertEqual(response['line'], {'qty': 3, 'final_price': '300.00'})
+        response = self.client.post(self.api_url('api_cart_remove')).json()
+        self.assertIsNone(response['line'])
+        self.assertEqual(response['cart'], {'total_product': 0, 'final_price': '0'})
+
+    @mock.patch('shop.cart.GUEST_CART_MAX_LINES', 1)
+    def test_guest_cart_limit(self):
+        create_wobbler(self.wobbler.category, 'Воблер B', 'wobbler-b', price=200)
+        self.assertEqual(self.client.post(self.api_url('api_cart_add')).status_code, 200)
+        response = self.client.post(self.api_url('api_cart_add', slug='wobbler-b'))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {'message': GuestCartFull().get_message()})
+        self.assertNotIn(GUEST_CART_COOKIE, response.cookies)
+        # Товар, который уже в корзине, добавляется и при заполненной корзине
+        response = self.client.post(self.api_url('api_cart_add')).json()
+        self.assertEqual(response['cart'], {'total_product': 1, 'final_price': '200.00'})
+
+        # Обычная ссылка (без скрипта) показывает сообщение
+        response = self.client.get(
+            reverse('add_to_cart', kwargs={'ct_model': 'wobblers', 'slug': 'wobbler-b'}), HTTP_REFERER='/', follow=True
+        )
+        self.assertEqual(
+            [(message.level, message.message) for message in response.context['messages']],
+            [(messages.ERROR, GuestCartFull().get_message())],
+        )
+        self.assertEqual(response.context['cart'].total_product, 1)
+
+    def test_bad_qty(self):
+        self.client.force_login(self.user)
+        self.client.post(self.api_url('api_cart_add'))
+        for data in ({}, {'qty': ''}, {'qty': 'abc'}, {'qty': '1.5'}, {'qty': '1e3'}):
+            response = self.client.post(self.api_url('api_cart_change_qty'), data)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'message': 'Неверное колличество товара'})
+            self.assertEqual(self.get_line(), 1)
+
+    def test_unknown_product(self):
+        self.client.force_login(self.user)
+        for name in ('api_cart_add', 'api_cart_change_qty', 'api_cart_remove'):
+            self.assertEqual(self.client.post(self.api_url(name, slug='missing'), {'qty': '1'}).status_code, 404)
+            self.assertEqual(self.client.post(self.api_url(name, ct_model='missing'), {'qty': '1'}).status_code, 404)
+        self.assertFalse(CartProduct.objects.exists())
+
+    def test_get_not_allowed(self):
+        self.assertEqual(self.client.get(self.api_url('api_cart_add')).status_code, 405)
+
+    def test_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        self.assertEqual(client.post(self.api_url('api_cart_add')).status_code, 403)
+        self.assertIsNone(self.get_line())
+
+        # Страница каталога без форм встраивает токен для скрипта корзины и выставляет cookie
+        response = client.get(reverse('category_detail', kwargs={'slug': 'voblery'}))
+        self.assertIn('csrftoken', response.cookies)
+        token = response.context['csrf_token']
+        self.assertContains(response, "var csrfToken = '{}';".format(token))
+        response = client.post(self.api_url('api_cart_add'), HTTP_X_CSRFTOKEN=str(token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_line(), 1)
+
+
+
+class BulkEditTests(TestCase):
+
+    def setUp(self):
+        category = create_category()
+        self.first = create_wobbler(category, 'Воблер A', 'wobbler-a', price=100, stock=5)
+        self.second = create_wobbler(category, 'Воблер B', 'wobbler-b', price=200, stock=5)
+        self.other = create_wobbler(category, 'Воблер C', 'wobbler-c', price=300, stock=5)
+
+    def get_catalog(self, product):
+        return CatalogProduct.objects.values_list('price', 'stock', 'available').get(
+            object_id=product.pk, model_name='wobblers'
+        )
+
+    def test_edit_selected_products(self):
+        queryset = Wobblers.objects.filter(pk__in=[self.first.pk, self.second.pk], available=True)
+        count = bulk_edit_products(
+            queryset, price_change=PRICE_PERCENT, price_value=10, stock_change=STOCK_DELTA, stock_value=-2,
+            available=False,
+        )
+        # Фильтр queryset после изменения уже не выбирает товары, каталог всё равно обновлён
+        self.assertEqual(count, 2)
+        self.assertEqual(self.get_catalog(self.first), (Decimal('110.00'), 3, False))
+        self.assertEqual(self.get_catalog(self.second), (Decimal('220.00'), 3, False))
+        self.assertEqual(self.get_catalog(self.other), (Decimal('300.00'), 5, True))
+
+    def test_same_timestamp_does_not_touch_other_products(self):
+        now = timezone.now()
+        # Товар сохранён в ту же микросекунду в обход каталога: его строку каталога правка трогать не должна
+        Wobblers.objects.filter(pk=self.other.pk).update(updated=now, stock=42)
+        with mock.patch('shop.bulk.timezone.now', return_value=now):
+            bulk_edit_products(Wobblers.objects.filter(pk=self.first.pk), stock_change=STOCK_DELTA, stock_value=1)
+        self.assertEqual(self.get_catalog(self.first), (Decimal('100.00'), 6, True))
+        self.assertEqual(self.get_catalog(self.other), (Decimal('300.00'), 5, True))
+
+    def test_empty_selection(self):
+        self.assertEqual(bulk_edit_products(Wobblers.objects.none(), available=False), 0)
+
+
+
+class ThumbnailTests(TestCase):
+    IMAGE = 'products/thumbnail-test.png'
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(thumbnails._ready.clear)
+        thumbnails._ready.clear()
+        names = [
+            thumbnails.get_thumbnail_name(self.IMAGE, rendition, fmt)
+            for rendition in thumbnails.RENDITIONS for fmt in thumbnails.FORMATS
+        ]
+        get_cache(FRAGMENTS_CACHE).delete_many([thumbnails._missing_key(name) for name in names])
+
+        content = ContentFile(b'')
+        thumbnails.Image.new('RGB', (40, 20), (200, 0, 0)).save(content, 'PNG')
+        default_storage.save(self.IMAGE, content)
+
+    def test_missing_thumbnail_checked_once(self):
+        with mock.patch.object(default_storage, 'exists', wraps=default_storage.exists) as exists:
+            for _ in range(3):
+                urls = thumbnails.get_thumbnail_urls(self.IMAGE, 'card')
+                self.assertEqual(list(urls), [None])
+        # Одна проверка на формат, дальше ответ берётся из кэша
+        self.assertEqual(exists.call_count, len(thumbnails.FORMATS))
+
+    def test_generation_clears_missing_mark(self):
+        self.assertEqual(list(thumbnails.get_thumbnail_urls(self.IMAGE, 'card')), [None])
+        thumbnails.generate_thumbnails(self.IMAGE)
+        thumbnails._ready.clear()
+        with mock.patch.object(default_storage, 'exists', wraps=default_storage.exists) as exists:
+            for _ in range(2):
+                urls = thumbnails.get_thumbnail_urls(self.IMAGE, 'card')
+        self.assertEqual(set(urls), set(thumbnails.FORMATS))
+        self.assertEqual(exists.call_count, len(thumbnails.FORMATS))
+
+    @mock.patch('shop.thumbnails.READY_CACHE_SIZE', 2)
+    def test_ready_cache_is_bounded(self):
+        thumbnails.generate_thumbnails(self.IMAGE)
+        self.assertEqual(len(thumbnails._ready), 2)
+        thumbnails._ready.clear()
+        for rendition in ('card', 'detail', 'card'):
+            thumbnails.is_ready(self.IMAGE, rendition, thumbnails.FALLBACK)
+        # Недавно использованное превью вытесняется последним
+        self.assertEqual(list(thumbnails._ready), [
+            thumbnails.get_thumbnail_name(self.IMAGE, 'detail', thumbnails.FALLBACK),
+            thumbnails.get_thumbnail_name(self.IMAGE, 'card', thumbnails.FALLBACK),
+        ])
+        thumbnails.is_ready(self.IMAGE, 'cart', thumbnails.FALLBACK)
+        self.assertEqual(len(thumbnails._ready), 2)
+        self.assertNotIn(thumbnails.get_thumbnail_name(self.IMAGE, 'detail', thumbnails.FALLBACK), thumbnails._ready)
+
+    def test_locks_are_striped(self):
+        locks = {id(thumbnails._get_lock('products/{}.png'.format(num))) for num in range(1000)}
+        self.assertLessEqual(len(locks), thumbnails.LOCK_STRIPES)
+        self.assertEqual(len(thumbnails._locks), thumbnails.LOCK_STRIPES)
+        self.assertIs(thumbnails._get_lock(self.IMAGE), thumbnails._get_lock(self.IMAGE))
+
+    def test_concurrent_generation(self):
+        results, errors = run_concurrently(lambda: thumbnails.generate_thumbnails(self.IMAGE), [()] * 4)
+        self.assertEqual(errors, [])
+        # Картинку построил один поток, остальные застали свежие превью
+        self.assertEqual(sorted(results), [0, 0, 0, len(thumbnails.RENDITIONS) * len(thumbnails.FORMATS)])
+
+
+
+@mock.patch('shop.tasks.EXECUTOR', 'command')
+class MakeOrderTests(TestCase):
+    ORDER_DATA = {
+        'first_name': 'Иван', 'last_name': 'Иванов', 'phone': '+79990000000', 'address': 'Москва',
+        'buying_type': 'self', 'order_date': '2026-01-01', 'comment': '',
+    }
+
+    def setUp(self):
+        self.wobbler = create_wobbler(create_category(), 'Воблер A', 'wobbler-a', stock=10)
+        self.cart = create_cart('buyer', (self.wobbler, 2))
+        self.client.force_login(self.cart.owner.user)
+
+    def get_stock(self):
+        return Wobblers.objects.get(pk=self.wobbler.pk).stock
+
+    def test_make_order(self):
+        response = self.client.post(reverse('make_order'), self.ORDER_DATA)
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        self.assertTrue(Cart.objects.get(pk=self.cart.pk).in_order)
+        self.assertEqual(Order.objects.get().cart_id, self.cart.pk)
+        self.assertEqual(self.get_stock(), 8)
+
+    def test_cart_ordered_twice(self):
+        # Обе отправки формы загрузили корзину до того, как первая оформила заказ
+        view = MakeOrderView()
+        view.cart = self.cart
+        view.cart_service = mock.Mock(customer_id=self.cart.owner_id)
+        atomic_with_retry(view.make_order, OrderForm(self.ORDER_DATA))
+        with self.assertRaises(CartAlreadyOrdered):
+            atomic_with_retry(view.make_order, OrderForm(self.ORDER_DATA))
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.get_stock(), 8)
+
+    def test_view_redirects_to_cart_when_already_ordered(self):
+        Cart.objects.filter(pk=self.cart.pk).update(in_order=True)
+        with mock.patch.object(CartService, 'get_lazy_cart', return_value=self.cart):
+            response = self.client.post(reverse('make_order'), self.ORDER_DATA)
+        self.assertRedirects(response, '/cart/', fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.get_stock(), 10)
+
+
+
+@mock.patch('shop.tasks.EXECUTOR', 'command')
+class OrderTaskTests(TestCase):
+
+    def setUp(self):
+        cart = create_cart('buyer')
+        self.order = Order.objects.create(
+            customer=cart.owner, cart=cart, first_name='Иван', last_name='Иванов', phone='+79990000000'
+        )
+        self.now = timezone.now()
+        self.calls = []
+        self.failures = 0
+        handlers = mock.patch.dict(tasks._handlers, {'test': self.handler})
+        clock = mock.patch('shop.tasks.timezone.now', lambda: self.now)
+        for patcher in (handlers, clock, mock.patch('shop.tasks.logger')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def handler(self, order, task):
+        self.calls.append((order.pk, task.attempts))
+        if len(self.calls) <= self.failures:
+            raise RuntimeError('SMTP недоступен')
+
+    def enqueue(self, *names):
+        """ Ставим задачи в очередь; часы задач - с момента постановки
+        """
+        tasks.enqueue_order_tasks(self.order, names)
+        self.now = OrderTask.objects.filter(order=self.order).latest('run_after').run_after
+
+    def get_task(self):
+        return OrderTask.objects.get(order=self.order, name='test')
+
+    def test_executor_setting(self):
+        spec = importlib.util.find_spec('shop.tasks')
+        for executor in ('thread', 'command', 'queue'):
+            with override_settings(SHOP_ORDER_TASKS_EXECUTOR=executor):
+                spec.loader.exec_module(importlib.util.module_from_spec(spec))
+        with override_settings(SHOP_ORDER_TASKS_EXECUTOR='celery'):
+            with self.assertRaises(ImproperlyConfigured):
+                spec.loader.exec_module(importlib.util.module_from_spec(spec))
+
+    @mock.patch('shop.tasks.RETRY_DELAY', 30)
+    def test_retry_backoff(self):
+        self.failures = 2
+        self.enqueue('test')
+        start = self.now
+        self.assertEqual(tasks.run_pending_tasks(), (0, 1))
+        task = self.get_task()
+        self.assertEqual((task.status, task.attempts), (OrderTask.STATUS_PENDING, 1))
+        self.assertEqual(task.run_after, start + timedelta(seconds=30))
+        self.assertIn('SMTP недоступен', task.last_error)
+        # До срока повтора задача не выполняется, пауза удваивается
+        self.now = start + timedelta(seconds=29)
+        self.assertEqual(tasks.run_pending_tasks(), (0, 0))
+        self.now = start + timedelta(seconds=30)
+        self.assertEqual(tasks.run_pending_tasks(), (0, 1))
+        self.assertEqual(self.get_task().run_after, self.now + timedelta(seconds=60))
+        self.now += timedelta(seconds=60)
+        self.assertEqual(tasks.run_pending_tasks(), (1, 0))
+        task = self.get_task()
+        self.assertEqual((task.status, task.attempts, task.last_error), (OrderTask.STATUS_DONE, 3, ''))
+        self.assertEqual(self.calls, [(self.order.pk, 1), (self.order.pk, 2), (self.order.pk, 3)])
+
+    @mock.patch('shop.tasks.MAX_ATTEMPTS', 2)
+    def test_max_attempts(self):
+        self.failures = 10
+        self.enqueue('test')
+        for _ in range(2):
+            self.assertEqual(tasks.run_pending_tasks(), (0, 1))
+            self.now += timedelta(days=1)
+        task = self.get_task()
+        self.assertEqual((task.status, task.attempts), (OrderTask.STATUS_FAILED, 2))
+        self.assertEqual(tasks.run_pending_tasks(), (0, 0))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_completed_task_runs_once(self):
+        self.enqueue('test')
+        self.assertEqual(tasks.run_pending_tasks(), (1, 0))
+        # Повторная постановка, повторный проход очереди и запуск той же задачи ничего не выполняют
+        tasks.enqueue_order_tasks(self.order, ['test'])
+        self.assertEqual(OrderTask.objects.filter(order=self.order).count(), 1)
+        self.assertEqual(tasks.run_pending_tasks(), (0, 0))
+        self.assertIsNone(tasks.run_task(self.get_task()))
+        self.assertEqual(self.calls, [(self.order.pk, 1)])
+        self.assertEqual(self.get_task().status, OrderTask.STATUS_DONE)
+
+    @mock.patch('shop.tasks.STALE_MINUTES', 15)
+    def test_release_stale_tasks(self):
+        self.enqueue('test', 'other')
+        # Исполнитель забрал обе задачи и упал; одну из них забрали только что
+        OrderTask.objects.filter(order=self.order).update(
+            status=OrderTask.STATUS_RUNNING, attempts=1, updated=self.now - timedelta(minutes=16)
+        )
+        OrderTask.objects.filter(order=self.order, name='other').update(updated=self.now - timedelta(minutes=1))
+        self.assertEqual(tasks.run_pending_tasks(), (0, 0))
+        self.assertEqual(tasks.release_stale_tasks(), 1)
+        self.assertEqual(OrderTask.objects.get(order=self.order, name='other').status, OrderTask.STATUS_RUNNING)
+        self.assertEqual(tasks.run_pending_tasks(), (1, 0))
+        self.assertEqual(self.calls, [(self.order.pk, 2)])
+
+
+class QueryBudgetTests(QueryBudgetMixin, TransactionTestCase):
+    """ Бюджеты запросов (query_budget и cold_query_budget представлений) для вошедшего покупателя - точное число
+        запросов. Транзакции настоящие, как в работе сайта: обёртка TestCase добавила бы к каждой свои SAVEPOINT
+    """
+    # Первый запрос после входа переносит гостевую корзину: товары гостя из каталога, строки корзины,
+    # INSERT новых строк в точке сохранения, UPDATE итогов и запись итогов в сессию - разово сверх бюджета
+    GUEST_CART_MERGE_QUERIES = 9
+
+    def setUp(self):
+        # Между тестами таблицы очищаются и типы контента создаются заново с другими id
+        ContentType.objects.clear_cache()
+        registry.build()
+        for alias in ('catalog', 'fragments', 'sessions'):
+            caches[alias].clear()
+        self.category = create_category()
+        self.wobbler = create_wobbler(self.category, 'Воблер A', 'wobbler-a')
+        create_wobbler(self.category, 'Воблер B', 'wobbler-b', type='Крэнк', snag_protection=True)
+        self.cart = create_cart('buyer', (self.wobbler, 1))
+
+    def login(self):
+        self.client.force_login(self.cart.owner.user)
+
+    def make_cold(self):
+        """ Самый холодный запрос: кэши каталога и сессий пусты, итогов корзины в сессии нет
+        """
+        session = self.client.session
+        session.pop(CART_SESSION_KEY, None)
+        session.save()
+        for alias in ('catalog', 'fragments', 'sessions'):
+            caches[alias].clear()
+
+    def product_url(self, name, slug='wobbler-a'):
+        return reverse(name, kwargs={'ct_model': 'wobblers', 'slug': slug})
+
+    def get_pages(self):
+        return [
+            reverse('home'), reverse('about'), reverse('categories'), reverse('cart'), reverse('checkout'),
+            reverse('category_detail', kwargs={'slug': self.category.slug}), self.product_url('product_detail'),
+            reverse('search') + '?q=воблер', reverse('search_suggest') + '?q=воб', reverse('api_cart_badge'),
+        ]
+
+    def test_pages_warm(self):
+        # Анонимный покупатель укладывается в бюджеты вошедшего
+        for path in self.get_pages():
+            self.assertEqual(self.assertQueryBudget(path, cold=True).status_code, 200)
+            self.assertEqual(self.assertQueryBudget(path).status_code, 200)
+        self.login()
+        for path in self.get_pages():
+            self.assertEqual(self.assertQueryBudget(path, warmup=True, exact=True).status_code, 200)
+
+    def test_pages_cold(self):
+        self.login()
+        for path in self.get_pages():
+            self.make_cold()
+            self.assertEqual(self.assertQueryBudget(path, cold=True, exact=True).status_code, 200)
+
+    def test_category_detail_cold_facets(self):
+        self.login()
+        category_url = reverse('category_detail', kwargs={'slug': self.category.slug})
+        self.assertQueryBudget(category_url, warmup=True)
+        # Фасеты для нового набора фильтров ещё не в кэше
+        response = self.assertQueryBudget(category_url + '?type=Крэнк&snag_protection=1&price_min=10', cold=True)
+        self.assertEqual([product.slug for product in response.context['product']], ['wobbler-b'])
+        facets = response.context['facets']
+        self.assertEqual({flag['name']: flag['count'] for flag in facets['flags']}, {
+            'snag_protection': 1, 'long_distance_casting_system': 0, 'noise_effects': 0,
+        })
+        price = next(item for item in facets['ranges'] if item['name'] == 'price')
+        self.assertEqual((price['min'], price['max']), (Decimal(100), Decimal(100)))
+
+    def test_cart_after_login_merge(self):
+        self.client.get(reverse('cart'))
+        self.client.get(self.product_url('add_to_cart', 'wobbler-b'), HTTP_REFERER='/')
+        self.login()
+        budget = CartView.query_budget + self.GUEST_CART_MERGE_QUERIES
+        with mock.patch('shop.middleware.logger'):
+            response = self.assertQueryBudget(reverse('cart'), budget=budget, exact=True)
+        self.assertEqual(len(response.context['cart_lines']), 2)
+        self.assertQueryBudget(reverse('cart'), exact=True)
+
+    def test_cart_actions_warm(self):
+        """ Бюджет действия - самый дорогой его вариант: новая строка корзины, удаление строки
+        """
+        self.login()
+        self.client.get(reverse('cart'))
+        add_url = self.product_url('add_to_cart', 'wobbler-b')
+        response = self.assertQueryBudget(add_url, HTTP_REFERER='/cart/', exact=True)
+        self.assertRedirects(response, '/cart/', fetch_redirect_response=False)
+        # Товар уже в корзине: ни INSERT, ни записи сессии
+        self.assertQueryBudget(add_url, budget=6, HTTP_REFERER='/cart/', exact=True)
+        self.assertQueryBudget(self.product_url('change_qty'), method='post', budget=7, data={'qty': 3}, exact=True)
+        self.assertEqual(self.cart.related_products.get(object_id=self.wobbler.pk).qty, 3)
+        self.assertQueryBudget(self.product_url('change_qty'), method='post', data={'qty': 0}, exact=True)
+        self.assertQueryBudget(self.product_url('remove_from_cart', 'wobbler-b'), exact=True)
+        self.assertFalse(self.cart.related_products.exists())
+
+    def test_cart_api_warm(self):
+        self.login()
+        self.client.get(reverse('cart'))
+        self.assertQueryBudget(self.product_url('api_cart_add', 'wobbler-b'), method='post', exact=True)
+        self.assertQueryBudget(
+            self.product_url('api_cart_change_qty', 'wobbler-b'), method='post', data={'qty': 0}, exact=True
+        )
+        self.assertQueryBudget(self.product_url('api_cart_remove'), method='post', exact=True)
+        self.assertFalse(self.cart.related_products.exists())
+
+    def test_cart_actions_cold(self):
+        self.login()
+        self.make_cold()
+        self.assertQueryBudget(self.product_url('add_to_cart', 'wobbler-b'), HTTP_REFERER='/', cold=True, exact=True)
+        self.make_cold()
+        self.assertQueryBudget(self.product_url('api_cart_add'), method='post', cold=True)
+        self.make_cold()
+        self.assertQueryBudget(self.product_url('change_qty'), method='post', data={'qty': 0}, cold=True, exact=True)
+        self.make_cold()
+        self.assertQueryBudget(self.product_url('remove_from_cart', 'wobbler-b'), cold=True, exact=True)
+
+    @mock.patch('shop.tasks.EXECUTOR', 'command')
+    def test_make_order(self):
+        self.login()
+        self.client.get(reverse('cart'))
+        response = self.assertQueryBudget(
+            reverse('make_order'), method='post', data=MakeOrderTests.ORDER_DATA, exact=True
+        )
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        self.assertTrue(Order.objects.filter(cart=self.cart).exists())
+
+    @mock.patch('shop.tasks.EXECUTOR', 'command')
+    def test_make_order_cold(self):
+        self.login()
+        self.make_cold()
+        self.assertQueryBudget(
+            reverse('make_order'), method='post', data=MakeOrderTests.ORDER_DATA, cold=True, exact=True
+        )
+
+    def assertNoBudgetWarnings(self):
+        """ Холодные и прогретые запросы страниц укладываются в свои бюджеты и по счёту middleware
+            (он учитывает и запросы асинхронных представлений из других потоков)
+        """
+        with mock.patch('shop.middleware.logger') as logger:
+            for path in self.get_pages():
+                self.make_cold()
+                self.client.get(path)
+                self.client.get(path)
+        self.assertEqual(logger.warning.call_args_list, [])
+
+    def test_middleware_cold_budget(self):
+        self.login()
+        self.assertNoBudgetWarnings()
+
+    def test_middleware_cold_budget_async(self):
+        self.login()
+        with async_catalog_views():
+            self.assertNoBudgetWarnings()
+            # Точное число запросов асинхронной страницы видно только по статистике middleware
+            with mock.patch('shop.middleware.aggregator') as aggregator, mock.patch('shop.middleware.logger'):
+                path = reverse('category_detail', kwargs={'slug': self.category.slug})
+                self.make_cold()
+                self.client.get(path)
+                self.client.get(path)
+            view = resolve(path).func
+            self.assertEqual(
+                [call[0][1].queries for call in aggregator.add.call_args_list],
+                [view.cold_query_budget, view.query_budget],
+            )
+
+
+
+class ConcurrentCartTests(TransactionTestCase):
+    """ Одновременные изменения одной корзины: инкрементальные итоги в реальных транзакциях из разных потоков
+    """
+
+    def setUp(self):
+        ContentType.objects.clear_cache()
+        registry.build()
+        category = create_category()
+        self.products = [
+            create_wobbler(category, 'Воблер {}'.format(number), 'wobbler-{}'.format(number), price=10 * number)
+            for number in range(1, 5)
+        ]
+        self.cart = create_cart('buyer')
+
+    def test_concurrent_adds(self):
+        def add(product):
+            # Конфликт блокировок откатывает транзакцию целиком, корзина перечитывается в повторе
+            atomic_with_retry(lambda: add_cart_product(Cart.objects.get(pk=self.cart.pk), product))
+
+        # Каждый товар добавляют два потока: строка создаётся одна, итоги учитывают все добавления
+        results, errors = run_concurrently(add, [(product,) for product in self.products * 2])
+        self.assertEqual(errors, [])
+        cart = Cart.objects.get(pk=self.cart.pk)
+        self.assertEqual((cart.total_product, cart.final_price), (4, Decimal(2 * (10 + 20 + 30 + 40))))
+        self.assertEqual(sorted(cart.related_products.values_list('qty', flat=True)), [2, 2, 2, 2])
+        recalc_cart(cart)
+        self.assertEqual((cart.total_product, cart.final_price), (4, Decimal(200)))
+
+
+class DatabaseSettingsTests(TestCase):
+
+    def test_sqlite_profile(self):
+        project_settings = load_project_settings(DJANGO_SQLITE_BUSY_TIMEOUT='500')
+        self.assertEqual(list(project_settings.DATABASES), ['default'])
+        database = project_settings.DATABASES['default']
+        self.assertEqual(database['ENGINE'], 'fishing_shop.sqlite')
+        self.assertEqual(database['OPTIONS']['pragmas']['journal_mode'], 'WAL')
+        self.assertEqual(database['OPTIONS']['pragmas']['busy_timeout'], 500)
+        self.assertEqual(database['OPTIONS']['transaction_mode'], 'DEFERRED')
+        self.assertEqual(database['OPTIONS']['write_transaction_mode'], 'IMMEDIATE')
+        self.assertEqual((project_settings.DATABASE_REPLICAS, project_settings.DATABASE_ROUTERS), ([], []))
+
+    def test_postgres_profile(self):
+        project_settings = load_project_settings(
+            DJANGO_DB_PROFILE='postgres', DJANGO_DB_HOST='db', DJANGO_DB_REPLICAS='replica-a, replica-b',
+            DJANGO_DB_PGBOUNCER='1',
+        )
+        databases = project_settings.DATABASES
+        self.assertEqual(list(databases), ['default', 'replica_0', 'replica_1'])
+        self.assertEqual(databases['default']['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual([database['HOST'] for database in databases.values()], ['db', 'replica-a', 'replica-b'])
+        self.assertTrue(all(database['DISABLE_SERVER_SIDE_CURSORS'] for database in databases.values()))
+        # В тестах реплики - зеркала основной базы
+        self.assertEqual(databases['replica_0']['TEST'], {'MIRROR': 'default'})
+        self.assertNotIn('TEST', databases['default'])
+        self.assertEqual(project_settings.DATABASE_REPLICAS, ['replica_0', 'replica_1'])
+        self.assertEqual(project_settings.DATABASE_ROUTERS, ['fishing_shop.routers.ReplicaRouter'])
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            load_project_settings(DJANGO_DB_PROFILE='mysql')
+
+    def test_pragmas(self):
+        pragmas = connection.settings_dict['OPTIONS']['pragmas']
+        with connection.cursor() as cursor:
+            for name in ('busy_timeout', 'cache_size'):
+                cursor.execute('PRAGMA {}'.format(name))
+                self.assertEqual(cursor.fetchone()[0], pragmas[name])
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA temp_store')
+            self.assertEqual(cursor.fetchone()[0], 2)
+
+    def test_invalid_transaction_mode(self):
+        for option in ('transaction_mode', 'write_transaction_mode'):
+            settings_dict = dict(connection.settings_dict, OPTIONS={option: 'LATER'})
+            with self.subTest(option=option), self.assertRaises(ImproperlyConfigured):
+                DatabaseWrapper(settings_dict, 'invalid').get_connection_params()
+
+
+class SQLiteTransactionTests(TransactionTestCase):
+    """ Режим BEGIN внешних транзакций: блокировку записи сразу берут только транзакции write_atomic
+    """
+
+    def get_begin(self, block):
+        with CaptureQueriesContext(connection) as queries:
+            with block():
+                Category.objects.count()
+        return [query['sql'] for query in queries.captured_queries if query['sql'].startswith('BEGIN')]
+
+    def test_read_transaction_is_deferred(self):
+        self.assertEqual(self.get_begin(transaction.atomic), ['BEGIN DEFERRED'])
+
+    def test_write_transaction_is_immediate(self):
+        self.assertEqual(self.get_begin(write_atomic), ['BEGIN IMMEDIATE'])
+        self.assertFalse(connection.write_intent)
+        self.assertEqual(self.get_begin(lambda: write_atomic(savepoint=False)), ['BEGIN IMMEDIATE'])
+
+    def test_nested_write_transaction(self):
+        # Внутри начатой транзакции блокировку уже не поднять: write_atomic - обычная точка сохранения
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                with write_atomic():
+                    Category.objects.count()
+        self.assertEqual(
+            [query['sql'].split()[0] for query in queries.captured_queries], ['BEGIN', 'SAVEPOINT', 'SELECT', 'RELEASE']
+        )
+        self.assertEqual(queries.captured_queries[0]['sql'], 'BEGIN DEFERRED')
+
+    def test_error_resets_write_intent(self):
+        with self.assertRaises(RuntimeError):
+            with write_atomic():
+                raise RuntimeError
+        self.assertFalse(connection.write_intent)
+        self.assertEqual(self.get_begin(transaction.atomic), ['BEGIN DEFERRED'])
+
+
+@override_settings(DATABASE_REPLICAS=['replica_0', 'replica_1'])
+class ReplicaRouterTests(TransactionTestCase):
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+
+    def test_catalog_reads_go_to_replicas(self):
+        for model in (Wobblers, Spoons, CatalogProduct, Category, ParentCategory, SearchToken):
+            with self.subTest(model=model.__name__):
+                self.assertIn(self.router.db_for_read(model), ['replica_0', 'replica_1'])
+
+    def test_other_reads_go_to_default(self):
+        for model in (Cart, CartProduct, Customer, Order, OrderTask, StockReservation, User):
+            with self.subTest(model=model.__name__):
+                self.assertEqual(self.router.db_for_read(model), 'default')
+
+    def test_writes_go_to_default(self):
+        for model in (Wobblers, CatalogProduct, Cart):
+            self.assertEqual(self.router.db_for_write(model), 'default')
+
+    def test_reads_in_transaction_go_to_default(self):
+        with transaction.atomic():
+            self.assertEqual(self.router.db_for_read(Wobblers), 'default')
+            self.assertEqual(self.router.db_for_read(CatalogProduct), 'default')
+        self.assertIn(self.router.db_for_read(Wobblers), ['replica_0', 'replica_1'])
+
+    def test_without_replicas(self):
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(ReplicaRouter().db_for_read(Wobblers), 'default')
+
+    def test_migrations_only_on_default(self):
+        self.assertTrue(self.router.allow_migrate('default', 'shop'))
+        self.assertFalse(self.router.allow_migrate('replica_0', 'shop'))
+        self.assertTrue(self.router.allow_relation(Wobblers(), Cart()))
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    """ Одновременное оформление заказов на последние единицы товара: реальные транзакции в отдельных потоках
+    """
+
+    def setUp(self):
+        # Между тестами таблицы очищаются и типы контента создаются заново с другими id
+        ContentType.objects.clear_cache()
+        registry.build()
+        self.wobbler = create_wobbler(create_category(), 'Воблер A', 'wobbler-a', stock=3)
+        self.key = get_product_content_key(self.wobbler)
+
+    def get_stock(self):
+        catalog_stock = CatalogProduct.objects.get(object_id=self.wobbler.pk, model_name='wobblers').stock
+        stock = Wobblers.objects.get(pk=self.wobbler.pk).stock
+        self.assertEqual(stock, catalog_stock)
+        return stock
+
+    @staticmethod
+    def checkout(cart):
+        try:
+            atomic_with_retry(commit_cart_stock, cart)
+        except InsufficientStock:
+            return 'shortage'
+        return 'ok'
+
+    def test_last_units(self):
+        carts = [create_cart('buyer{}'.format(number), (self.wobbler, 1)) for number in range(8)]
+        results, errors = run_concurrently(self.checkout, [(cart,) for cart in carts])
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(results), ['ok'] * 3 + ['shortage'] * 5)
+        self.assertEqual(self.get_stock(), 0)
+
+    def test_multi_unit_carts(self):
+        """ Заказ на 2 шт. при остатке 1 шт. не проходит и ничего не списывает
+        """
+        carts = [create_cart('buyer{}'.format(number), (self.wobbler, 2)) for number in range(4)]
+        results, errors = run_concurrently(self.checkout, [(cart,) for cart in carts])
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(results), ['ok', 'shortage', 'shortage', 'shortage'])
+        self.assertEqual(self.get_stock(), 1)
+
+    def test_no_lost_updates(self):
+        """ Одновременные списания и возвраты не теряются
+        """
+        Wobblers.objects.filter(pk=self.wobbler.pk).update(stock=100)
+
+        def change(delta):
+            if delta > 0:
+                atomic_with_retry(increment_stock, {self.key: delta})
+            else:
+                atomic_with_retry(decrement_stock, {self.key: -delta})
+
+        results, errors = run_concurrently(change, [(3,)] * 10 + [(-2,)] * 10)
+        self.assertEqual(errors, [])
+        self.assertEqual(self.get_stock(), 110)
+
+    @mock.patch.object(inventory, 'RESERVATION_MINUTES', 15)
+    def test_reservations_and_checkout(self):
+        """ Резервы одних покупателей и оформление заказов других не продают больше остатка
+        """
+        reserving = [create_cart('reserving{}'.format(number)) for number in range(4)]
+        buying = [create_cart('buyer{}'.format(number), (self.wobbler, 1)) for number in range(4)]
+
+        def run(cart, reserve):
+            if not reserve:
+                return self.checkout(cart)
+            try:
+                atomic_with_retry(inventory.reserve_stock, cart, self.wobbler)
+            except InsufficientStock:
+                return 'shortage'
+            return 'reserved'
+
+        results, errors = run_concurrently(
+            run, [(cart, True) for cart in reserving] + [(cart, False) for cart in buying]
+        )
+        self.assertEqual(errors, [])
+        sold = results.count('ok') + results.count('reserved')
+        self.assertEqual(sold, 3)
+        self.assertEqual(StockReservation.objects.count(), results.count('reserved'))
+        self.assertEqual(self.get_stock(), 0)
+
+
+
+@contextmanager
+def async_catalog_views():
+    """ Страницы каталога на асинхронных представлениях: urls.py выбирает их при импорте по SHOP_ASYNC_VIEWS,
+        поэтому конфигурация адресов перезагружается с включённой настройкой и восстанавливается после
+    """
+    def reload_urls():
+        importlib.reload(urls)
+        importlib.reload(fishing_shop.urls)
+        clear_url_caches()
+
+    with override_settings(SHOP_ASYNC_VIEWS=True):
+        reload_urls()
+    try:
+        yield
+    finally:
+        reload_urls()
+
+
+
+class AsyncViewTests(TransactionTestCase):
+    """ Асинхронные страницы каталога отдают то же, что синхронные. Работа с БД идёт в пуле потоков
+        со своими подключениями, поэтому данные теста должны быть зафиксированы
+    """
+
+    def setUp(self):
+        ContentType.objects.clear_cache()
+        registry.build()
+        for alias in ('catalog', 'fragments', 'sessions'):
+            caches[alias].clear()
+        self.category = create_category()
+        self.wobbler = create_wobbler(self.category, 'Воблер A', 'wobbler-a')
+        create_wobbler(self.category, 'Воблер B', 'wobbler-b', type='Крэнк')
+        self.cart = create_cart('buyer', (self.wobbler, 2))
+        self.pages = [
+            reverse('home'),
+            reverse('categories'),
+            reverse('category_detail', kwargs={'slug': self.category.slug}),
+            reverse('category_detail', kwargs={'slug': self.category.slug}) + '?type=Крэнк',
+            reverse('product_detail', kwargs={'ct_model': 'wobblers', 'slug': 'wobbler-a'}),
+        ]
+
+    async def _get_async(self, path):
+        return await self.async_client.get(path)
+
+    async def _post_async(self, path):
+        return await self.async_client.post(path)
+
+    def get_async(self, path):
+        try:
+            return async_to_sync(self._get_async)(path)
+        except SynchronousOnlyOperation as error:
+            self.fail('{}: синхронный вызов в цикле событий ({})'.format(path, error))
+
+    def assertSamePages(self):
+        for path in self.pages:
+            expected = self.client.get(path)
+            self.assertEqual(expected.status_code, 200, path)
+            with async_catalog_views():
+                response = self.get_async(path)
+            self.assertEqual(response.status_code, 200, path)
+            self.assertEqual(self.get_content(response), self.get_content(expected), path)
+
+    def get_content(self, response):
+        # Маскированный токен CSRF отличается при каждом выводе страницы
+        return re.sub(r"csrfToken = '\w+'", "csrfToken = ''", response.content.decode())
+
+    def test_url_switch(self):
+        self.assertFalse(asyncio.iscoroutinefunction(resolve(self.pages[0]).func))
+        with async_catalog_views():
+            self.assertTrue(asyncio.iscoroutinefunction(resolve(self.pages[0]).func))
+        self.assertFalse(asyncio.iscoroutinefunction(resolve(self.pages[0]).func))
+
+    def test_anonymous(self):
+        self.assertSamePages()
+
+    def test_logged_in(self):
+        self.client.force_login(self.cart.owner.user)
+        self.async_client.force_login(self.cart.owner.user)
+        self.assertSamePages()
+
+    def test_not_found(self):
+        with async_catalog_views():
+            response = self.get_async(reverse('category_detail', kwargs={'slug': 'missing'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_independent_calls_run_concurrently(self):
+        """ Категории и родительские категории читаются одновременно: при последовательных вызовах
+            ни один из них не дождался бы второго у барьера
+        """
+        barrier = threading.Barrier(2, timeout=5)
+
+        def waiting(func):
+            def wrapper():
+                barrier.wait()
+                return func()
+            return wrapper
+
+        with mock.patch('shop.async_views.get_categories', waiting(async_views.get_categories)), \
+                mock.patch('shop.async_views.get_parent_categories', waiting(async_views.get_parent_categories)), \
+                async_catalog_views():
+            response = self.get_async(reverse('categories'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(barrier.broken)
+
+    def test_run_in_thread(self):
+        async def call(func, *args):
+            return threading.get_ident(), await async_views.run_in_thread(func, *args)
+
+        loop_thread, (worker_thread, value) = async_to_sync(call)(lambda number: (threading.get_ident(), number), 7)
+        self.assertEqual(value, 7)
+        self.assertNotEqual(worker_thread, loop_thread)
+        with self.assertRaises(Category.DoesNotExist):
+            async_to_sync(call)(lambda: Category.objects.get(pk=0))
+
+    def test_guest_cart_merged_after_login(self):
+        user = User.objects.create_user('guest', password='password')
+        url = reverse('api_cart_add', kwargs={'ct_model': 'wobblers', 'slug': 'wobbler-a'})
+        self.assertEqual(async_to_sync(self._post_async)(url).status_code, 200)
+        self.assertIn(GUEST_CART_COOKIE, self.async_client.cookies)
+        self.async_client.force_login(user)
+        # Перенос корзины при входе - разовые запросы сверх бюджета страницы
+        with async_catalog_views(), mock.patch('shop.middleware.logger'):
+            response = self.get_async(reverse('home'))
+        self.assertEqual(response.status_code, 200)
+        # Корзина из cookie перенесена в БД, cookie удаляется
+        self.assertEqual(response.cookies[GUEST_CART_COOKIE]['max-age'], 0)
+        cart = Cart.objects.get(owner__user=user, in_order=False)
+        self.assertEqual((cart.total_product, list(cart.related_products.values_list('qty', flat=True))), (1, [1]))
+        self.assertEqual(response.context['cart'].pk, cart.pk)
+
+
+
+class ReservationTests(TestCase):
+
+    @mock.patch('shop.cart.RESERVATION_MINUTES', 15)
+    def test_change_qty_of_missing_line_does_not_reserve(self):
+        wobbler = create_wobbler(create_category(), 'Воблер A', 'wobbler-a', stock=5)
+        cart = create_cart('buyer')
+        request = mock.Mock(user=cart.owner.user, session={}, COOKIES={})
+        service = CartService(request)
+        service._cart = cart
+
+        service.change_qty(wobbler, 3)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(Wobblers.objects.get(pk=wobbler.pk).stock, 5)
@@ -0,0 +1,224 @@
+import hashlib
+import logging
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import features, Image, ImageOps
+
+from .cache import bump_version, FRAGMENTS_CACHE, get_cache, KEY_PREFIX, PRODUCTS
+
+
+logger = logging.getLogger(__name__)
+
+# Размеры превью: имя -> (ширина, высота). Картинка вписывается в рамку с сохранением пропорций,
+# размеры - двойные от размеров в шаблонах, чтобы превью было чётким на экранах высокой плотности
+RENDITIONS = getattr(settings, 'SHOP_THUMBNAIL_RENDITIONS', {
+    'cart': (200, 64),
+    'card': (800, 264),
+    'detail': (800, 800),
+})
+
+# Каталог превью внутри MEDIA_ROOT
+THUMBS_DIR = getattr(settings, 'SHOP_THUMBNAILS_DIR', 'thumbs')
+
+# Качество сжатия WebP и запасного JPEG
+QUALITY = getattr(settings, 'SHOP_THUMBNAIL_QUALITY', 80)
+
+# Где строятся превью после загрузки картинки: 'thread' - пул потоков процесса после фиксации транзакции,
+# 'command' - только командой build_thumbnails
+EXECUTOR = getattr(settings, 'SHOP_THUMBNAILS_EXECUTOR', 'thread')
+WORKERS = getattr(settings, 'SHOP_THUMBNAILS_WORKERS', 2)
+
+# Сколько построенных превью помнить в памяти процесса (LRU) и на сколько блокировок делятся картинки
+READY_CACHE_SIZE = getattr(settings, 'SHOP_THUMBNAIL_READY_CACHE_SIZE', 10000)
+LOCK_STRIPES = getattr(settings, 'SHOP_THUMBNAIL_LOCK_STRIPES', 64)
+
+# Сколько секунд помнить, что превью ещё нет (в кэше фрагментов): до этого страницы отдают оригинал,
+# не обращаясь к хранилищу. Построение превью сбрасывает отметку сразу
+MISSING_TIMEOUT = getattr(settings, 'SHOP_THUMBNAIL_MISSING_TIMEOUT', 60)
+
+# Форматы превью: WebP (если Pillow собран с его поддержкой) и запасной JPEG для старых браузеров
+WEBP = 'webp'
+FALLBACK = 'jpg'
+FORMATS = (WEBP, FALLBACK) if features.check('webp') else (FALLBACK,)
+PIL_FORMATS = {WEBP: 'WEBP', FALLBACK: 'JPEG'}
+
+_executor = None
+
+# Одна картинка (например, общая у нескольких товаров) строится в процессе только одним потоком. Блокировки
+# общие для картинок с одинаковым остатком хэша имени: их число не растёт с каталогом
+_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+# Превью, про которые уже известно, что они есть на диске: шаблонный тег не проверяет их повторно (LRU)
+_ready = OrderedDict()
+_ready_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='thumbnails')
+    return _executor
+
+
+def _get_lock(name):
+    return _locks[zlib.crc32(name.encode()) % len(_locks)]
+
+
+def _is_known_ready(thumbnail_name):
+    with _ready_lock:
+        if thumbnail_name not in _ready:
+            return False
+        _ready.move_to_end(thumbnail_name)
+        return True
+
+
+def _mark_ready(thumbnail_name):
+    with _ready_lock:
+        _ready[thumbnail_name] = True
+        _ready.move_to_end(thumbnail_name)
+        while len(_ready) > READY_CACHE_SIZE:
+            _ready.popitem(last=False)
+
+
+def get_thumbnail_name(name, rendition, fmt):
+    """
+    Путь превью в хранилище: thumbs/<размер>/<путь оригинала без расширения>.<формат>
+    :param name: Путь оригинала в хранилище (FieldFile.name)
+    """
+    return '{}/{}/{}.{}'.format(THUMBS_DIR, rendition, os.path.splitext(name)[0], fmt)
+
+
+def _missing_key(thumbnail_name):
+    return '{}:thumbnail-missing:{}'.format(KEY_PREFIX, hashlib.md5(thumbnail_name.encode()).hexdigest())
+
+
+def is_ready(name, rendition, fmt):
+    """ Есть ли превью в хранилище. Положительный ответ запоминается в памяти процесса,
+        отрицательный - в кэше фрагментов на MISSING_TIMEOUT секунд
+    """
+    thumbnail_name = get_thumbnail_name(name, rendition, fmt)
+    if _is_known_ready(thumbnail_name):
+        return True
+    cache = get_cache(FRAGMENTS_CACHE)
+    if cache.get(_missing_key(thumbnail_name)):
+        return False
+    if default_storage.exists(thumbnail_name):
+        _mark_ready(thumbnail_name)
+        return True
+    cache.set(_missing_key(thumbnail_name), True, MISSING_TIMEOUT)
+    return False
+
+
+def _is_fresh(name, thumbnail_name):
+    try:
+        return default_storage.get_modified_time(thumbnail_name) >= default_storage.get_modified_time(name)
+    except (OSError, NotImplementedError):
+        return False
+
+
+def _encode(image, fmt):
+    content = ContentFile(b'')
+    if fmt == FALLBACK and image.mode != 'RGB':
+        # JPEG без прозрачности: прозрачный фон заливаем белым
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A') if 'A' in image.getbands() else None)
+        image = background
+    image.save(content, PIL_FORMATS[fmt], quality=QUALITY, optimize=fmt == FALLBACK)
+    return content
+
+
+def generate_thumbnails(name, force=False):
+    """
+    Строим все превью картинки. Уже построенные и не старше оригинала превью пропускаются
+    :param name: Путь оригинала в хранилище
+    :param force: Перестроить, даже если превью свежие
+    :return: Колличество записанных файлов превью
+    """
+    with _get_lock(name):
+        return _generate(name, force)
+
+
+def _generate(name, force):
+    targets = [
+        (rendition, fmt, get_thumbnail_name(name, rendition, fmt))
+        for rendition in RENDITIONS for fmt in FORMATS
+    ]
+    if not force:
+        targets = [target for target in targets if not _is_fresh(name, target[2])]
+    if not targets:
+        return 0
+
+    with default_storage.open(name, 'rb') as source:
+        original = Image.open(source)
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+        original.load()
+
+    written = 0
+    for rendition, fmt, thumbnail_name in targets:
+        image = original.copy()
+        image.thumbnail(RENDITIONS[rendition], Image.LANCZOS)
+        if default_storage.exists(thumbnail_name):
+            default_storage.delete(thumbnail_name)
+        saved_name = default_storage.save(thumbnail_name, _encode(image, fmt))
+        if saved_name != thumbnail_name:
+            # Превью параллельно записал другой процесс - копия под другим именем не нужна
+            default_storage.delete(saved_name)
+        _mark_ready(thumbnail_name)
+        get_cache(FRAGMENTS_CACHE).delete(_missing_key(thumbnail_name))
+        written += 1
+    return written
+
+
+def _generate_in_thread(name):
+    try:
+        # Кэшированный HTML (блок товаров главной) ссылается на оригинал - сбрасываем его, когда превью готовы
+        if generate_thumbnails(name):
+            bump_version(PRODUCTS)
+    except Exception:
+        logger.exception('Превью для %s не построены', name)
+
+
+def schedule_thumbnails(name):
+    """ Ставим построение превью в пул потоков после фиксации текущей транзакции
+    """
+    if name and EXECUTOR == 'thread':
+        transaction.on_commit(lambda: get_executor().submit(_generate_in_thread, name))
+
+
+def get_image_models():
+    """ Модели с картинками, для которых строятся превью: подкатегории и товары с полем image
+    """
+    from .models import Category, get_product_models
+    return [Category] + [
+        model for model in get_product_models()
+        if any(field.name == 'image' for field in model._meta.concrete_fields)
+    ]
+
+
+def get_thumbnail_urls(image, rendition):
+    """
+    Адреса готовых превью картинки. Ничего не строит: если превью ещё нет, отдаётся оригинал
+    :param image: FieldFile или путь картинки в хранилище
+    :param rendition: Имя размера из RENDITIONS
+    :return: {формат: адрес}, для оригинала - {None: адрес}; пустой словарь, если картинки нет
+    """
+    name = getattr(image, 'name', image)
+    if not name:
+        return {}
+    urls = {
+        fmt: default_storage.url(get_thumbnail_name(name, rendition, fmt))
+        for fmt in FORMATS if is_ready(name, rendition, fmt)
+    }
+    if FALLBACK not in urls:
+        return {None: default_storage.url(name)}
+    return urls
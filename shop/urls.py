@@ -1,4 +1,6 @@
+from django.conf import settings
 from django.urls import path
+from .async_views import category_detail_view, category_view, main_view, product_detail_view
 from .views import (
     AboutUsView,
     CategoryView,
@@ -16,16 +18,33 @@ from .views import (
     PersonalView,
     PromotionsView,
     NewsView,
+    SearchView,
+    SearchSuggestView,
+    CartAPIAddView,
+    CartAPIChangeQTYView,
+    CartAPIRemoveView,
+    CartBadgeView,
 )
 
 
+# Страницы каталога: синхронные представления или их асинхронные варианты для ASGI (SHOP_ASYNC_VIEWS)
+if getattr(settings, 'SHOP_ASYNC_VIEWS', False):
+    home, categories, category_detail, product_detail = (
+        main_view, category_view, category_detail_view, product_detail_view
+    )
+else:
+    home, categories, category_detail, product_detail = (
+        MainView.as_view(), CategoryView.as_view(), CategoryDetailView.as_view(), ProductDetailView.as_view()
+    )
+
+
 urlpatterns = [
-    path('', MainView.as_view(), name='home'),
+    path('', home, name='home'),
     path('about', AboutUsView.as_view(), name='about'),
     path('news', NewsView.as_view(), name='news'),
-    path('categories', CategoryView.as_view(), name='categories'),
-    path('categories/<str:slug>/', CategoryDetailView.as_view(), name='category_detail'),
-    path('categories/<str:ct_model>/<str:slug>/', ProductDetailView.as_view(), name='product_detail'),
+    path('categories', categories, name='categories'),
+    path('categories/<str:slug>/', category_detail, name='category_detail'),
+    path('categories/<str:ct_model>/<str:slug>/', product_detail, name='product_detail'),
     path('cart/', CartView.as_view(), name='cart'),
     path('add-to-cart/<str:ct_model>/<str:slug>/', AddToCartView.as_view(), name='add_to_cart'),
     path('remove-from-cart/<str:ct_model>/<str:slug>/', DeleteFromCartView.as_view(), name='remove_from_cart'),
@@ -36,4 +55,10 @@ urlpatterns = [
     path('pay-ship', PayShipView.as_view(), name='pay_ship'),
     path('personal', PersonalView.as_view(), name='personal'),
     path('promotions', PromotionsView.as_view(), name='promotions'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('search/suggest/', SearchSuggestView.as_view(), name='search_suggest'),
+    path('api/cart/add/<str:ct_model>/<str:slug>/', CartAPIAddView.as_view(), name='api_cart_add'),
+    path('api/cart/change-qty/<str:ct_model>/<str:slug>/', CartAPIChangeQTYView.as_view(), name='api_cart_change_qty'),
+    path('api/cart/remove/<str:ct_model>/<str:slug>/', CartAPIRemoveView.as_view(), name='api_cart_remove'),
+    path('api/cart/badge/', CartBadgeView.as_view(), name='api_cart_badge'),
 ]
\ No newline at end of file
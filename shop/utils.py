@@ -1,12 +1,280 @@
-from django.db import models
+from collections import defaultdict
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models.functions import Coalesce
+from django.contrib.contenttypes.models import ContentType
+
+
+@contextmanager
+def write_atomic(using=None, savepoint=True):
+    """
+    transaction.atomic для транзакций с записью. На бэкенде fishing_shop.sqlite внешний блок начинается
+    с BEGIN IMMEDIATE: блокировка записи берётся сразу, и чтение перед записью (SELECT ... FOR UPDATE, проверка
+    остатков) не упадёт при повышении блокировки. На остальных бэкендах - обычный atomic
+    """
+    connection = transaction.get_connection(using)
+    write_transaction = getattr(connection, 'write_transaction', None)
+    if write_transaction is None or connection.in_atomic_block:
+        with transaction.atomic(using=using, savepoint=savepoint):
+            yield
+        return
+    with write_transaction(), transaction.atomic(using=using, savepoint=savepoint):
+        yield
 
 
 def recalc_cart(cart):
-    cart_data = cart.products.aggregate(models.Sum('final_price'), models.Count('id'))
-    print(cart_data)
-    if cart_data.get('final_price__sum'):
-        cart.final_price = cart_data.get('final_price__sum')
-    else:
-        cart.final_price = 0
+    """ Полный пересчёт итогов корзины по её строкам (проверка согласованности инкрементальных итогов)
+    """
+    cart_data = cart.related_products.aggregate(models.Sum('final_price'), models.Count('id'))
+    cart.final_price = cart_data.get('final_price__sum') or 0
     cart.total_product = cart_data['id__count']
-    cart.save()
\ No newline at end of file
+    cart.save(update_fields=['final_price', 'total_product'])
+
+
+def apply_cart_delta(cart, price_delta, count_delta=0):
+    """
+    Инкрементально меняем итоги корзины одним UPDATE с F-выражениями (только изменённые колонки)
+    :param cart: Корзина
+    :param price_delta: Изменение итоговой цены
+    :param count_delta: Изменение колличества товаров
+    """
+    from .models import Cart
+
+    if price_delta or count_delta:
+        Cart.objects.filter(pk=cart.pk).update(
+            final_price=models.F('final_price') + price_delta,
+            total_product=models.F('total_product') + count_delta,
+        )
+        cart.final_price += price_delta
+        cart.total_product += count_delta
+    if getattr(settings, 'SHOP_CART_VERIFY_TOTALS', False):
+        recalc_cart(cart)
+
+
+def bulk_update_rows(objs, fields):
+    """
+    Массовое обновление колонок одним подготовленным UPDATE ... WHERE id = %s через executemany.
+    bulk_update строит CASE по всем строкам пачки и на десятках тысяч строк работает в разы медленнее
+    :param objs: Экземпляры одной модели с заполненным pk
+    :param fields: Имена полей для обновления
+    :return: Колличество обновлённых объектов
+    """
+    if not objs:
+        return 0
+    model = objs[0]._meta.concrete_model
+    using = router.db_for_write(model)
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    fields = [model._meta.get_field(name) for name in fields]
+    sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+        quote(model._meta.db_table),
+        ', '.join('{} = %s'.format(quote(field.column)) for field in fields),
+        quote(model._meta.pk.column),
+    )
+    params = [
+        [field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields] + [obj.pk]
+        for obj in objs
+    ]
+    with write_atomic(using=using, savepoint=False), connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+    return len(objs)
+
+
+def get_product_content_key(product):
+    """
+    Пара (id типа контента, id товара) для товара или записи сводного каталога
+    :param product: Экземпляр наследника Product или CatalogProduct
+    """
+    from .models import CatalogProduct
+    from .registry import registry
+
+    if isinstance(product, CatalogProduct):
+        return product.content_type_id, product.object_id
+    return registry.get_content_type_id(product.__class__), product.pk
+
+
+def update_cart_totals(cart):
+    """
+    Пересчитываем итоги корзины одним UPDATE с подзапросом по её строкам и перечитываем их в объект корзины
+    :param cart: Корзина
+    """
+    from .models import Cart, CartProduct
+
+    lines = CartProduct.objects.filter(cart=models.OuterRef('pk')).order_by().values('cart')
+    Cart.objects.filter(pk=cart.pk).update(
+        final_price=Coalesce(
+            models.Subquery(lines.annotate(total=models.Sum('final_price')).values('total')), Decimal(0)
+        ),
+        total_product=Coalesce(models.Subquery(lines.annotate(count=models.Count('id')).values('count')), 0),
+    )
+    cart.refresh_from_db(fields=['final_price', 'total_product'])
+
+
+def _add_cart_line(cart, content_type_id, object_id, qty, price):
+    """ UPDATE существующей строки (колличество и цена увеличиваются в самом запросе), если строки нет - INSERT.
+        :return: True, если строка создана
+    """
+    from .models import CartProduct
+
+    lines = CartProduct.objects.filter(cart=cart, content_type_id=content_type_id, object_id=object_id)
+    if lines.update(qty=models.F('qty') + qty, final_price=models.F('final_price') + price):
+        return False
+    try:
+        with transaction.atomic():
+            CartProduct.objects.create(
+                user_id=cart.owner_id, cart=cart, content_type_id=content_type_id, object_id=object_id,
+                qty=qty, final_price=price
+            )
+    except IntegrityError:
+        # Строку успел создать параллельный запрос - увеличиваем её
+        lines.update(qty=models.F('qty') + qty, final_price=models.F('final_price') + price)
+        return False
+    return True
+
+
+def add_cart_product(cart, product, qty=1):
+    """
+    Добавляем товар в корзину: UPDATE существующей строки, если строки нет - INSERT.
+    Итоги корзины меняются инкрементально в той же транзакции
+    :param cart: Корзина
+    :param product: Товар (наследник Product или CatalogProduct)
+    :param qty: Сколько штук добавить
+    """
+    content_type_id, object_id = get_product_content_key(product)
+    price = product.price * qty
+    with write_atomic(savepoint=False):
+        created = _add_cart_line(cart, content_type_id, object_id, qty, price)
+        apply_cart_delta(cart, price, 1 if created else 0)
+
+
+def merge_cart_products(cart, items):
+    """
+    Добавляем в корзину сразу несколько товаров (перенос гостевой корзины при входе): строки корзины читаются
+    одним запросом, новые создаются одним bulk_create, итоги корзины меняются одним UPDATE
+    :param cart: Корзина
+    :param items: Пары (товар, колличество)
+    """
+    from .models import CartProduct
+
+    amounts = {}
+    for product, qty in items:
+        key = get_product_content_key(product)
+        total_qty, price = amounts.get(key, (0, 0))
+        amounts[key] = (total_qty + qty, price + product.price * qty)
+    if not amounts:
+        return
+    with write_atomic(savepoint=False):
+        # В пустой корзине (обычный случай при входе) сравнивать не с чем
+        existing = set()
+        if cart.total_product:
+            existing.update(cart.related_products.values_list('content_type_id', 'object_id'))
+        new_keys = [key for key in amounts if key not in existing]
+        try:
+            with transaction.atomic():
+                CartProduct.objects.bulk_create([
+                    CartProduct(
+                        user_id=cart.owner_id, cart=cart, content_type_id=content_type_id, object_id=object_id,
+                        qty=amounts[content_type_id, object_id][0], final_price=amounts[content_type_id, object_id][1]
+                    )
+                    for content_type_id, object_id in new_keys
+                ])
+            created = len(new_keys)
+        except IntegrityError:
+            # Часть строк успел создать параллельный запрос - новые товары переносим по одному
+            created = sum(_add_cart_line(cart, *key, *amounts[key]) for key in new_keys)
+        for key in existing.intersection(amounts):
+            _add_cart_line(cart, *key, *amounts[key])
+        apply_cart_delta(cart, sum(price for _, price in amounts.values()), created)
+
+
+def _lock_cart_line(cart, content_type_id, object_id):
+    """ pk и цена строки корзины, заблокированной до конца транзакции (None, если товара в корзине нет).
+        По прочитанной цене считается изменение итогов корзины
+    """
+    from .models import CartProduct
+
+    return CartProduct.objects.select_for_update().filter(
+        cart=cart, content_type_id=content_type_id, object_id=object_id
+    ).values_list('pk', 'final_price').first()
+
+
+def change_cart_product_qty(cart, product, qty):
+    """
+    Меняем колличество товара в корзине: UPDATE строки и инкрементальный UPDATE итогов корзины на разницу цен
+    (как в add_cart_product), без пересчёта всех строк корзины
+    :return: True, если товар был в корзине
+    """
+    from .models import CartProduct
+
+    with write_atomic(savepoint=False):
+        line = _lock_cart_line(cart, *get_product_content_key(product))
+        if line is None:
+            return False
+        pk, old_price = line
+        price = product.price * qty
+        CartProduct.objects.filter(pk=pk).update(qty=qty, final_price=price)
+        apply_cart_delta(cart, price - old_price)
+    return True
+
+
+def remove_cart_product(cart, product):
+    """
+    Удаляем товар из корзины: DELETE строки и инкрементальный UPDATE итогов корзины
+    :return: True, если товар был в корзине
+    """
+    from .models import CartProduct
+
+    with write_atomic(savepoint=False):
+        line = _lock_cart_line(cart, *get_product_content_key(product))
+        if line is None:
+            return False
+        pk, old_price = line
+        CartProduct.objects.filter(pk=pk).delete()
+        apply_cart_delta(cart, -old_price, -1)
+    return True
+
+
+def attach_cart_products(lines):
+    """
+    Подгружаем товары для строк корзины пачкой вместо GenericForeignKey на каждую строку:
+    один запрос к сводному каталогу и по одному запросу на модель для товаров, которых нет в каталоге
+    :param lines: Список строк корзины (CartProduct)
+    :return: lines - каждой строке проставлен атрибут product
+    """
+    from .models import CatalogProduct
+
+    if not lines:
+        return lines
+    ids_by_content_type = defaultdict(set)
+    for line in lines:
+        ids_by_content_type[line.content_type_id].add(line.object_id)
+
+    condition = models.Q()
+    for content_type_id, object_ids in ids_by_content_type.items():
+        condition |= models.Q(content_type_id=content_type_id, object_id__in=object_ids)
+    products = {
+        (entry.content_type_id, entry.object_id): entry
+        for entry in CatalogProduct.objects.filter(condition)
+    }
+
+    missing = defaultdict(set)
+    for line in lines:
+        if (line.content_type_id, line.object_id) not in products:
+            missing[line.content_type_id].add(line.object_id)
+    for content_type_id, object_ids in missing.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        for object_id, product in model._base_manager.in_bulk(object_ids).items():
+            products[(content_type_id, object_id)] = product
+
+    for line in lines:
+        line.product = products.get((line.content_type_id, line.object_id))
+    return lines
+
+
+def get_cart_lines(cart):
+    """ Все строки корзины одним запросом с уже подгруженными товарами
+    """
+    return attach_cart_products(list(cart.related_products.order_by('id')))
@@ -1,27 +1,42 @@
-from django.db import transaction
-from django.shortcuts import render
-from django.http import HttpResponseRedirect
+from abc import ABCMeta, abstractmethod
+
+from django.shortcuts import render, get_object_or_404
+from django.http import HttpResponseRedirect, JsonResponse
 from django.views.generic import DetailView, View
-from django.contrib.contenttypes.models import ContentType
 from django.contrib import messages
+from django.contrib.auth.views import redirect_to_login
 
+from .cache import get_categories, get_main_page_products_html, get_product
+from .cart import GuestCartFull
 from .mixins import CategoryDetailMixin, CartMixin, CategoryMixin
 from .forms import OrderForm
-from .utils import recalc_cart
-from .models import (
-    Category, LatestProducts, Customer, CartProduct, Wobblers, Spoons, WinterFishing, SpinningRods, Libras,
-    DryAdditives, CoilsInertial, LineMonofilament, CoilsMulty, Leashes, Floats, SlingShots, Hooks,
-)
+from .inventory import InsufficientStock, atomic_with_retry, commit_cart_stock
+from .registry import registry
+from .search import search_products
+from .tasks import enqueue_order_tasks
+from .models import Cart, Category
+
+
+
+def parse_qty(value):
+    """ Колличество товара из формы (None, если это не целое число)
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
 
 
 class BaseView(CategoryMixin, CartMixin, View):
     """ Базовый класс представлений
     """
+    query_budget = 1
+    cold_query_budget = 7
     title = 'Sniper Fish интернет магазин'
     url = 'shop/index.html'
 
-    def get(self, request, *args, **kwargs):
+    def get_context_data(self, **kwargs):
         context = {
                 'parent_category': self.parent_category,
                 'category': self.category,
@@ -29,7 +44,11 @@ class BaseView(CategoryMixin, CartMixin, View):
                 'cart': self.cart,
                 'user': self.user
         }
-        return render(request, self.url, context)
+        context.update(kwargs)
+        return context
+
+    def get(self, request, *args, **kwargs):
+        return render(request, self.url, self.get_context_data())
 
 
 
@@ -96,12 +115,14 @@ class PersonalView(CategoryMixin, CartMixin, View):
 class MainView(CategoryMixin, CartMixin, View):
     """ Представление главной страницы
     """
+    query_budget = 1
+    cold_query_budget = 8
+
     def get(self, request, *args, **kwargs):
-        products = LatestProducts.objects.get_products_for_main_page('wobblers', 'spoons')
         context = {
                 'parent_category': self.parent_category,
                 'category': self.category,
-                'products': products,
+                'products_html': get_main_page_products_html('wobblers', 'spoons'),
                 'title': "Sniper Fish интернет магазин",
                 'cart': self.cart,
                 'user': self.user
@@ -123,16 +144,58 @@ class CategoryView(BaseView):
 class CartView(BaseView):
     """ Представление корзины
     """
+    query_budget = 4
+    cold_query_budget = 9
+
     def __init__(self):
         self.title = 'Корзина'
         self.url = 'shop/cart.html'
         super(CartView, self).__init__()
 
+    def get_context_data(self, **kwargs):
+        return super().get_context_data(cart_lines=self.get_cart_lines(), **kwargs)
+
+
+
+class SearchView(BaseView):
+    """ Представление результатов поиска товаров
+    """
+    query_budget = 3
+    cold_query_budget = 9
+
+    def __init__(self):
+        self.title = 'Поиск'
+        self.url = 'shop/search.html'
+        super(SearchView, self).__init__()
+
+    def get_context_data(self, **kwargs):
+        query = self.request.GET.get('q', '').strip()
+        return super().get_context_data(query=query, products=search_products(query), **kwargs)
+
+
+
+class SearchSuggestView(View):
+    """ Подсказки поиска (автодополнение) в JSON
+    """
+    query_budget = 2
+
+    def get(self, request, *args, **kwargs):
+        products = search_products(request.GET.get('q', ''), limit=10)
+        return JsonResponse({
+            'results': [
+                {'name': product.name, 'url': product.get_absolute_url(), 'price': str(product.price)}
+                for product in products
+            ]
+        })
+
 
 
 class CheckoutView(CategoryMixin, CartMixin, View):
     """ Представление оформления заказа
     """
+    query_budget = 4
+    cold_query_budget = 9
+
     def get(self, request, *args, **kwargs):
         form = OrderForm(request.POST or None)
         context = {
@@ -140,6 +203,7 @@ class CheckoutView(CategoryMixin, CartMixin, View):
             'cart': self.cart,
             "category": self.category,
             'title': "Оформление заказа",
+            'cart_lines': self.get_cart_lines(),
             'form': form,
             'user': self.user
         }
@@ -147,28 +211,32 @@ class CheckoutView(CategoryMixin, CartMixin, View):
 
 
 
+class CartAlreadyOrdered(Exception):
+    """ Корзина уже оформлена в заказ другим запросом (повторная отправка формы)
+    """
+
+
+
 class MakeOrderView(CartMixin, View):
+    query_budget = 14
+    cold_query_budget = 15
 
-    @transaction.atomic
     def post(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            # Гостевая корзина переносится в БД после входа, заказ оформляется уже из неё
+            return redirect_to_login('/checkout/')
         form = OrderForm(request.POST or None)
-        customer = Customer.objects.get(user=request.user)
         if form.is_valid():
-            new_order = form.save(commit=False)
-            new_order.customer = customer
-            new_order.first_name = form.cleaned_data['first_name']
-            new_order.last_name = form.cleaned_data['last_name']
-            new_order.phone = form.cleaned_data['phone']
-            new_order.address = form.cleaned_data['address']
-            new_order.buying_type = form.cleaned_data['buying_type']
-            new_order.order_date = form.cleaned_data['order_date']
-            new_order.comment = form.cleaned_data['comment']
-            new_order.save()
-            self.cart.in_order = True
-            self.cart.save()
-            new_order.cart = self.cart
-            new_order.save()
-            customer.orders.add(new_order)
+            try:
+                # Списание остатков и заказ - одна транзакция, повторяемая при конфликте блокировок
+                atomic_with_retry(self.make_order, form)
+            except InsufficientStock as error:
+                messages.add_message(request, messages.ERROR, error.get_message())
+                return HttpResponseRedirect('/cart/')
+            except CartAlreadyOrdered:
+                messages.add_message(request, messages.ERROR, 'Заказ по этой корзине уже оформлен')
+                return HttpResponseRedirect('/cart/')
+            self.cart_service.forget()
             messages.add_message(
                 request,
                 messages.INFO,
@@ -177,24 +245,39 @@ class MakeOrderView(CartMixin, View):
             return  HttpResponseRedirect('/')
         return  HttpResponseRedirect('/checkout/')
 
+    def make_order(self, form):
+        """ Один INSERT заказа (покупатель и корзина проставлены сразу) и один UPDATE корзины
+        """
+        # Корзину помечаем первой: условный UPDATE блокирует её строку, и из двух одновременных отправок
+        # формы заказ оформит только одна. Вторая откатывается, ничего не списав со склада
+        if not Cart.objects.filter(pk=self.cart.pk, in_order=False).update(in_order=True):
+            raise CartAlreadyOrdered
+        commit_cart_stock(self.cart)
+        new_order = form.save(commit=False)
+        new_order.customer_id = self.cart_service.customer_id
+        new_order.cart_id = self.cart.pk
+        new_order.save(force_insert=True)
+        # Уведомления и прочее выполняются после фиксации заказа, ответ покупателю их не ждёт
+        enqueue_order_tasks(new_order)
+        return new_order
+
 
 class AddToCartView(CartMixin, View):
     """ Добавление товара в корзину
     """
+    query_budget = 11
+    cold_query_budget = 12
 
     def get(self, request, *args, **kwargs):
         path = request.META['HTTP_REFERER']
         ct_model, product_slug = kwargs.get('ct_model'), kwargs.get('slug')
-        content_type = ContentType.objects.get(model=ct_model)
-        product = content_type.model_class().objects.get(slug=product_slug)
-        cart_product, created = CartProduct.objects.get_or_create(
-            user=self.cart.owner, cart=self.cart, content_type=content_type, object_id=product.id,
-        )
-        if created:
-            self.cart.products.add(cart_product)
-
-        recalc_cart(self.cart)
-        messages.add_message(request, messages.INFO, 'Товар успешно добавлен')
+        product = get_object_or_404(registry.get_model_or_404(ct_model), slug=product_slug)
+        try:
+            self.cart_service.add_product(product)
+        except (InsufficientStock, GuestCartFull) as error:
+            messages.add_message(request, messages.ERROR, error.get_message())
+        else:
+            messages.add_message(request, messages.INFO, 'Товар успешно добавлен')
 
         return HttpResponseRedirect(path)
 
@@ -203,18 +286,26 @@ class AddToCartView(CartMixin, View):
 class ChangeQTYView(CartMixin, View):
     """ Изменение колличества товара в корзине
     """
+    query_budget = 9
+    cold_query_budget = 10
+
     def post(self, request, *args, **kwargs):
         ct_model, product_slug = kwargs.get('ct_model'), kwargs.get('slug')
-        content_type = ContentType.objects.get(model=ct_model)
-        product = content_type.model_class().objects.get(slug=product_slug)
-        cart_product = CartProduct.objects.get(
-            user=self.cart.owner, cart=self.cart, content_type=content_type, object_id=product.id,
-        )
-        qty = int(request.POST.get('qty'))
-        cart_product.qty = qty
-        cart_product.save()
-        recalc_cart(self.cart)
-        messages.add_message(request, messages.INFO, 'Колличество успешно изменено')
+        product = get_object_or_404(registry.get_model_or_404(ct_model), slug=product_slug)
+        qty = parse_qty(request.POST.get('qty'))
+        if qty is None:
+            messages.add_message(request, messages.ERROR, 'Неверное колличество товара')
+            return HttpResponseRedirect('/cart')
+        if qty <= 0:
+            self.cart_service.remove_product(product)
+            messages.add_message(request, messages.INFO, 'Товар успешно удален')
+            return HttpResponseRedirect('/cart')
+        try:
+            self.cart_service.change_qty(product, qty)
+        except InsufficientStock as error:
+            messages.add_message(request, messages.ERROR, error.get_message())
+        else:
+            messages.add_message(request, messages.INFO, 'Колличество успешно изменено')
 
         return HttpResponseRedirect('/cart')
 
@@ -223,25 +314,113 @@ class ChangeQTYView(CartMixin, View):
 class DeleteFromCartView(CartMixin, View):
     """ Удаление товара из корзины
     """
+    query_budget = 9
+    cold_query_budget = 10
+
     def get(self, request, *args, **kwargs):
         ct_model, product_slug = kwargs.get('ct_model'), kwargs.get('slug')
-        content_type = ContentType.objects.get(model=ct_model)
-        product = content_type.model_class().objects.get(slug=product_slug)
-        cart_product = CartProduct.objects.get(
-            user=self.cart.owner, cart=self.cart, content_type=content_type, object_id=product.id,
-        )
-        self.cart.products.remove(cart_product)
-        cart_product.delete()
-        recalc_cart(self.cart)
+        product = get_object_or_404(registry.get_model_or_404(ct_model), slug=product_slug)
+        self.cart_service.remove_product(product)
         messages.add_message(request, messages.INFO, 'Товар успешно удален')
 
         return HttpResponseRedirect('/cart')
 
 
 
+class CartAPIView(CartMixin, View, metaclass=ABCMeta):
+    """ Абстрактный базовый класс JSON API корзины: операция с товаром (perform) и ответ с его строкой
+        и итогами корзины, чтобы страница обновлялась на месте без перезагрузки
+    """
+    message = None
+
+    def get_product(self):
+        model = registry.get_model_or_404(self.kwargs['ct_model'])
+        return get_object_or_404(model, slug=self.kwargs['slug'])
+
+    @abstractmethod
+    def perform(self, product):
+        """ Операция с товаром в корзине
+        """
+
+    def post(self, request, *args, **kwargs):
+        product = self.get_product()
+        try:
+            self.perform(product)
+        except InsufficientStock as error:
+            return JsonResponse({'message': error.get_message(), 'shortages': error.shortages}, status=409)
+        except GuestCartFull as error:
+            return JsonResponse({'message': error.get_message()}, status=409)
+        line = self.cart_service.get_line(product)
+        cart = self.cart_service.get_cart()
+        return JsonResponse({
+            'message': self.message,
+            'line': {'qty': line.qty, 'final_price': str(line.final_price)} if line is not None else None,
+            'cart': {'total_product': cart.total_product, 'final_price': str(cart.final_price)},
+        })
+
+
+
+class CartAPIAddView(CartAPIView):
+    """ Добавление товара в корзину (JSON)
+    """
+    query_budget = 12
+    cold_query_budget = 13
+    message = 'Товар успешно добавлен'
+
+    def perform(self, product):
+        self.cart_service.add_product(product)
+
+
+
+class CartAPIChangeQTYView(CartAPIView):
+    """ Изменение колличества товара в корзине (JSON)
+    """
+    query_budget = 10
+    cold_query_budget = 11
+    message = 'Колличество успешно изменено'
+
+    def post(self, request, *args, **kwargs):
+        self.qty = parse_qty(request.POST.get('qty'))
+        if self.qty is None:
+            return JsonResponse({'message': 'Неверное колличество товара'}, status=400)
+        return super().post(request, *args, **kwargs)
+
+    def perform(self, product):
+        if self.qty > 0:
+            self.cart_service.change_qty(product, self.qty)
+        else:
+            self.cart_service.remove_product(product)
+
+
+
+class CartAPIRemoveView(CartAPIView):
+    """ Удаление товара из корзины (JSON)
+    """
+    query_budget = 10
+    cold_query_budget = 11
+    message = 'Товар успешно удален'
+
+    def perform(self, product):
+        self.cart_service.remove_product(product)
+
+
+
+class CartBadgeView(CartMixin, View):
+    """ Значок корзины в шапке сайта (JSON): колличество товаров без загрузки корзины, пока итоги в сессии свежие
+    """
+    query_budget = 1
+    cold_query_budget = 5
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse({'total_product': self.cart_service.total_product})
+
+
+
 class CategoryDetailView(CartMixin, CategoryDetailMixin, DetailView):
     """ Представление раздела конкретной категории
     """
+    query_budget = 3
+    cold_query_budget = 13
     model = Category
     queryset = Category.objects.all()
     context_object_name = 'categories'
@@ -259,37 +438,32 @@ class CategoryDetailView(CartMixin, CategoryDetailMixin, DetailView):
 class ProductDetailView(CartMixin, DetailView):
     """ Представление раздела конкретного товара
     """
-    CT_MODEL_MODEL_CLASS = {
-        'voblery': Wobblers,
-        'blesny': Spoons,
-        'aksessuary-dlya-zimnej-rybalki': WinterFishing,
-        'spinningovye-udilisha': SpinningRods,
-        'vesy': Libras,
-        'dobavki-suhie': DryAdditives,
-        'inercionnye-katushki': CoilsInertial,
-        'kryuchki': Hooks,
-        'leska-monofilnaya': LineMonofilament,
-        'multiplikatornye-katushki': CoilsMulty,
-        'povodki': Leashes,
-        'poplavki': Floats,
-        'rogatki': SlingShots
-    }
-
+    query_budget = 1
+    cold_query_budget = 7
     context_object_name = 'product'
     template_name = 'shop/product_detail.html'
     slug_url_kwarg = 'slug'
 
 
     def dispatch(self, request, *args, **kwargs):
-        self.model = self.CT_MODEL_MODEL_CLASS[kwargs['ct_model']]
+        self.model = registry.get_model_or_404(kwargs['ct_model'])
         self.queryset = self.model._base_manager.all()
+        if any(field.name == 'category' for field in self.model._meta.concrete_fields):
+            self.queryset = self.queryset.select_related('category')
         return super().dispatch(request, *args, **kwargs)
 
 
+    def get_object(self, queryset=None):
+        # Товар с подкатегорией берётся из кэша каталога до изменения товаров
+        return get_product(
+            self.model, self.kwargs[self.slug_url_kwarg], lambda: super(ProductDetailView, self).get_object(queryset)
+        )
+
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['ct_model'] = self.model._meta.model_name
         context['cart'] = self.cart
         context['user'] = self.user
-        context['category'] = Category.objects.order_by('name')
-        return context
\ No newline at end of file
+        context['category'] = get_categories()
+        return context